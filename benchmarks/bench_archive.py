@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the data flash archive.
+
+Imports a fleet of data flash dumps into an archive and queries it, and
+compares the query with parsing every dump through DataFlash.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_archive.py [number of dumps]
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+import evic
+from evic.archive import DataFlashArchive, parse_condition
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with open('testdata/test_dataflash.bin', 'rb') as dataflashfile:
+        data = dataflashfile.read()
+
+    random.seed(0)
+    dumps = []
+    for index in range(0, number):
+        dataflash = evic.DataFlash(bytearray(data), 0)
+        dataflash.product_id = random.choice(['E052', 'W007', 'M011'])
+        dataflash.hw_version = random.choice([103, 106, 108, 111])
+        dataflash.fw_version = random.choice([300, 302, 303])
+        dumps.append(("SN{:06d}".format(index), dataflash, index))
+
+    conditions = [parse_condition(condition) for condition in
+                  ["product_id==E052", "hw_version>106", "fw_version<303"]]
+
+    fd, path = tempfile.mkstemp(suffix='.evda')
+    os.close(fd)
+    os.remove(path)
+    try:
+        archive = DataFlashArchive(path)
+
+        start = time.time()
+        archive.extend(dumps)
+        print("Import:      {0:8.3f} s ({1} dumps, {2:.1f} MB)".format(
+            time.time() - start, number, os.path.getsize(path) / 1e6))
+
+        start = time.time()
+        matches = len(archive.select(conditions))
+        print("Query:       {0:8.3f} s ({1} matches)".format(
+            time.time() - start, matches))
+
+        start = time.time()
+        matches = sum(1 for _, dataflash, _ in dumps
+                      if dataflash.product_id == 'E052' and
+                      dataflash.hw_version > 106 and
+                      dataflash.fw_version < 303)
+        print("Parse dumps: {0:8.3f} s ({1} matches)".format(
+            time.time() - start, matches))
+
+        archive.close()
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
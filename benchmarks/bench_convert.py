@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for APROM conversion throughput.
+
+Compares the per-byte _genfun loop against APROM.convert.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_convert.py [size in KB]
+"""
+
+import os
+import sys
+import timeit
+
+import evic
+
+
+def convert_loop(data):
+    """The original per-byte conversion loop."""
+
+    result = bytearray(len(data))
+    for i in range(0, len(data)):
+        result[i] = (data[i] ^ evic.APROM._genfun(len(data), i)) & 0xFF
+    return result
+
+
+def throughput(func, data, number):
+    """Returns the throughput of func(data) in MB/s."""
+
+    seconds = min(timeit.repeat(lambda: func(data), number=number, repeat=3))
+    return len(data) * number / seconds / 1e6
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 120 * 1024
+    data = bytearray(os.urandom(size))
+    aprom = evic.APROM(data)
+
+    assert aprom.convert() == convert_loop(data)
+
+    print("Image size: {} KB, NumPy: {}".format(
+        size // 1024, evic.aprom.numpy_module() is not None))
+    print("Per-byte loop:  {0:10.2f} MB/s".format(
+        throughput(convert_loop, data, 1)))
+
+    cache = evic.aprom.keystream_cache
+    cache.resize(0)
+    print("APROM.convert:  {0:10.2f} MB/s".format(
+        throughput(lambda _: aprom.convert(), data, 20)))
+    cache.resize(4 * 1024 * 1024)
+    print("Cached:         {0:10.2f} MB/s".format(
+        throughput(lambda _: aprom.convert(), data, 20)))
+
+
+if __name__ == '__main__':
+    main()
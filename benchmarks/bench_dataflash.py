@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for reading and editing data flash dumps.
+
+Reads a few fields from and bulk-edits a batch of data flash dumps through
+binstruct descriptors and through the compiled DataFlash layouts.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_dataflash.py [number of dumps]
+"""
+
+import sys
+import time
+
+import binstruct
+
+import evic
+
+
+class BinstructDataFlash(binstruct.StructTemplate):
+    """The original binstruct based DataFlash."""
+
+    hw_version = binstruct.Int32Field(4)
+    bootflag = binstruct.Int8Field(9)
+    product_id = binstruct.StringField(312, 4)
+    fw_version = binstruct.Int32Field(256)
+    ldrom_version = binstruct.Int32Field(260)
+
+
+def read_fields(cls, dumps):
+    for dump in dumps:
+        dataflash = cls(dump, 0)
+        (dataflash.product_id, dataflash.hw_version, dataflash.fw_version,
+         dataflash.ldrom_version)
+
+
+def edit(cls, dumps):
+    for dump in dumps:
+        dataflash = cls(dump, 0)
+        if dataflash.product_id == 'E052':
+            dataflash.hw_version = 106
+            dataflash.bootflag = 0
+
+
+def settings(cls, dumps):
+    for dump in dumps:
+        cls(dump, 0).settings()
+
+
+def measure(func, cls, dumps):
+    start = time.process_time()
+    func(cls, dumps)
+    return (time.process_time() - start) / len(dumps) * 1e6
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    with open('testdata/test_dataflash.bin', 'rb') as dataflashfile:
+        data = dataflashfile.read()
+    dumps = [bytearray(data) for _ in range(0, number)]
+
+    print("Dumps: {}".format(number))
+    for name, func in [("Read 4 fields", read_fields),
+                       ("Edit 2 fields", edit)]:
+        old = measure(func, BinstructDataFlash, dumps)
+        new = measure(func, evic.DataFlash, dumps)
+        print("{0:16} {1:8.2f} us/dump -> {2:6.2f} us/dump".format(
+            name + ":", old, new))
+    print("{0:16} {1:8.2f} us/dump ({2} fields)".format(
+        "All settings:", measure(settings, evic.DataFlash, dumps),
+        len(evic.DataFlash.fields)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for HIDTransfer.write.
+
+Writes an APROM sized payload to a stand-in HID device and reports the
+CPU time and the peak memory allocated per MB written.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_hid_write.py [size in KB]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+import evic
+
+
+class NullDevice(object):
+    """Stand-in for hid.device that accepts every report."""
+
+    def write(self, buf):
+        return len(buf)
+
+
+def write_copying(dev, data):
+    """The original list-of-chunks implementation of HIDTransfer.write."""
+
+    bytes_written = 0
+    chunks = [bytearray(data[i:i+64]) for i in range(0, len(data), 64)]
+    for chunk in chunks:
+        buf = bytearray([0]) + chunk
+        bytes_written += dev.device.write(buf) - 1
+    if bytes_written != len(data):
+        raise IOError("HID Write failed.")
+
+
+def measure(func, dev, data, number):
+    """Returns the CPU time and peak allocation per MB written."""
+
+    megabytes = len(data) * number / 1e6
+
+    tracemalloc.start()
+    func(dev, data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    start = time.process_time()
+    for _ in range(0, number):
+        func(dev, data)
+    cpu = time.process_time() - start
+
+    return cpu / megabytes * 1e3, peak / 1024.0
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 100 * 1024
+    data = bytearray(os.urandom(size))
+
+    dev = evic.HIDTransfer()
+    dev.device = NullDevice()
+
+    print("Payload size: {} KB".format(size // 1024))
+    for name, func in [("Copying chunks", write_copying),
+                       ("HIDTransfer.write", evic.HIDTransfer.write)]:
+        cpu, peak = measure(func, dev, data, 50)
+        print("{0:18} {1:8.2f} ms CPU/MB {2:10.1f} KB peak".format(
+            name + ":", cpu, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end upload benchmark against a simulated device.
+
+Runs the upload sequence of evic-usb (connect, read and write the data
+flash, reset, reconnect and write the APROM) and reports the time spent
+in each phase and the APROM throughput.
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_upload.py [latency per report in ms]
+"""
+
+import os
+import sys
+import time
+
+import evic
+
+
+def main():
+    latency = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.0005
+    bus = evic.SimulatedHID(latency=latency, reset_delay=0.5)
+    aprom = evic.APROM(os.urandom(100 * 1024))
+    dev = evic.HIDTransfer(backend=bus)
+
+    phases = []
+
+    def phase(name, func, *args):
+        start = time.time()
+        func(*args)
+        phases.append((name, time.time() - start))
+
+    phase("Connect", dev.connect)
+    phase("Read data flash", dev.read_dataflash)
+    dataflash = dev.read_dataflash()[0]
+    dataflash.bootflag = 1
+    phase("Write data flash", dev.write_dataflash, dataflash)
+    phase("Reset", dev.reset)
+    phase("Reconnect", dev.reconnect)
+    phase("Write APROM", dev.write_aprom, aprom)
+
+    print("Latency per report: {0:.2f} ms".format(latency * 1000))
+    for name, seconds in phases:
+        print("{0:18} {1:8.3f} s".format(name + ":", seconds))
+    print("{0:18} {1:8.3f} s".format("Total:", sum(s for _, s in phases)))
+    print("APROM throughput: {0:.1f} KB/s".format(
+        len(aprom.data) / 1024.0 / phases[-1][1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,8 +19,54 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 __version__ = '0.1.dev0'
 
+import sys
+import importlib
 
-from .device import HIDTransfer
-from .aprom import APROM, APROMError
-from .dataflash import DataFlash, DataFlashError
-from .logo import Logo, LogoConversionError
+# Names exported by the package and their modules. They are imported on
+# first use, so that evic-client doesn't wait for NumPy and Pillow.
+_EXPORTS = {
+    'HIDTransfer': 'device', 'TransferError': 'device',
+    'TransferStats': 'device',
+    'APROM': 'aprom', 'APROMError': 'aprom',
+    'DataFlash': 'dataflash', 'DataFlashError': 'dataflash',
+    'Logo': 'logo', 'LogoConversionError': 'logo',
+    'Catalog': 'catalog',
+    'ImageCache': 'imagecache',
+    'FlashJournal': 'journal',
+    'SimulatedHID': 'simulator', 'SimulatedUnit': 'simulator',
+    'RecordingHID': 'trace', 'ReplayHID': 'trace', 'TraceError': 'trace',
+    'DataFlashPatch': 'patch', 'PatchError': 'patch',
+    'DataFlashArchive': 'archive',
+    'BackupStore': 'backup', 'BackupError': 'backup',
+}
+
+_SUBMODULES = ('aprom', 'archive', 'asyncdevice', 'backup', 'catalog', 'cli',
+               'client', 'dataflash', 'device', 'imagecache', 'journal',
+               'logo', 'patch', 'server', 'simulator', 'trace')
+
+__all__ = sorted(_EXPORTS)
+
+
+def _load(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+
+    module = importlib.import_module('.' + _EXPORTS[name], __name__)
+    return getattr(module, name)
+
+
+# Module __getattr__ needs Python 3.7
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name not in _EXPORTS and name not in _SUBMODULES:
+            raise AttributeError("module {!r} has no attribute {!r}".format(
+                __name__, name))
+        value = _load(name)
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(_EXPORTS) | set(_SUBMODULES))
+else:
+    for _name in _EXPORTS:
+        globals()[_name] = _load(_name)
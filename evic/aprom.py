@@ -17,7 +17,24 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
+import io
+import re
+import mmap
 import struct
+import binascii
+import threading
+from collections import OrderedDict, namedtuple
+
+APROMInfo = namedtuple('APROMInfo', 'manufacturer product_ids')
+
+# The NumPy module, False if it's missing or None before the first import
+_numpy = None
+
+# Finds the manufacturer string and everything that looks like a product ID
+# in a single pass. The lookahead allows overlapping matches.
+_SCAN_PATTERN = re.compile(b'(?=(Joyetech APROM|[A-Z][0-9]{3}))')
+_PRODUCT_ID_PATTERN = re.compile('^[A-Z][0-9]{3}$')
 
 
 class APROMError(Exception):
@@ -31,10 +48,14 @@ class APROM(object):
 
     Attributes:
         data: A bytearray containing the binary data of the firmware.
+        info: An APROMInfo tuple of the scanned data or None if the data
+              hasn't been scanned yet. It isn't checked against the data,
+              so set it to None after changing the data.
     """
 
-    def __init__(self, data):
+    def __init__(self, data, info=None):
         self.data = bytearray(data)
+        self.info = info
 
     @staticmethod
     def _genfun(filesize, index):
@@ -47,6 +68,30 @@ class APROM(object):
 
         return filesize + 408376 + index - filesize // 408376
 
+    @classmethod
+    def keystream(cls, filesize, offset=0, length=None):
+        """Generates the conversion keystream for a range of the file.
+
+        The low byte of _genfun grows by one with the index, so the
+        keystream is a 256 byte sequence repeated over the whole file.
+
+        Args:
+            filesize: Filesize of the APROM file in bytes.
+            offset: Index of the first byte in the keystream.
+            length: Length of the keystream. Defaults to the rest of the file.
+
+        Returns:
+            A bytearray containing the keystream.
+        """
+
+        if length is None:
+            length = filesize - offset
+
+        first = cls._genfun(filesize, offset) & 0xFF
+        period = bytearray((first + i) & 0xFF for i in range(0, 256))
+
+        return (period * (length // 256 + 1))[:length]
+
     def convert(self):
         """Decrypts/Encrypts the binary data.
 
@@ -54,11 +99,53 @@ class APROM(object):
             A Bytearray containing decrypted/encrypted APROM image.
         """
 
-        data = bytearray(len(self.data))
-        for i in range(0, len(self.data)):
-            data[i] = (self.data[i] ^
-                       self._genfun(len(self.data), i)) & 0xFF
-        return data
+        return xor(self.data, keystream_cache.get(len(self.data)))
+
+    def _max_hw_version(self, max_hw_ind):
+        """Reads the maximum hardware version following a product ID.
+
+        Args:
+            max_hw_ind: Index of the first byte after the product ID.
+        """
+
+        max_hw = self.data[max_hw_ind:max_hw_ind+3]
+        return struct.unpack("=I", bytes(b'\x00' + max_hw))[0]
+
+    def scan(self):
+        """Scans the data for the verification information.
+
+        The manufacturer string and the first occurrence of every product ID
+        are located in a single pass over the data. The result is stored in
+        the info attribute and reused until the attribute is cleared. The
+        data must not change while the info attribute is set.
+
+        Data needs to be unencrypted.
+
+        Returns:
+            An APROMInfo tuple. product_ids maps product ID strings to tuples
+            containing the index of the ID and the maximum hardware version.
+        """
+
+        if self.info is None:
+            manufacturer = False
+            product_ids = {}
+            for match in _SCAN_PATTERN.finditer(self.data):
+                found = match.group(1)
+                if len(found) != 4:
+                    manufacturer = True
+                    continue
+                product_id = found.decode('ascii')
+                if product_id not in product_ids:
+                    id_ind = match.start(1)
+                    try:
+                        product_ids[product_id] = (
+                            id_ind, self._max_hw_version(id_ind + 4))
+                    # Product ID at the very end of the data
+                    except struct.error:
+                        continue
+            self.info = APROMInfo(manufacturer, product_ids)
+
+        return self.info
 
     def verify(self, product_ids, hw_version):
         """Verifies the contained data.
@@ -74,25 +161,28 @@ class APROM(object):
 
         """
 
+        info = self.scan()
+
         # Does the APROM contain the string "Joyetech APROM"?
-        if b'Joyetech APROM' not in self.data:
+        if not info.manufacturer:
             raise APROMError("Firmware manufacturer verification failed.")
 
         id_ind = 0
         max_hw_version = 0
         # Try to locate supported product IDs
         for product_id in product_ids:
-            try:
-                product_id = product_id.encode()
-                id_ind = self.data.index(product_id)
-                # Maximum hardware version follows the product ID
-                max_hw_ind = id_ind + len(product_id)
-                max_hw_version = struct.unpack("=I", bytes(b'\x00' +
-                                                           self.data[max_hw_ind:max_hw_ind+3]))[0]
+            if product_id in info.product_ids:
+                id_ind, max_hw_version = info.product_ids[product_id]
                 break
-            # Product ID was not found, try the next one
-            except ValueError:
-                continue
+            # Only IDs in the usual format are found by the scan
+            if not _PRODUCT_ID_PATTERN.match(product_id):
+                product_id = product_id.encode()
+                id_ind = self.data.find(product_id)
+                if id_ind >= 0:
+                    max_hw_version = self._max_hw_version(
+                        id_ind + len(product_id))
+                    break
+                id_ind = 0
 
         # Raise an error if none of the supported product IDs were found
         if not id_ind:
@@ -102,3 +192,179 @@ class APROM(object):
         # the supplied hardware version
         if max_hw_version < hw_version:
             raise APROMError("Firmware hardware version verification failed.")
+
+
+class KeystreamCache(object):
+    """LRU cache of whole file keystreams keyed by filesize.
+
+    Attributes:
+        max_bytes: Maximum combined size of the cached keystreams in bytes.
+                   Keystreams longer than this are not cached.
+        hits: Number of lookups served from the cache.
+        misses: Number of lookups that generated a new keystream.
+    """
+
+    def __init__(self, max_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._keystreams = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keystreams)
+
+    def get(self, filesize):
+        """Returns the keystream for a file.
+
+        Args:
+            filesize: Filesize of the APROM file in bytes.
+
+        Returns:
+            A bytes object containing the keystream.
+        """
+
+        with self._lock:
+            keystream = self._keystreams.pop(filesize, None)
+            if keystream is not None:
+                self.hits += 1
+                # Move to the most recently used end
+                self._keystreams[filesize] = keystream
+                return keystream
+            self.misses += 1
+
+        keystream = bytes(APROM.keystream(filesize))
+        if filesize > self.max_bytes:
+            return keystream
+
+        with self._lock:
+            if filesize not in self._keystreams:
+                self._keystreams[filesize] = keystream
+                self.nbytes += filesize
+            self._evict()
+
+        return keystream
+
+    def resize(self, max_bytes):
+        """Changes the memory limit, evicting keystreams if needed.
+
+        Args:
+            max_bytes: New memory limit in bytes.
+        """
+
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """Empties the cache and resets the counters."""
+
+        with self._lock:
+            self._keystreams.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _evict(self):
+        """Drops the least recently used keystreams until under the limit."""
+
+        while self.nbytes > self.max_bytes:
+            filesize, _ = self._keystreams.popitem(last=False)
+            self.nbytes -= filesize
+
+
+# Keystream cache shared by all APROM objects
+keystream_cache = KeystreamCache()
+
+
+def convert_file(inputfile, outputfile, blocksize=65536):
+    """Decrypts/Encrypts an APROM file block by block.
+
+    The input file is memory mapped when possible, so the memory used
+    doesn't depend on the size of the file. Other file objects are
+    converted in memory.
+
+    Args:
+        inputfile: A file object opened for reading in binary mode.
+        outputfile: A file object opened for writing in binary mode.
+        blocksize: Amount of bytes converted at a time.
+
+    Returns:
+        The number of bytes written.
+    """
+
+    try:
+        fileno = inputfile.fileno()
+        filesize = os.fstat(fileno).st_size
+        source = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError,
+            io.UnsupportedOperation):
+        # Pipes, empty files and in-memory files can't be mapped
+        data = APROM(inputfile.read()).convert()
+        outputfile.write(data)
+        return len(data)
+
+    try:
+        for offset in range(0, filesize, blocksize):
+            block = source[offset:offset + blocksize]
+            outputfile.write(xor(block, APROM.keystream(filesize, offset,
+                                                        len(block))))
+    finally:
+        source.close()
+
+    return filesize
+
+
+def numpy_module():
+    """Returns the NumPy module or None if it isn't installed.
+
+    NumPy is imported on first use, as importing it takes longer than
+    converting a typical image.
+    """
+
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+
+    return _numpy or None
+
+
+def xor(data, key):
+    """XORs a byte sequence with a key.
+
+    Uses NumPy if it is available.
+
+    Args:
+        data: A bytes-like object.
+        key: A bytes-like object at least as long as data.
+
+    Returns:
+        A bytearray containing the result.
+    """
+
+    length = len(data)
+    if not length:
+        return bytearray()
+
+    numpy = numpy_module()
+    if numpy is not None:
+        result = numpy.bitwise_xor(numpy.frombuffer(data, numpy.uint8),
+                                   numpy.frombuffer(key, numpy.uint8,
+                                                    length))
+        return bytearray(result.tobytes())
+
+    # XOR the sequences as big integers
+    if hasattr(int, 'from_bytes'):
+        result = int.from_bytes(data, 'little') ^ \
+            int.from_bytes(key[:length], 'little')
+        return bytearray(result.to_bytes(length, 'little'))
+
+    # Python 2
+    result = int(binascii.hexlify(data), 16) ^ \
+        int(binascii.hexlify(key[:length]), 16)
+    return bytearray(binascii.unhexlify('%0*x' % (length * 2, result)))
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+import time
+import struct
+import operator
+from collections import namedtuple
+
+from .aprom import numpy_module
+from .dataflash import DataFlash
+
+# An archive starts with the magic bytes, a version byte and the record
+# size, followed by fixed size records. A record is the serial number, the
+# time of the dump in seconds since the epoch and the data flash. The
+# records are read as a NumPy structured array with a column per data flash
+# field, without parsing them one by one. NumPy is only imported by the
+# queries.
+MAGIC = b'EVDA'
+VERSION = 1
+
+# Longest serial number a record holds
+SERIAL_SIZE = 16
+
+_HEADER = struct.Struct('<4sBH')
+_RECORD = struct.Struct('<{}sd'.format(SERIAL_SIZE))
+
+RECORD_SIZE = _RECORD.size + DataFlash.size
+
+# Columns holding a single value, which can be compared and counted
+SCALAR_COLUMNS = ('serial', 'time') + tuple(
+    name for name in DataFlash.fields if getattr(DataFlash, name).count == 1)
+
+ArchiveRecord = namedtuple('ArchiveRecord', 'serial time dataflash')
+
+# NumPy types of the struct format characters used by DataFlash
+_NUMPY_TYPES = {'B': 'u1', 'H': '<u2', 'I': '<u4'}
+
+_FORMAT_PATTERN = re.compile(r'^(\d*)([BHIs])$')
+
+_CONDITION_PATTERN = re.compile(
+    r'^\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*(.+?)\s*$')
+
+_OPERATORS = {'<': operator.lt, '<=': operator.le, '==': operator.eq,
+              '!=': operator.ne, '>=': operator.ge, '>': operator.gt}
+
+
+class ArchiveError(IOError):
+    """The file is not a data flash archive."""
+
+    pass
+
+
+def record_dtype():
+    """Returns the NumPy dtype of the archive records.
+
+    The columns are serial, time and the DataFlash fields.
+    """
+
+    numpy = numpy_module()
+    names = ['serial', 'time']
+    formats = ['S{}'.format(SERIAL_SIZE), '<f8']
+    offsets = [0, SERIAL_SIZE]
+    for name in DataFlash.fields:
+        field = getattr(DataFlash, name)
+        count, code = _FORMAT_PATTERN.match(field.fmt).groups()
+        count = int(count or 1)
+        if code == 's':
+            fmt = 'S{}'.format(count)
+        elif count == 1:
+            fmt = _NUMPY_TYPES[code]
+        else:
+            fmt = (_NUMPY_TYPES[code], (count,))
+        names.append(name)
+        formats.append(fmt)
+        offsets.append(_RECORD.size + field.offset)
+
+    return numpy.dtype({'names': names, 'formats': formats,
+                        'offsets': offsets, 'itemsize': RECORD_SIZE})
+
+
+def parse_condition(condition):
+    """Parses a query condition such as "hw_version>106".
+
+    Args:
+        condition: A string containing a field name, a comparison operator
+                   and a value.
+
+    Returns:
+        A tuple containing the field name, the operator and the value.
+
+    Raises:
+        ValueError: The condition is invalid.
+    """
+
+    match = _CONDITION_PATTERN.match(condition)
+    if not match:
+        raise ValueError("Invalid condition {}.".format(condition))
+    name, op, value = match.groups()
+    if name not in SCALAR_COLUMNS:
+        raise ValueError("Can't compare field {}.".format(name))
+
+    if name not in ('serial', 'product_id'):
+        value = float(value) if name == 'time' else int(value, 0)
+
+    return (name, op, value)
+
+
+class DataFlashArchive(object):
+    """An append only archive of data flash dumps.
+
+    Appending works without NumPy, queries need it.
+
+    Attributes:
+        path: Path of the archive file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab+')
+        self._file.seek(0)
+        header = self._file.read(_HEADER.size)
+        if not header:
+            self._file.write(_HEADER.pack(MAGIC, VERSION, RECORD_SIZE))
+            self._file.flush()
+        elif len(header) != _HEADER.size or \
+                _HEADER.unpack(header) != (MAGIC, VERSION, RECORD_SIZE):
+            self._file.close()
+            raise ArchiveError("Not a data flash archive.")
+
+    def close(self):
+        """Closes the archive file."""
+
+        self._file.close()
+
+    def __len__(self):
+        size = os.fstat(self._file.fileno()).st_size
+        return (size - _HEADER.size) // RECORD_SIZE
+
+    def append(self, serial, dataflash, timestamp=None):
+        """Appends a data flash dump.
+
+        Args:
+            serial: Serial number string of the device.
+            dataflash: evic.DataFlash object.
+            timestamp: Time of the dump. Defaults to now.
+        """
+
+        self.extend([(serial, dataflash, timestamp)])
+
+    def extend(self, dumps):
+        """Appends several data flash dumps with a single write.
+
+        Args:
+            dumps: An iterable of (serial, dataflash, timestamp) tuples.
+
+        Raises:
+            ValueError: A serial number is longer than 16 bytes. Nothing is
+                        appended.
+        """
+
+        now = time.time()
+        buf = bytearray()
+        for serial, dataflash, timestamp in dumps:
+            serial = serial.encode('latin-1')
+            if len(serial) > SERIAL_SIZE:
+                raise ValueError("Serial number {} is longer than {} "
+                                 "bytes.".format(serial.decode('latin-1'),
+                                                 SERIAL_SIZE))
+            buf += _RECORD.pack(serial,
+                                now if timestamp is None else timestamp)
+            start = dataflash.start_offset
+            buf += dataflash.array[start:start + DataFlash.size]
+
+        self._file.write(buf)
+        self._file.flush()
+
+    def records(self):
+        """Reads the dumps one by one.
+
+        Returns:
+            An iterator of ArchiveRecord tuples.
+        """
+
+        self._file.seek(_HEADER.size)
+        while True:
+            buf = self._file.read(RECORD_SIZE)
+            if len(buf) < RECORD_SIZE:
+                break
+            serial, timestamp = _RECORD.unpack_from(buf)
+            yield ArchiveRecord(serial.rstrip(b'\0').decode('latin-1'),
+                                timestamp,
+                                DataFlash(bytearray(buf), _RECORD.size))
+
+    def dataflash(self, index):
+        """Returns the data flash of a dump.
+
+        Args:
+            index: Index of the dump in the archive.
+        """
+
+        self._file.seek(_HEADER.size + index * RECORD_SIZE + _RECORD.size)
+        return DataFlash(bytearray(self._file.read(DataFlash.size)), 0)
+
+    def table(self):
+        """Returns all the dumps as a read-only NumPy structured array.
+
+        The file is memory mapped instead of being parsed record by record.
+        """
+
+        numpy = numpy_module()
+        count = len(self)
+        if not count:
+            return numpy.zeros(0, record_dtype())
+
+        return numpy.memmap(self.path, record_dtype(), 'r', _HEADER.size,
+                            (count,))
+
+    def select(self, conditions=(), latest=False):
+        """Finds the dumps matching all the conditions.
+
+        Args:
+            conditions: An iterable of (field name, operator, value) tuples,
+                        e.g. ('hw_version', '>', 106).
+            latest: True to only consider the latest dump of each device.
+
+        Returns:
+            A NumPy array of the indices of the matching dumps.
+        """
+
+        numpy = numpy_module()
+        table = self.table()
+        mask = numpy.ones(len(table), bool)
+        if latest and len(table):
+            # Last index of each serial after a stable sort by time
+            order = numpy.argsort(table['time'], kind='stable')[::-1]
+            _, first = numpy.unique(table['serial'][order],
+                                    return_index=True)
+            mask[:] = False
+            mask[order[first]] = True
+
+        for name, op, value in conditions:
+            if name in ('serial', 'product_id'):
+                value = value.encode('latin-1')
+            mask &= _OPERATORS[op](table[name], value)
+
+        return numpy.flatnonzero(mask)
+
+    def count_by(self, name, indices=None):
+        """Counts the dumps by the value of a field.
+
+        Args:
+            name: Name of a column in SCALAR_COLUMNS.
+            indices: Indices of the dumps to count. Defaults to all dumps.
+
+        Returns:
+            A list of (value, count) tuples sorted by value.
+        """
+
+        numpy = numpy_module()
+        column = self.table()[name]
+        if indices is not None:
+            column = column[indices]
+        values, counts = numpy.unique(column, return_counts=True)
+        values = values.tolist()
+        if column.dtype.kind == 'S':
+            values = [value.decode('latin-1') for value in values]
+
+        return list(zip(values, counts.tolist()))
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .device import HIDTransfer
+
+
+class AsyncHIDTransfer(object):
+    """asyncio interface to a Nuvoton HID Transfer device.
+
+    The blocking hidapi calls of the wrapped HIDTransfer run in a bounded
+    thread pool. Calls to one device are serialized, calls to different
+    devices run concurrently. Needs Python 3.7 or later.
+
+    Attributes:
+        transfer: The wrapped HIDTransfer object. Its attributes, such as
+                  serial and ldrom, can be read through this object.
+        executor: The executor running the blocking calls.
+        max_workers: Size of the executor shared by all instances.
+    """
+
+    max_workers = 32
+    _shared_executor = None
+
+    def __init__(self, transfer=None, executor=None):
+        self.transfer = transfer if transfer is not None else HIDTransfer()
+        self.executor = executor or self.shared_executor()
+        self._lock = None
+        self._lock_loop = None
+
+    @classmethod
+    def shared_executor(cls):
+        """Returns the executor shared by all instances."""
+
+        if cls._shared_executor is None:
+            cls._shared_executor = ThreadPoolExecutor(cls.max_workers)
+
+        return cls._shared_executor
+
+    def __getattr__(self, name):
+        if name == 'transfer':
+            raise AttributeError(name)
+        return getattr(self.transfer, name)
+
+    async def _call(self, func, *args):
+        """Runs a blocking call in the executor.
+
+        Args:
+            func: The callable.
+            *args: Arguments for the callable.
+        """
+
+        # Before Python 3.10 a lock belongs to the loop it's created in
+        loop = asyncio.get_running_loop()
+        if self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+
+        async with self._lock:
+            return await loop.run_in_executor(
+                self.executor, functools.partial(func, *args))
+
+    async def connect(self):
+        """Connects the USB device."""
+
+        await self._call(self.transfer.connect)
+
+    async def close(self):
+        """Closes the USB device."""
+
+        await self._call(self.transfer.close)
+
+    async def read_dataflash(self):
+        """Reads the device data flash.
+
+        Returns:
+            A tuple containing the data flash and its checksum.
+        """
+
+        return await self._call(self.transfer.read_dataflash)
+
+    async def write_dataflash(self, dataflash):
+        """Writes the data flash to the device.
+
+        Args:
+            dataflash: A DataFlash object.
+        """
+
+        await self._call(self.transfer.write_dataflash, dataflash)
+
+    async def write_aprom(self, aprom):
+        """Writes the APROM to the device.
+
+        Args:
+            aprom: An APROM object containing an unencrypted image.
+        """
+
+        await self._call(self.transfer.write_aprom, aprom)
+
+    async def write_logo(self, logo):
+        """Writes the logo to the device.
+
+        Args:
+            logo: A Logo object.
+        """
+
+        await self._call(self.transfer.write_logo, logo)
+
+    async def reset(self):
+        """Resets the device."""
+
+        await self._call(self.transfer.reset)
+
+    async def reconnect(self, delay=0.2, interval=0.05, backoff=1.5,
+                        max_interval=0.5, timeout=10.0, ldrom=True):
+        """Connects the device again after a reset.
+
+        Same as HIDTransfer.reconnect, but waits without blocking the
+        event loop.
+
+        Returns:
+            The seconds from the reset until the device was ready.
+
+        Raises:
+            IOError: The device didn't restart in time.
+        """
+
+        await self.close()
+        start = time.time()
+
+        attempts = 0
+        for wait in self.transfer._reconnect_waits(
+                start, delay, interval, backoff, max_interval, timeout,
+                ldrom):
+            await asyncio.sleep(wait)
+            attempts += 1
+            if await self._call(self.transfer.try_reconnect, ldrom):
+                break
+
+        return self.transfer._reconnected(start, attempts)
+
+    async def restart(self, **kwargs):
+        """Resets the device and connects again once it has restarted.
+
+        Args:
+            **kwargs: Arguments for reconnect.
+
+        Returns:
+            The seconds from the reset until the device was ready.
+        """
+
+        await self.reset()
+        return await self.reconnect(**kwargs)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+import zlib
+import hashlib
+import sqlite3
+from collections import namedtuple
+
+from .dataflash import DataFlash
+
+Snapshot = namedtuple('Snapshot', 'id serial time product_id fw_version '
+                                  'sha256')
+
+BackupStats = namedtuple('BackupStats', 'snapshots objects size')
+
+
+class BackupError(Exception):
+    """The snapshot doesn't exist."""
+
+    pass
+
+
+# Preset dictionaries need Python 3.3
+_ZDICT_SUPPORTED = sys.version_info >= (3, 3)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    sha256 TEXT PRIMARY KEY,
+    baseline TEXT,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS baselines (
+    product_id TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    serial TEXT NOT NULL,
+    time REAL NOT NULL,
+    product_id TEXT NOT NULL,
+    fw_version INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_serial ON snapshots (serial, time);
+"""
+
+
+class BackupStore(object):
+    """A deduplicating store of data flash snapshots.
+
+    Each distinct data flash is stored once, identified by its SHA-256
+    hash. The first data flash stored for a product becomes the baseline of
+    that product, and the others are compressed with it as the zlib preset
+    dictionary. Devices of the same model have near-identical data flash,
+    so a snapshot takes only a few dozen bytes.
+
+    Attributes:
+        path: Path of the SQLite database.
+        connection: sqlite3 connection to the database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_SCHEMA)
+        self._baselines = {}
+
+    def close(self):
+        """Closes the database."""
+
+        self.connection.close()
+
+    def _compress(self, data, baseline):
+        if baseline is None:
+            return zlib.compress(data, 9)
+
+        compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS, 9,
+                                      zlib.Z_DEFAULT_STRATEGY,
+                                      self._baseline(baseline))
+        return compressor.compress(data) + compressor.flush()
+
+    def _baseline(self, sha256):
+        """Returns the contents of a baseline, caching them."""
+
+        if sha256 not in self._baselines:
+            self._baselines[sha256] = self._data(sha256)
+
+        return self._baselines[sha256]
+
+    def _data(self, sha256):
+        """Returns the contents of a stored object."""
+
+        row = self.connection.execute(
+            "SELECT baseline, data FROM objects WHERE sha256 = ?",
+            (sha256,)).fetchone()
+        if row is None:
+            raise BackupError("Missing backup object {}.".format(sha256))
+        baseline, data = row
+
+        if baseline is None:
+            return zlib.decompress(bytes(data))
+
+        decompressor = zlib.decompressobj(zdict=self._baseline(baseline))
+        return decompressor.decompress(bytes(data)) + decompressor.flush()
+
+    def _store(self, sha256, data, product_id):
+        """Stores an object unless it's already stored.
+
+        Called in a transaction holding the write lock, so that concurrent
+        captures agree on the baseline.
+        """
+
+        if self.connection.execute(
+                "SELECT 1 FROM objects WHERE sha256 = ?",
+                (sha256,)).fetchone():
+            return
+
+        # The first object stored for a product becomes its baseline
+        self.connection.execute(
+            "INSERT OR IGNORE INTO baselines VALUES (?, ?)",
+            (product_id, sha256))
+        baseline, = self.connection.execute(
+            "SELECT sha256 FROM baselines WHERE product_id = ?",
+            (product_id,)).fetchone()
+        if baseline == sha256:
+            self._baselines[sha256] = data
+            baseline = None
+        elif not _ZDICT_SUPPORTED:
+            baseline = None
+
+        self.connection.execute(
+            "INSERT INTO objects VALUES (?, ?, ?)",
+            (sha256, baseline,
+             sqlite3.Binary(self._compress(data, baseline))))
+
+    def capture(self, serial, dataflash, timestamp=None):
+        """Stores a snapshot of a device data flash.
+
+        Nothing is stored if the data flash hasn't changed since the latest
+        snapshot of the device.
+
+        Args:
+            serial: Serial number of the device.
+            dataflash: evic.DataFlash object.
+            timestamp: Time of the snapshot. Defaults to now.
+
+        Returns:
+            The Snapshot tuple of the data flash.
+        """
+
+        start = dataflash.start_offset
+        data = bytes(dataflash.array[start:start + DataFlash.size])
+        sha256 = hashlib.sha256(data).hexdigest()
+
+        latest = self.snapshots(serial, 1)
+        if latest and latest[0].sha256 == sha256:
+            return latest[0]
+
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self._store(sha256, data, dataflash.product_id)
+            cursor = self.connection.execute(
+                "INSERT INTO snapshots (serial, time, product_id, fw_version,"
+                " sha256) VALUES (?, ?, ?, ?, ?)",
+                (serial, time.time() if timestamp is None else timestamp,
+                 dataflash.product_id, dataflash.fw_version, sha256))
+
+        return self.snapshot(cursor.lastrowid)
+
+    def snapshot(self, snapshot_id):
+        """Returns a Snapshot tuple.
+
+        Raises:
+            BackupError: The snapshot doesn't exist.
+        """
+
+        row = self.connection.execute(
+            "SELECT * FROM snapshots WHERE id = ?", (snapshot_id,)).fetchone()
+        if row is None:
+            raise BackupError("No snapshot {}.".format(snapshot_id))
+
+        return Snapshot(*row)
+
+    def snapshots(self, serial=None, limit=-1):
+        """Lists the snapshots, newest first.
+
+        Args:
+            serial: Serial number of a device or None for all devices.
+            limit: Maximum number of snapshots or -1 for all.
+
+        Returns:
+            A list of Snapshot tuples.
+        """
+
+        if serial is None:
+            rows = self.connection.execute(
+                "SELECT * FROM snapshots ORDER BY time DESC, id DESC LIMIT ?",
+                (limit,))
+        else:
+            rows = self.connection.execute(
+                "SELECT * FROM snapshots WHERE serial = ?"
+                " ORDER BY time DESC, id DESC LIMIT ?", (serial, limit))
+
+        return [Snapshot(*row) for row in rows]
+
+    def load(self, snapshot_id):
+        """Returns the data flash of a snapshot.
+
+        Returns:
+            An evic.DataFlash object.
+
+        Raises:
+            BackupError: The snapshot doesn't exist.
+        """
+
+        return DataFlash(bytearray(self._data(
+            self.snapshot(snapshot_id).sha256)), 0)
+
+    def stats(self):
+        """Returns a BackupStats tuple of the store size."""
+
+        snapshots, = self.connection.execute(
+            "SELECT COUNT(*) FROM snapshots").fetchone()
+        objects, size = self.connection.execute(
+            "SELECT COUNT(*), TOTAL(LENGTH(data)) FROM objects").fetchone()
+
+        return BackupStats(snapshots, objects, int(size))
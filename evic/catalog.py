@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import hashlib
+import sqlite3
+from collections import namedtuple
+
+from .aprom import APROM
+
+CatalogUpdate = namedtuple('CatalogUpdate', 'scanned unchanged removed')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256);
+CREATE TABLE IF NOT EXISTS contents (
+    sha256 TEXT PRIMARY KEY,
+    encrypted INTEGER NOT NULL,
+    manufacturer INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS product_ids (
+    sha256 TEXT NOT NULL,
+    product_id TEXT NOT NULL,
+    max_hw_version INTEGER NOT NULL,
+    PRIMARY KEY (sha256, product_id)
+);
+CREATE INDEX IF NOT EXISTS product_ids_product_id
+    ON product_ids (product_id, max_hw_version);
+"""
+
+
+class Catalog(object):
+    """An on-disk index of APROM images.
+
+    Images are identified by their SHA-256 hash. Copies of the same image
+    are only decrypted and scanned once.
+
+    Attributes:
+        path: Path of the SQLite database.
+        connection: sqlite3 connection to the database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        """Closes the database."""
+
+        self.connection.close()
+
+    def _add_contents(self, sha256, data):
+        """Scans an APROM image and stores the verification information.
+
+        Unencrypted images are recognized by the manufacturer string.
+
+        Args:
+            sha256: Hexadecimal SHA-256 hash of the file.
+            data: Contents of the file.
+        """
+
+        encrypted = False
+        aprom = APROM(data)
+        if not aprom.scan().manufacturer:
+            encrypted = True
+            aprom = APROM(aprom.convert())
+        info = aprom.scan()
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO contents VALUES (?, ?, ?)",
+            (sha256, encrypted, info.manufacturer))
+        if info.manufacturer:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO product_ids VALUES (?, ?, ?)",
+                [(sha256, product_id, max_hw_version)
+                 for product_id, (_, max_hw_version)
+                 in info.product_ids.items()])
+
+    def update(self, directory):
+        """Updates the index from the files in a directory tree.
+
+        Files whose modification time and size haven't changed are
+        skipped, and files whose hash is already known aren't scanned
+        again. Index entries of deleted files are removed.
+
+        Args:
+            directory: Path of the directory.
+
+        Returns:
+            A CatalogUpdate tuple containing the number of files scanned,
+            files that were unchanged and entries that were removed.
+        """
+
+        directory = os.path.abspath(directory)
+        known = dict((path, (mtime, size)) for path, mtime, size in
+                     self.connection.execute(
+                         "SELECT path, mtime, size FROM images"))
+        seen = set()
+        scanned = 0
+        unchanged = 0
+
+        with self.connection:
+            for root, _, names in os.walk(directory):
+                for name in sorted(names):
+                    path = os.path.join(root, name)
+                    if path == os.path.abspath(self.path):
+                        continue
+                    stat = os.stat(path)
+                    seen.add(path)
+
+                    if known.get(path) == (stat.st_mtime, stat.st_size):
+                        unchanged += 1
+                        continue
+
+                    with open(path, 'rb') as imagefile:
+                        data = imagefile.read()
+                    sha256 = hashlib.sha256(data).hexdigest()
+                    if not self.connection.execute(
+                            "SELECT 1 FROM contents WHERE sha256 = ?",
+                            (sha256,)).fetchone():
+                        self._add_contents(sha256, data)
+                        scanned += 1
+                    else:
+                        unchanged += 1
+
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+                        (path, stat.st_mtime, stat.st_size, sha256))
+
+            # Forget the files that are gone
+            removed = [(path,) for path in known if path not in seen and
+                       path.startswith(directory + os.sep)]
+            self.connection.executemany(
+                "DELETE FROM images WHERE path = ?", removed)
+            self.connection.execute(
+                "DELETE FROM contents WHERE sha256 NOT IN "
+                "(SELECT sha256 FROM images)")
+            self.connection.execute(
+                "DELETE FROM product_ids WHERE sha256 NOT IN "
+                "(SELECT sha256 FROM contents)")
+
+        return CatalogUpdate(scanned, unchanged, len(removed))
+
+    def compatible(self, product_ids, hw_version):
+        """Finds the images that can be flashed to a device.
+
+        Uses the same rules as APROM.verify.
+
+        Args:
+            product_ids: A list of supported product IDs for the device.
+            hw_version: An integer device hardware version.
+
+        Returns:
+            A sorted list of image paths.
+        """
+
+        if not product_ids:
+            return []
+
+        rows = self.connection.execute(
+            "SELECT images.path, product_ids.product_id, "
+            "product_ids.max_hw_version FROM images "
+            "JOIN product_ids ON images.sha256 = product_ids.sha256 "
+            "WHERE product_ids.product_id IN ({})".format(
+                ", ".join("?" * len(product_ids))),
+            list(product_ids))
+
+        # The first supported product ID found in the image decides
+        priority = dict((product_id, i)
+                        for i, product_id in reversed(list(
+                            enumerate(product_ids))))
+        best = {}
+        for path, product_id, max_hw_version in rows:
+            if path not in best or \
+                    priority[product_id] < priority[best[path][0]]:
+                best[path] = (product_id, max_hw_version)
+
+        return sorted(path for path, (_, max_hw_version) in best.items()
+                      if max_hw_version >= hw_version)
+
+    def __len__(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM images").fetchone()[0]
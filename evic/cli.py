@@ -20,10 +20,14 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
 import os
-import copy
+import zlib
 import struct
-from time import sleep
+import sqlite3
+from time import sleep, time
+from datetime import datetime
 from contextlib import contextmanager
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 import click
 
@@ -44,11 +48,171 @@ def handle_exceptions(*exceptions):
         sys.exit(1)
 
 
+def app_path(name):
+    """Returns the path of a file in the application directory.
+
+    The application directory is created if it doesn't exist.
+
+    Args:
+        name: Name of the file or directory.
+    """
+
+    appdir = click.get_app_dir('evic')
+    if not os.path.isdir(appdir):
+        os.makedirs(appdir)
+
+    return os.path.join(appdir, name)
+
+
 @click.group()
-def usb():
+@click.option('--simulate', is_flag=True,
+              help='Use simulated devices instead of USB devices.')
+@click.option('--sim-devices', type=click.IntRange(1, None), default=1,
+              help='Number of simulated devices.')
+@click.option('--sim-latency', type=float, default=0.001,
+              help='Seconds per simulated HID report.')
+@click.option('--sim-reset-delay', type=float, default=0.5,
+              help='Seconds a simulated device takes to restart.')
+@click.option('--sim-fault-rate', type=click.FloatRange(0, 1), default=0.0,
+              help='Probability of losing a simulated HID report.')
+@click.option('--stats', is_flag=True,
+              help='Print a timing breakdown of the USB transfers.')
+@click.option('--record', type=click.Path(dir_okay=False, writable=True),
+              help='Record the HID traffic to a trace file.')
+@click.option('--replay', type=click.Path(exists=True, dir_okay=False),
+              help='Replay a trace file instead of using USB devices.')
+@click.option('--retries', type=click.IntRange(0, None), default=0,
+              help='Retry lost HID reports and resume interrupted flash '
+                   'writes. Experimental, assumes the device drops an '
+                   'interrupted transfer when it is opened again.')
+@click.option('--backup/--no-backup', default=True,
+              help='Back up the data flash read from the devices. '
+                   'Defaults to enabled.')
+@click.pass_context
+def usb(ctx, simulate, sim_devices, sim_latency, sim_reset_delay,
+        sim_fault_rate, stats, record, replay, retries, backup):
     """A USB programmer for devices based on the Joyetech Evic VTC Mini."""
 
-    pass
+    ctx.ensure_object(dict)
+    ctx.obj['retries'] = retries
+    ctx.obj['backup'] = backup
+    if stats:
+        ctx.obj['stats'] = evic.TransferStats()
+        ctx.call_on_close(
+            lambda start=time(): print_stats(ctx.obj['stats'], start))
+    if simulate:
+        units = [evic.simulator.SimulatedUnit('SIM{0:07d}'.format(i))
+                 for i in range(0, sim_devices)]
+        ctx.obj['backend'] = evic.simulator.SimulatedHID(
+            units, sim_latency, sim_reset_delay, sim_fault_rate)
+    if replay:
+        with open(replay, 'rb') as tracefile:
+            ctx.obj['backend'] = evic.trace.ReplayHID(tracefile)
+    if record:
+        backend = ctx.obj.get('backend')
+        if backend is None:
+            if not evic.device.HIDAPI_AVAILABLE:
+                raise click.UsageError("Recording requires hidapi.")
+            backend = evic.device.hid
+        tracefile = open(record, 'wb')
+        ctx.call_on_close(tracefile.close)
+        ctx.obj['backend'] = evic.trace.RecordingHID(backend, tracefile)
+
+
+def get_backend():
+    """Returns the HID backend selected for the usb commands.
+
+    Returns:
+        A backend for evic.HIDTransfer or None for the hid module.
+    """
+
+    return (click.get_current_context().find_root().obj or {}).get('backend')
+
+
+def get_stats():
+    """Returns the evic.TransferStats enabled with --stats or None."""
+
+    return (click.get_current_context().find_root().obj or {}).get('stats')
+
+
+def get_retries():
+    """Returns the number of write retries enabled with --retries."""
+
+    return (click.get_current_context().find_root().obj or {}).get(
+        'retries', 0)
+
+
+def backups_enabled():
+    """Returns False if the data flash backups are disabled."""
+
+    return (click.get_current_context().find_root().obj or {}).get(
+        'backup', True)
+
+
+def new_device(serial=None):
+    """Creates the device for the usb commands.
+
+    Args:
+        serial: Serial number of the device or None for the first device.
+
+    Returns:
+        An evic.HIDTransfer object.
+    """
+
+    dev = evic.HIDTransfer(serial=serial, backend=get_backend())
+    dev.write_attempts = dev.flash_attempts = get_retries() + 1
+    stats = get_stats()
+    if stats is not None:
+        dev.listeners.append(stats)
+
+    return dev
+
+
+# Phases printed by --stats
+STATS_PHASES = [('read_dataflash', "Data flash read"),
+                ('write_dataflash', "Data flash write"),
+                ('reset', "Reset command"),
+                ('reconnect', "Reset and reconnect"),
+                ('write_flash', "Flash write"),
+                ('command', "Commands"),
+                ('report_write', "Reports written"),
+                ('report_read', "Reports read")]
+
+
+def print_stats(stats, start):
+    """Prints the transfer statistics.
+
+    Args:
+        stats: evic.TransferStats object.
+        start: Time the command started.
+    """
+
+    if not len(stats):
+        return
+
+    elapsed = time() - start
+    totals = dict((total.event, total) for total in stats.totals())
+    click.echo("\nTransfer statistics:")
+    for event, label in STATS_PHASES:
+        total = totals.get(event)
+        if total is None:
+            continue
+        click.echo("\t{:<20}{:>6} x {:>8.3f} s".format(
+            label + ':', total.count, total.seconds), nl=False)
+        if total.nbytes:
+            click.echo("{:>10.1f} KB {:>8.1f} KB/s".format(
+                total.nbytes / 1024.0,
+                total.nbytes / 1024.0 / max(total.seconds, 1e-6)), nl=False)
+        if total.retries:
+            click.echo(" ({} retries)".format(total.retries), nl=False)
+        click.echo("")
+
+    # Everything that went over USB, commands included
+    payload = sum(totals[event].nbytes for event in
+                  ['report_write', 'report_read'] if event in totals)
+    click.echo("\t{:<20}{:>6}   {:>8.3f} s{:>10.1f} KB {:>8.1f} KB/s".format(
+        "Total:", '', elapsed, payload / 1024.0,
+        payload / 1024.0 / max(elapsed, 1e-6)))
 
 
 def connect(dev):
@@ -69,6 +233,34 @@ def connect(dev):
             raise IOError("Device not found.")
 
 
+def reconnect(dev):
+    """Connects the USB device again after a reset.
+
+    Args:
+        dev: evic.HIDTransfer object.
+    """
+
+    with handle_exceptions(IOError):
+        click.echo("Waiting for the device...", nl=False)
+        dev.reconnect()
+        click.echo("{0:.2f} s ".format(dev.reset_latency), nl=False)
+
+
+def boot_aprom(dev):
+    """Restarts the device to the APROM image just written.
+
+    Args:
+        dev: evic.HIDTransfer object booted to LDROM.
+
+    Returns:
+        The evic.DataFlash object read from the running image.
+    """
+
+    dev.reset()
+    dev.reconnect(ldrom=False)
+    return dev.read_dataflash()[0]
+
+
 def print_usb_info(dev):
     """Prints the USB information attributes of the device
 
@@ -105,6 +297,10 @@ def read_dataflash(dev, verify):
     if verify:
         verify_dataflash(dataflash, checksum)
 
+    # Keep a copy of what was on the device
+    if dev.serial and backups_enabled():
+        backup_dataflash(dev.serial, dataflash)
+
     return dataflash
 
 
@@ -142,6 +338,459 @@ def verify_dataflash(dataflash, checksum):
         dataflash.verify(checksum)
 
 
+def open_journal():
+    """Returns the flash journal in the application directory."""
+
+    return evic.journal.FlashJournal(app_path('journal'))
+
+
+def open_backups():
+    """Returns the data flash backup store in the application directory."""
+
+    return evic.backup.BackupStore(app_path('backups.sqlite'))
+
+
+def backup_dataflash(serial, dataflash):
+    """Stores a snapshot of the data flash of a device.
+
+    A failed backup is reported without stopping the command.
+
+    Args:
+        serial: Serial number of the device.
+        dataflash: evic.DataFlash object.
+    """
+
+    try:
+        backups = open_backups()
+        try:
+            backups.capture(serial, dataflash)
+        finally:
+            backups.close()
+    except (sqlite3.Error, OSError, zlib.error) as error:
+        click.echo("Data flash backup failed: {}".format(error), err=True)
+
+
+def get_device_info(dataflash):
+    """Returns the DeviceInfo tuple for the device.
+
+    Args:
+        dataflash: evic.DataFlash object.
+    """
+
+    return evic.HIDTransfer.devices.get(
+        dataflash.product_id, DeviceInfo("Unknown device", None, None))
+
+
+def supported_product_ids(device_info, dataflash):
+    """Returns the product IDs of the APROM images the device supports.
+
+    Args:
+        device_info: device.DeviceInfo tuple.
+        dataflash: evic.DataFlash object.
+    """
+
+    product_ids = [dataflash.product_id]
+    if device_info.supported_product_ids:
+        product_ids.extend(device_info.supported_product_ids)
+
+    return product_ids
+
+
+def load_aprom(inputfile, encrypted, cache):
+    """Reads an APROM image from a file.
+
+    Args:
+        inputfile: APROM file object.
+        encrypted: A Boolean set to True if the image is encrypted.
+        cache: A Boolean set to True to use the image cache.
+
+    Returns:
+        An unencrypted evic.APROM object.
+    """
+
+    data = inputfile.read()
+    if cache:
+        try:
+            images = evic.imagecache.ImageCache(app_path('images'))
+            return images.load(data, encrypted)
+        except EnvironmentError as error:
+            # Convert the image without the cache
+            click.echo("Image cache failed: {}".format(error), err=True)
+
+    aprom = evic.APROM(data)
+    if encrypted:
+        aprom = evic.APROM(aprom.convert())
+
+    return aprom
+
+
+def load_dataflash(buf):
+    """Creates a DataFlash object from the contents of a data flash file.
+
+    Args:
+        buf: Contents of the data flash file.
+
+    Returns:
+        A tuple containing the data flash and its checksum.
+    """
+
+    buf = bytearray(buf)
+    # We used to store the checksum inside the file
+    if len(buf) == 2048:
+        checksum = struct.unpack("=I", bytes(buf[0:4]))[0]
+        return (evic.DataFlash(buf[4:], 0), checksum)
+
+    return (evic.DataFlash(buf, 0), sum(buf))
+
+
+def dataflash_changed(dataflash, dataflash_original):
+    """Checks if the data flash has to be written to the device.
+
+    Args:
+        dataflash: evic.DataFlash object to write.
+        dataflash_original: evic.DataFlash object read from the device.
+    """
+
+    # Field writes are tracked, a data flash file has to be compared
+    if dataflash is dataflash_original:
+        return dataflash.changed
+
+    return dataflash.array != dataflash_original.array
+
+
+def needs_presa_hw_version(aprom, dataflash):
+    """Checks if the hardware version needs to be changed for Presa firmware.
+
+    Flashing Presa firmware requires HW version <=1.03 on type A devices.
+
+    Args:
+        aprom: evic.APROM object.
+        dataflash: evic.DataFlash object.
+    """
+
+    return 'W007' in aprom.scan().product_ids and \
+        dataflash.product_id == 'E052' and \
+        dataflash.hw_version in [106, 108, 109, 111]
+
+
+def logo_from_image(inputfile, invert, device_info):
+    """Converts a logo for the device without printing anything.
+
+    Args:
+        inputfile: Image file object.
+        invert: True to invert the colors used in the image.
+        device_info: evic.DeviceInfo of the device.
+
+    Returns:
+        An evic.Logo object.
+
+    Raises:
+        evic.LogoConversionError: The device doesn't support the logo.
+    """
+
+    # Check supported logo dimensions
+    logo_dimensions = device_info.logo_dimensions
+    if not logo_dimensions:
+        raise evic.LogoConversionError("Device doesn't support logos.")
+
+    # Perform the actual conversion
+    logo = evic.logo.fromimage(inputfile, invert)
+    if (logo.width, logo.height) != logo_dimensions:
+        raise evic.LogoConversionError("Device only supports {}x{} logos."
+                                       .format(*logo_dimensions))
+
+    return logo
+
+
+def convert_logo(inputfile, invert, device_info):
+    """Converts a logo for the device.
+
+    Args:
+        inputfile: Image file object.
+        invert: True to invert the colors used in the image.
+        device_info: evic.DeviceInfo of the device.
+
+    Returns:
+        An evic.Logo object.
+    """
+
+    with handle_exceptions(evic.LogoConversionError):
+        click.echo("Converting logo...", nl=False)
+        logo = logo_from_image(inputfile, invert, device_info)
+
+    return logo
+
+
+def flash_logo(dev, dataflash, logo, journal):
+    """Uploads a logo to a connected device without printing anything.
+
+    Args:
+        dev: A connected evic.HIDTransfer object.
+        dataflash: evic.DataFlash object read from the device.
+        logo: An evic.Logo object.
+        journal: evic.FlashJournal object or None.
+
+    Raises:
+        IOError: The transfer failed.
+    """
+
+    # The logo is written from LDROM
+    if not dev.ldrom:
+        dataflash.bootflag = 1
+        sleep(0.1)
+        dev.write_dataflash(dataflash)
+        dev.reset()
+        dev.reconnect()
+
+    dev.write_logo(logo)
+    if journal:
+        journal.overwritten(dev.serial, 102400)
+
+
+@contextmanager
+def silent_step(message):
+    """Context for a step of flash_aprom that prints nothing."""
+
+    yield lambda note: None
+
+
+@contextmanager
+def printed_step(message):
+    """Context for a step of flash_aprom that prints its progress.
+
+    Yields a function printing a note after the message.
+    """
+
+    with handle_exceptions(IOError, evic.APROMError, evic.DataFlashError):
+        click.echo(message, nl=False)
+        yield lambda note: click.echo(note, nl=False)
+
+
+def flash_aprom(dev, dataflash, aprom, dataflashbuf, noverify, journal,
+                delta=False, ifchanged=False, step=silent_step):
+    """Uploads an APROM image to a connected device.
+
+    With delta or ifchanged, the device is restarted to the written image
+    and the image is journaled for the next upload. Otherwise the journal
+    entry is only removed and the device isn't restarted again.
+
+    Args:
+        dev: A connected evic.HIDTransfer object.
+        dataflash: Verified evic.DataFlash object read from the device.
+        aprom: An unencrypted evic.APROM object.
+        dataflashbuf: Contents of a data flash file or None.
+        noverify: A list of verifications to skip.
+        journal: evic.FlashJournal object or None.
+        delta: A Boolean set to True to only write the changed pages.
+        ifchanged: A Boolean set to True to skip the APROM write on devices
+                   already running the image.
+        step: Context used for each step, silent_step or printed_step.
+
+    Returns:
+        True if the device was already running the image and only the data
+        flash was written.
+
+    Raises:
+        IOError: The transfer failed.
+        evic.APROMError: The image failed verification.
+        evic.DataFlashError: The data flash failed verification.
+    """
+
+    serial = dev.serial
+    dataflash_original = dataflash
+
+    # Is the device already running the image?
+    uptodate = bool(ifchanged and journal and journal.has_image(
+        serial, dataflash, dev.ldrom, aprom.data))
+
+    # Find the image on the device for a delta upload
+    base = None
+    if delta and journal and not uptodate:
+        base = journal.current(serial, dataflash, dev.ldrom)
+
+    # Verify the APROM image
+    if 'aprom' not in noverify and not uptodate:
+        with step("Verifying APROM..."):
+            aprom.verify(supported_product_ids(get_device_info(dataflash),
+                                               dataflash),
+                         dataflash.hw_version)
+
+    # Are we using a data flash file?
+    if dataflashbuf:
+        dataflash, checksum = load_dataflash(dataflashbuf)
+        if 'dataflash' not in noverify:
+            with step("Verifying data flash..."):
+                dataflash.verify(checksum)
+
+    # We want to boot to LDROM on restart
+    if not dev.ldrom and not uptodate:
+        dataflash.bootflag = 1
+
+    # Flashing Presa firmware requires HW version <=1.03 on type A devices
+    if needs_presa_hw_version(aprom, dataflash):
+        with step("Changing HW version to 1.03..."):
+            dataflash.hw_version = 103
+
+    # Write data flash to the device
+    if dataflash_changed(dataflash, dataflash_original):
+        with step("Writing data flash..."):
+            sleep(0.1)
+            dev.write_dataflash(dataflash)
+
+    # Only the data flash was needed
+    if uptodate:
+        return True
+
+    # We should only restart if we're not in LDROM
+    if not dev.ldrom:
+        with step("Restarting the device..."):
+            dev.reset()
+        with step("Waiting for the device...") as note:
+            dev.reconnect()
+            note("{0:.2f} s ".format(dev.reset_latency))
+
+    # Write APROM to the device
+    if journal:
+        journal.invalidate(serial)
+    with step("Writing APROM..." if base is None
+              else "Writing APROM changes...") as note:
+        written = dev.write_aprom(aprom, base)
+        if base is not None:
+            note("{0:.1f} KB ".format(written / 1024.0))
+
+    # Journal the image once the device runs it
+    if journal and (delta or ifchanged):
+        with step("Restarting to the new image...") as note:
+            try:
+                journal.put(serial, aprom.data, boot_aprom(dev))
+            except IOError:
+                # The image is written, only the journal entry is missing
+                note("not journaled, the device didn't restart ")
+
+    return False
+
+
+def upload_device(serial, aprom, dataflashbuf, noverify, journal,
+                  delta=False, ifchanged=False, backend=None, stats=None,
+                  backup=False, retries=0):
+    """Uploads an APROM image to a device without printing anything.
+
+    Args:
+        serial: Serial number of the device.
+        aprom: An unencrypted evic.APROM object.
+        dataflashbuf: Contents of a data flash file or None.
+        noverify: A list of verifications to skip.
+        journal: evic.FlashJournal object.
+        delta: A Boolean set to True to only write the changed pages.
+        ifchanged: A Boolean set to True to skip the APROM write on devices
+                   already running the image.
+        backend: Backend for evic.HIDTransfer.
+        stats: evic.TransferStats object or None.
+        backup: A Boolean set to True to back up the data flash.
+        retries: Number of times a lost report or flash write is retried.
+
+    Returns:
+        A tuple containing the serial number, the time spent in seconds,
+        the error that stopped the upload or None and a Boolean set to True
+        if the APROM write was skipped.
+    """
+
+    start = time()
+    dev = evic.HIDTransfer(serial=serial, backend=backend)
+    dev.write_attempts = dev.flash_attempts = retries + 1
+    if stats is not None:
+        dev.listeners.append(stats)
+    try:
+        dev.connect()
+        dataflash, checksum = dev.read_dataflash()
+        if 'dataflash' not in noverify:
+            dataflash.verify(checksum)
+        if backup:
+            backup_dataflash(serial, dataflash)
+        skipped = flash_aprom(dev, dataflash, aprom, dataflashbuf, noverify,
+                              journal, delta, ifchanged)
+        dev.close()
+    except Exception as error:
+        # Any failure only stops this device
+        return (serial, time() - start, error, False)
+
+    return (serial, time() - start, None, skipped)
+
+
+def upload_all(serials, aprom, dataflashfile, noverify, delta, ifchanged):
+    """Uploads an APROM image to several devices concurrently.
+
+    Args:
+        serials: A list of device serial numbers.
+        aprom: An unencrypted evic.APROM object.
+        dataflashfile: Data flash file object or None.
+        noverify: A list of verifications to skip.
+        delta: A Boolean set to True to only write the changed pages.
+        ifchanged: A Boolean set to True to skip the APROM write on devices
+                   already running the image.
+    """
+
+    # Devices are told apart and journaled by their serial numbers
+    if not all(serials) or len(set(serials)) != len(serials):
+        click.secho("Devices need unique serial numbers to be uploaded to "
+                    "concurrently.", fg='red', bold=True)
+        sys.exit(1)
+
+    dataflashbuf = dataflashfile.read() if dataflashfile else None
+    journal = open_journal()
+    backend = get_backend()
+    stats = get_stats()
+    backup = backups_enabled()
+    retries = get_retries()
+
+    # Scan the image before it's shared by the threads
+    aprom.scan()
+
+    click.echo("\nUploading APROM to {} devices...".format(len(serials)))
+    start = time()
+    pool = ThreadPool(len(serials))
+    try:
+        results = pool.imap_unordered(
+            lambda serial: upload_device(serial, aprom, dataflashbuf,
+                                         noverify, journal, delta, ifchanged,
+                                         backend, stats, backup, retries),
+            serials)
+        failed = 0
+        slowest = 0
+        for serial, seconds, error, skipped in results:
+            slowest = max(slowest, seconds)
+            click.echo("\t{}: ".format(serial), nl=False)
+            if skipped:
+                click.secho("SKIP", fg='yellow', bold=True, nl=False)
+                click.echo(" already up to date ({:.1f} s)".format(seconds))
+            elif error:
+                failed += 1
+                click.secho("FAIL", fg='red', bold=True, nl=False)
+                click.echo(" {} ({:.1f} s)".format(error, seconds))
+            else:
+                click.secho("OK", fg='green', bold=True, nl=False)
+                click.echo(" ({:.1f} s)".format(seconds))
+    finally:
+        pool.close()
+        pool.join()
+
+    click.echo("{} of {} devices in {:.1f} s, slowest device {:.1f} s".format(
+        len(serials) - failed, len(serials), time() - start, slowest))
+    if failed:
+        sys.exit(1)
+
+
+@usb.command('list')
+def listdevices():
+    """List the attached devices."""
+
+    for device in evic.HIDTransfer.enumerate(get_backend()):
+        click.echo("{}\t{}\t{}".format(
+            device.serial, device.product,
+            device.path.decode() if isinstance(device.path, bytes)
+            else device.path))
+
+
 @usb.command()
 @click.argument('inputfile', type=click.File('rb'))
 @click.option('--encrypted/--unencrypted', '-e/-u', default=True,
@@ -151,10 +800,35 @@ def verify_dataflash(dataflash, checksum):
 @click.option('--no-verify', 'noverify',
               type=click.Choice(['aprom', 'dataflash']), multiple=True,
               help='Disable verification for APROM or data flash.')
-def upload(inputfile, encrypted, dataflashfile, noverify):
+@click.option('--cache/--no-cache', default=True,
+              help='Cache converted and verified APROM images.')
+@click.option('--serial', '-s', 'serials', multiple=True,
+              help='Serial number of the device to use. Can be repeated.')
+@click.option('--all', '-a', 'alldevices', is_flag=True,
+              help='Upload to all attached devices concurrently.')
+@click.option('--delta', is_flag=True,
+              help='Only write the flash pages that changed since the last '
+                   '--delta or --if-changed upload to the device.')
+@click.option('--if-changed', 'ifchanged', is_flag=True,
+              help='Skip the APROM write on devices already running the '
+                   'image.')
+def upload(inputfile, encrypted, dataflashfile, noverify, cache, serials,
+           alldevices, delta, ifchanged):
     """Upload an APROM image to the device."""
 
-    dev = evic.HIDTransfer()
+    if alldevices:
+        serials = [device.serial for device in
+                   evic.HIDTransfer.enumerate(get_backend())]
+        if not serials:
+            click.secho("No devices found.", fg='red', bold=True)
+            sys.exit(1)
+
+    if len(serials) > 1 or alldevices:
+        aprom = load_aprom(inputfile, encrypted, cache)
+        upload_all(serials, aprom, dataflashfile, noverify, delta, ifchanged)
+        return
+
+    dev = new_device(serials[0] if serials else None)
 
     # Connect the device
     connect(dev)
@@ -163,60 +837,61 @@ def upload(inputfile, encrypted, dataflashfile, noverify):
     print_usb_info(dev)
 
     # Read the data flash
-    verify = 'dataflash' not in noverify
-    dataflash = read_dataflash(dev, verify)
-    dataflash_original = copy.deepcopy(dataflash)
+    dataflash = read_dataflash(dev, 'dataflash' not in noverify)
 
     # Get the device info
-    device_info = dev.devices.get(dataflash.product_id,
-                                  DeviceInfo("Unknown device", None, None))
+    device_info = get_device_info(dataflash)
 
     # Print the device information
     print_device_info(device_info, dataflash)
 
     # Read the APROM image
-    aprom = evic.APROM(inputfile.read())
-    if encrypted:
-        aprom = evic.APROM(aprom.convert())
+    aprom = load_aprom(inputfile, encrypted, cache)
 
-    # Verify the APROM image
-    if 'aprom' not in noverify:
-        with handle_exceptions(evic.APROMError):
-            click.echo("Verifying APROM...", nl=False)
+    journal = open_journal() if dev.serial else None
+    if flash_aprom(dev, dataflash, aprom,
+                   dataflashfile.read() if dataflashfile else None,
+                   noverify, journal, delta, ifchanged, printed_step):
+        click.secho("APROM is already up to date.", fg='green', bold=True)
 
-            supported_product_ids = [dataflash.product_id]
-            if device_info.supported_product_ids:
-                supported_product_ids.extend(device_info.supported_product_ids)
 
-            aprom.verify(supported_product_ids, dataflash.hw_version)
+@usb.command('upload-logo')
+@click.argument('inputfile', type=click.File('rb'))
+@click.option('--invert', '-i', is_flag=True,
+              help='Invert the colors used in the image.')
+@click.option('--no-verify', 'noverify', is_flag=True,
+              help='Disable data flash verification.')
+def uploadlogo(inputfile, invert, noverify):
+    """Upload a logo to the device."""
 
-    # Are we using a data flash file?
-    if dataflashfile:
-        buf = bytearray(dataflashfile.read())
-        # We used to store the checksum inside the file
-        if len(buf) == 2048:
-            checksum = struct.unpack("=I", bytes(buf[0:4]))[0]
-            dataflash = evic.DataFlash(buf[4:], 0)
-        else:
-            checksum = sum(buf)
-            dataflash = evic.DataFlash(buf, 0)
-        if 'dataflash' not in noverify:
-            verify_dataflash(dataflash, checksum)
+    dev = new_device()
+
+    # Connect the device
+    connect(dev)
+
+    # Print the USB info of the device
+    print_usb_info(dev)
+
+    # Read the data flash
+    dataflash = read_dataflash(dev, not noverify)
+    dataflash_original = dataflash
+
+    # Get the device info
+    device_info = get_device_info(dataflash)
+
+    # Print the device information
+    print_device_info(device_info, dataflash)
+
+    # Convert the image
+    logo = convert_logo(inputfile, invert, device_info)
 
     # We want to boot to LDROM on restart
     if not dev.ldrom:
         dataflash.bootflag = 1
 
-    # Flashing Presa firmware requires HW version <=1.03 on type A devices
-    if b'W007' in aprom.data and dataflash.product_id == 'E052' \
-            and dataflash.hw_version in [106, 108, 109, 111]:
-        click.echo("Changing HW version to 1.03...", nl=False)
-        dataflash.hw_version = 103
-        click.secho("OK", fg='green', bold=True)
-
     # Write data flash to the device
     with handle_exceptions(IOError):
-        if dataflash.array != dataflash_original.array:
+        if dataflash_changed(dataflash, dataflash_original):
             click.echo("Writing data flash...", nl=False)
             sleep(0.1)
             dev.write_dataflash(dataflash)
@@ -227,26 +902,46 @@ def upload(inputfile, encrypted, dataflashfile, noverify):
             # Restart
             click.echo("Restarting the device...", nl=False)
             dev.reset()
-            sleep(2)
-            click.secho("OK", fg='green', nl=False, bold=True)
+            click.secho("OK", fg='green', bold=True)
             # Reconnect
-            connect(dev)
+            reconnect(dev)
 
-        # Write APROM to the device
-        click.echo("Writing APROM...", nl=False)
-        dev.write_aprom(aprom)
+        # Write logo to the device
+        click.echo("Writing logo...", nl=False)
+        dev.write_logo(logo)
+        if dev.serial:
+            open_journal().overwritten(dev.serial, 102400)
 
 
-@usb.command('upload-logo')
-@click.argument('inputfile', type=click.File('rb'))
+@usb.command()
+@click.option('--aprom', 'apromfile', '-a', type=click.File('rb'),
+              help='APROM image to upload.')
+@click.option('--encrypted/--unencrypted', '-e/-u', default=True,
+              help='Use encrypted/unencrypted image. Defaults to encrypted.')
+@click.option('--logo', 'logofile', '-l', type=click.File('rb'),
+              help='Logo to upload.')
 @click.option('--invert', '-i', is_flag=True,
-              help='Invert the colors used in the image.')
-@click.option('--no-verify', 'noverify', is_flag=True,
-              help='Disable data flash verification.')
-def uploadlogo(inputfile, invert, noverify):
-    """Upload a logo to the device."""
+              help='Invert the colors used in the logo.')
+@click.option('--dataflash', 'dataflashfile', '-d', type=click.File('rb'),
+              help='Data flash to upload.')
+@click.option('--no-verify', 'noverify',
+              type=click.Choice(['aprom', 'dataflash']), multiple=True,
+              help='Disable verification for APROM or data flash.')
+@click.option('--cache/--no-cache', default=True,
+              help='Cache converted and verified APROM images.')
+@click.option('--serial', '-s', help='Serial number of the device to use.')
+def flash(apromfile, encrypted, logofile, invert, dataflashfile, noverify,
+          cache, serial):
+    """Upload an APROM image, a logo and data flash in one go.
+
+    The device is read and restarted to LDROM only once, whatever is
+    uploaded.
+    """
 
-    dev = evic.HIDTransfer()
+    if not (apromfile or logofile or dataflashfile):
+        raise click.UsageError("Nothing to upload.")
+
+    dev = new_device(serial)
 
     # Connect the device
     connect(dev)
@@ -255,56 +950,76 @@ def uploadlogo(inputfile, invert, noverify):
     print_usb_info(dev)
 
     # Read the data flash
-    dataflash = read_dataflash(dev, noverify)
-    dataflash_original = copy.deepcopy(dataflash)
+    dataflash = read_dataflash(dev, 'dataflash' not in noverify)
+    dataflash_original = dataflash
 
     # Get the device info
-    device_info = dev.devices.get(dataflash.product_id,
-                                  DeviceInfo("Unknown device", None, None))
+    device_info = get_device_info(dataflash)
 
     # Print the device information
     print_device_info(device_info, dataflash)
 
-    # Convert the image
-    with handle_exceptions(evic.LogoConversionError):
-        click.echo("Converting logo...", nl=False)
+    # Prepare everything before touching the device
+    aprom = None
+    if apromfile:
+        aprom = load_aprom(apromfile, encrypted, cache)
+        if 'aprom' not in noverify:
+            with handle_exceptions(evic.APROMError):
+                click.echo("Verifying APROM...", nl=False)
+                aprom.verify(supported_product_ids(device_info, dataflash),
+                             dataflash.hw_version)
 
-        # Check supported logo dimensions
-        logo_dimensions = device_info.logo_dimensions
-        if not logo_dimensions:
-            raise evic.LogoConversionError("Device doesn't support logos.")
+    logo = None
+    if logofile:
+        logo = convert_logo(logofile, invert, device_info)
 
-        # Perform the actual conversion
-        logo = evic.logo.fromimage(inputfile, invert)
-        if (logo.width, logo.height) != logo_dimensions:
-            raise evic.LogoConversionError("Device only supports {}x{} logos."
-                                           .format(*logo_dimensions))
+    if dataflashfile:
+        dataflash, checksum = load_dataflash(dataflashfile.read())
+        if 'dataflash' not in noverify:
+            verify_dataflash(dataflash, checksum)
 
-    # We want to boot to LDROM on restart
-    if not dev.ldrom:
+    # Flash writes need LDROM, the data flash is written from either
+    restart = (aprom or logo) and not dev.ldrom
+    if restart:
         dataflash.bootflag = 1
 
+    # Flashing Presa firmware requires HW version <=1.03 on type A devices
+    if aprom and needs_presa_hw_version(aprom, dataflash):
+        click.echo("Changing HW version to 1.03...", nl=False)
+        dataflash.hw_version = 103
+        click.secho("OK", fg='green', bold=True)
+
+    journal = open_journal() if dev.serial else None
+
     # Write data flash to the device
-    with handle_exceptions(IOError):
-        if dataflash.array != dataflash_original.array:
+    if dataflash_changed(dataflash, dataflash_original):
+        with handle_exceptions(IOError):
             click.echo("Writing data flash...", nl=False)
             sleep(0.1)
             dev.write_dataflash(dataflash)
-            click.secho("OK", fg='green', bold=True)
 
-        # We should only restart if we're not in LDROM
-        if not dev.ldrom:
-            # Restart
+    # Restart to LDROM
+    if restart:
+        with handle_exceptions(IOError):
             click.echo("Restarting the device...", nl=False)
             dev.reset()
-            sleep(2)
-            click.secho("OK", fg='green', nl=False, bold=True)
-            # Reconnect
-            connect(dev)
+        reconnect(dev)
 
-        # Write logo to the device
-        click.echo("Writing logo...", nl=False)
-        dev.write_logo(logo)
+    # Write APROM to the device
+    if aprom:
+        with handle_exceptions(IOError):
+            if journal:
+                journal.invalidate(dev.serial)
+            click.echo("Writing APROM...", nl=False)
+            dev.write_aprom(aprom)
+
+    # Write logo to the device
+    if logo:
+        with handle_exceptions(IOError):
+            click.echo("Writing logo...", nl=False)
+            dev.write_logo(logo)
+            if journal:
+                journal.overwritten(dev.serial, 102400)
 
 
 @usb.command('dump-dataflash')
@@ -314,7 +1029,7 @@ def uploadlogo(inputfile, invert, noverify):
 def dumpdataflash(output, noverify):
     """Write device data flash to a file."""
 
-    dev = evic.HIDTransfer()
+    dev = new_device()
 
     # Connect the device
     connect(dev)
@@ -323,11 +1038,10 @@ def dumpdataflash(output, noverify):
     print_usb_info(dev)
 
     # Read the data flash
-    dataflash = read_dataflash(dev, noverify)
+    dataflash = read_dataflash(dev, not noverify)
 
     # Get the device info
-    device_info = dev.devices.get(dataflash.product_id,
-                                  DeviceInfo("Unknown device", None, None))
+    device_info = get_device_info(dataflash)
 
     # Print the device information
     print_device_info(device_info, dataflash)
@@ -342,7 +1056,7 @@ def dumpdataflash(output, noverify):
 def resetdataflash():
     """Reset device data flash."""
 
-    dev = evic.HIDTransfer()
+    dev = new_device()
 
     # Connect the device
     connect(dev)
@@ -356,6 +1070,192 @@ def resetdataflash():
         dev.reset_dataflash()
 
 
+@usb.command('patch-dataflash')
+@click.argument('patchfile', type=click.File('r'))
+@click.option('--serial', '-s', 'serials', multiple=True,
+              help='Serial number of the device to patch. Can be repeated.')
+@click.option('--all', '-a', 'alldevices', is_flag=True,
+              help='Patch all attached devices.')
+@click.option('--no-verify', 'noverify', is_flag=True,
+              help='Disable data flash verification.')
+def patchdataflash(patchfile, serials, alldevices, noverify):
+    """Apply a data flash patch to devices.
+
+    The data flash is only written if the patch changes it. A failure on
+    one device doesn't stop the others.
+    """
+
+    with handle_exceptions(evic.PatchError):
+        click.echo("Reading patch...", nl=False)
+        patch = evic.DataFlashPatch.loads(patchfile.read())
+
+    if alldevices:
+        serials = [device.serial for device in
+                   evic.HIDTransfer.enumerate(get_backend())]
+        if not serials:
+            click.secho("No devices found.", fg='red', bold=True)
+            sys.exit(1)
+
+    serials = serials or [None]
+    failed = [serial for serial in serials
+              if patch_device(serial, patch, noverify) is not None]
+
+    if failed:
+        click.secho("\nPatching failed on {} of {} devices.".format(
+            len(failed), len(serials)), fg='red', bold=True)
+        sys.exit(1)
+
+
+@contextmanager
+def reported_step(message):
+    """Context for a step that prints its outcome and passes errors on."""
+
+    click.echo(message, nl=False)
+    try:
+        yield
+    except Exception as error:
+        click.secho("FAIL", fg='red', bold=True)
+        click.echo(str(error), err=True)
+        raise
+    click.secho("OK", fg='green', bold=True)
+
+
+def patch_device(serial, patch, noverify):
+    """Applies a data flash patch to a device.
+
+    Args:
+        serial: Serial number of the device or None for the first device.
+        patch: evic.DataFlashPatch object.
+        noverify: A Boolean set to True to skip data flash verification.
+
+    Returns:
+        The error that stopped the patching or None. The error is printed.
+    """
+
+    dev = new_device(serial)
+    try:
+        # Connect the device
+        with reported_step("\nFinding device..."):
+            dev.connect()
+            if not dev.manufacturer:
+                raise IOError("Device not found.")
+
+        # Print the USB info of the device
+        print_usb_info(dev)
+
+        # Read the data flash
+        with reported_step("Reading data flash..."):
+            dataflash, checksum = dev.read_dataflash()
+        if not noverify:
+            with reported_step("Verifying data flash..."):
+                dataflash.verify(checksum)
+        if dev.serial and backups_enabled():
+            backup_dataflash(dev.serial, dataflash)
+
+        # Apply the patch
+        with reported_step("Applying patch..."):
+            patch.apply(dataflash)
+
+        # Write data flash to the device
+        if dataflash.changed:
+            with reported_step("Writing data flash..."):
+                sleep(0.1)
+                dev.write_dataflash(dataflash)
+        else:
+            click.secho("Data flash is already up to date.", fg='green',
+                        bold=True)
+    except Exception as error:
+        # Any failure only stops this device
+        return error
+    finally:
+        dev.close()
+
+    return None
+
+
+@usb.command('restore-dataflash')
+@click.argument('snapshot_id', metavar='SNAPSHOT', type=int)
+@click.option('--serial', '-s', help='Serial number of the device to use.')
+@click.option('--no-verify', 'noverify', is_flag=True,
+              help='Disable data flash verification.')
+def restoredataflash(snapshot_id, serial, noverify):
+    """Write a data flash backup to the device.
+
+    SNAPSHOT is an ID listed by "evic backup list". The data flash on the
+    device is backed up before it's replaced.
+    """
+
+    backups = open_backups()
+    try:
+        with handle_exceptions(evic.backup.BackupError, sqlite3.Error):
+            click.echo("Loading backup {}...".format(snapshot_id), nl=False)
+            backup = backups.load(snapshot_id)
+    finally:
+        backups.close()
+
+    dev = new_device(serial)
+
+    # Connect the device
+    connect(dev)
+
+    # Print the USB info of the device
+    print_usb_info(dev)
+
+    # Read the data flash
+    dataflash = read_dataflash(dev, not noverify)
+
+    # Get the device info
+    device_info = get_device_info(dataflash)
+
+    # Print the device information
+    print_device_info(device_info, dataflash)
+
+    # Only restore backups of the same model
+    if backup.product_id != dataflash.product_id:
+        click.secho("Backup is from a device with product ID {}.".format(
+            backup.product_id), fg='red', bold=True)
+        sys.exit(1)
+
+    # Write data flash to the device
+    if dataflash_changed(backup, dataflash):
+        with handle_exceptions(IOError):
+            click.echo("Writing data flash...", nl=False)
+            sleep(0.1)
+            dev.write_dataflash(backup)
+    else:
+        click.secho("Data flash is already up to date.", fg='green',
+                    bold=True)
+
+
+@usb.command()
+@click.option('--socket', 'path', type=click.Path(dir_okay=False),
+              help='Path of the server socket.')
+def serve(path):
+    """Keep devices open and serve requests from evic-client.
+
+    Devices are opened on first use and their data flash is cached until
+    it's changed, so scripted sequences of commands don't pay for the
+    startup, USB setup and data flash reads every time.
+    """
+
+    from .client import default_socket_path
+    from .server import SessionServer
+
+    path = path or default_socket_path()
+    try:
+        server = SessionServer(path, get_backend(), backup=backups_enabled())
+    except IOError as error:
+        click.secho(str(error), fg='red', bold=True)
+        sys.exit(1)
+    click.echo("Listening on {}".format(path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
 @click.group()
 def main():
     """A USB programmer for devices based on the Joyetech Evic VTC Mini."""
@@ -363,15 +1263,455 @@ def main():
     pass
 
 
+def expand_paths(inputs):
+    """Lists the given files and the files in the given directories.
+
+    Args:
+        inputs: A list of file and directory paths.
+    """
+
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if os.path.isfile(os.path.join(path, name))))
+        else:
+            paths.append(path)
+
+    return paths
+
+
+def same_file(path, other):
+    """Checks if two paths refer to the same existing file."""
+
+    if '-' in (path, other):
+        return False
+
+    try:
+        return os.path.samefile(path, other)
+    except OSError:
+        return False
+
+
+def convert_path(inputpath, outputpath):
+    """Decrypts/Encrypts an APROM file and copies its permissions.
+
+    Args:
+        inputpath: Path of the APROM file or "-" for standard input.
+        outputpath: Path of the converted file or "-" for standard output.
+
+    Returns:
+        A tuple containing the input path, the file size and the time
+        spent in seconds.
+    """
+
+    start = time()
+    with click.open_file(inputpath, 'rb') as inputfile:
+        with click.open_file(outputpath, 'wb') as outputfile:
+            size = evic.aprom.convert_file(inputfile, outputfile)
+    if '-' not in (inputpath, outputpath):
+        os.chmod(outputpath, os.stat(inputpath).st_mode)
+
+    return (inputpath, size, time() - start)
+
+
+def _convert_job(paths):
+    """Pool worker for convert_path. Returns the error instead of raising."""
+
+    try:
+        return convert_path(*paths)
+    except EnvironmentError as error:
+        return (paths[0], None, error)
+
+
+def format_throughput(size, seconds):
+    """Formats a size and the time it took to process as a string."""
+
+    return "{0:.1f} KB in {1:.3f} s ({2:.2f} MB/s)".format(
+        size / 1024.0, seconds, size / max(seconds, 1e-6) / 1e6)
+
+
 @main.command()
-@click.argument('inputfile', type=click.File('rb'))
-@click.option('--output', '-o', type=click.File('wb'), required=True)
-def convert(inputfile, output):
-    """Decrypt/encrypt an APROM image."""
+@click.argument('inputs', nargs=-1, required=True,
+                type=click.Path(exists=True, allow_dash=True))
+@click.option('--output', '-o', type=click.Path(allow_dash=True),
+              required=True,
+              help='Output file, or output directory for several inputs.')
+@click.option('--jobs', '-j', type=click.IntRange(1, None),
+              help='Number of parallel conversions. Defaults to CPU count.')
+def convert(inputs, output, jobs):
+    """Decrypt/encrypt APROM images.
+
+    INPUTS can be a single file or several files and directories. Files
+    in the directories are converted into the output directory using the
+    same file names. A single file can be "-" to read standard input, and
+    the output can be "-" to write standard output.
+    """
+
+    if len(inputs) == 1 and not os.path.isdir(inputs[0]) and \
+            not os.path.isdir(output):
+        if same_file(inputs[0], output):
+            raise click.UsageError("The output would overwrite the input.")
+
+        # Keep the messages out of the converted image
+        if output == '-':
+            try:
+                convert_path(inputs[0], output)
+            except IOError as error:
+                click.echo(str(error), err=True)
+                sys.exit(1)
+            return
+
+        with handle_exceptions(IOError):
+            click.echo("Writing APROM image...", nl=False)
+            convert_path(inputs[0], output)
+        return
+
+    # Collect the files to convert
+    inputpaths = expand_paths(inputs)
+    if '-' in inputpaths:
+        raise click.UsageError("Standard input can only be converted alone.")
+
+    names = [os.path.basename(path) for path in inputpaths]
+    if len(set(names)) != len(names):
+        raise click.UsageError("Input file names must be unique.")
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    tasks = [(path, os.path.join(output, name))
+             for path, name in zip(inputpaths, names)]
+    for path, outputpath in tasks:
+        if same_file(path, outputpath):
+            raise click.UsageError("{} would overwrite the input.".format(
+                outputpath))
+
+    # Convert the files in parallel
+    click.echo("Converting {} files...".format(len(tasks)))
+    start = time()
+    pool = Pool(jobs)
+    try:
+        results = list(pool.imap_unordered(_convert_job, tasks))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time() - start
+
+    total = 0
+    failed = 0
+    for path, size, seconds in sorted(results):
+        click.echo("\t{}: ".format(path), nl=False)
+        if size is None:
+            click.secho("FAIL", fg='red', bold=True, nl=False)
+            click.echo(" {}".format(seconds))
+            failed += 1
+        else:
+            click.echo(format_throughput(size, seconds))
+            total += size
+
+    click.echo("{} files, {}".format(len(results) - failed,
+                                     format_throughput(total, elapsed)))
+    if failed:
+        click.secho("{} files failed.".format(failed), fg='red', bold=True)
+        sys.exit(1)
+
+
+@main.command()
+@click.argument('tracefiles', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+def trace(tracefiles):
+    """Summarize HID traffic traces recorded by evic-usb --record.
+
+    Give several traces to compare them side by side.
+    """
+
+    summaries = []
+    for path in tracefiles:
+        with handle_exceptions(IOError):
+            click.echo("Reading {}...".format(path), nl=False)
+            with open(path, 'rb') as tracefile:
+                summaries.append(dict(
+                    (summary.kind, summary) for summary in
+                    evic.trace.summarize(evic.trace.read_trace(tracefile))))
+
+    for kind in evic.trace.KIND_NAMES.values():
+        if not any(kind in summary for summary in summaries):
+            continue
+        click.echo("\t{:<10}".format(kind + ':'), nl=False)
+        for summary in summaries:
+            total = summary.get(kind, evic.trace.TraceSummary(kind, 0, 0, 0))
+            click.echo("{:>8} x {:>8.3f} s {:>8.1f} KB".format(
+                total.count, total.seconds, total.nbytes / 1024.0), nl=False)
+        click.echo("")
+
+
+@main.group()
+def patch():
+    """Create and apply field level data flash patches."""
+
+    pass
+
 
-    binfile = evic.APROM(inputfile.read())
+@patch.command('diff')
+@click.argument('old', type=click.File('rb'))
+@click.argument('new', type=click.File('rb'))
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='Patch file. Defaults to standard output.')
+def patchdiff(old, new, output):
+    """Create a patch changing data flash file OLD into NEW.
 
+    The unique IDs of the microcontroller are left out of the patch.
+    """
+
+    old_dataflash, _ = load_dataflash(old.read())
+    new_dataflash, _ = load_dataflash(new.read())
+    dataflash_patch = evic.DataFlashPatch.diff(old_dataflash, new_dataflash)
+
+    output.write(dataflash_patch.dumps() + '\n')
+    click.echo("{} fields changed.".format(len(dataflash_patch)), err=True)
+
+
+@patch.command('apply')
+@click.argument('patchfile', type=click.File('r'))
+@click.argument('inputs', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', '-o', type=click.Path(file_okay=False),
+              help='Output directory. Defaults to patching the files in '
+                   'place.')
+def patchapply(patchfile, inputs, output):
+    """Apply a patch to data flash files.
+
+    The checksums of files storing one are verified and updated.
+    """
+
+    with handle_exceptions(evic.PatchError):
+        click.echo("Reading patch...", nl=False)
+        dataflash_patch = evic.DataFlashPatch.loads(patchfile.read())
+
+    if output and not os.path.isdir(output):
+        os.makedirs(output)
+
+    failed = 0
+    for path in inputs:
+        click.echo("\t{}: ".format(path), nl=False)
+        outputpath = os.path.join(output, os.path.basename(path)) \
+            if output else None
+        try:
+            changed = evic.patch.apply_to_file(dataflash_patch, path,
+                                               outputpath)
+        except (IOError, evic.PatchError, evic.DataFlashError) as error:
+            click.secho("FAIL", fg='red', bold=True, nl=False)
+            click.echo(" {}".format(error))
+            failed += 1
+            continue
+        if changed:
+            click.secho("OK", fg='green', bold=True)
+        else:
+            click.echo("unchanged")
+
+    if failed:
+        click.secho("{} files failed.".format(failed), fg='red', bold=True)
+        sys.exit(1)
+
+
+@main.group()
+def archive():
+    """Archive data flash dumps and query them."""
+
+    pass
+
+
+@archive.command('add')
+@click.argument('archivefile', type=click.Path(dir_okay=False))
+@click.argument('inputs', nargs=-1, required=True,
+                type=click.Path(exists=True))
+@click.option('--serial', '-s',
+              help='Serial number of the device. Defaults to the file name '
+                   'without the extension.')
+def archiveadd(archivefile, inputs, serial):
+    """Add data flash dumps to an archive.
+
+    INPUTS can be files or directories of dumps. The modification time of
+    a file is used as the time of the dump.
+    """
+
+    dumps = []
     with handle_exceptions(IOError):
-        click.echo("Writing APROM image...", nl=False)
-        output.write(binfile.convert())
-        os.chmod(output.name, os.stat(inputfile.name).st_mode)
+        click.echo("Reading data flash files...", nl=False)
+        for path in expand_paths(inputs):
+            with open(path, 'rb') as dataflashfile:
+                dataflash, _ = load_dataflash(dataflashfile.read())
+            dumps.append((serial or
+                          os.path.splitext(os.path.basename(path))[0],
+                          dataflash, os.path.getmtime(path)))
+
+    with handle_exceptions(IOError, ValueError):
+        click.echo("Adding {} dumps...".format(len(dumps)), nl=False)
+        dumps_archive = evic.archive.DataFlashArchive(archivefile)
+        try:
+            dumps_archive.extend(dumps)
+        finally:
+            dumps_archive.close()
+
+
+@archive.command('query')
+@click.argument('archivefile', type=click.Path(exists=True, dir_okay=False))
+@click.option('--where', '-w', 'conditions', multiple=True,
+              help='Condition such as \'hw_version>106\', quoted for the '
+                   'shell. Can be repeated.')
+@click.option('--latest', is_flag=True,
+              help='Only consider the latest dump of each device.')
+@click.option('--group-by', '-g', 'groupby',
+              type=click.Choice(evic.archive.SCALAR_COLUMNS),
+              help='Count the matching dumps by the value of a field.')
+@click.option('--list', '-l', 'listdumps', is_flag=True,
+              help='List the matching dumps.')
+def archivequery(archivefile, conditions, latest, groupby, listdumps):
+    """Count the dumps in an archive matching the conditions.
+
+    Values are compared as stored in the data flash, e.g. hardware version
+    1.06 is 106.
+    """
+
+    if evic.archive.numpy_module() is None:
+        raise click.ClickException("Queries require NumPy.")
+
+    try:
+        conditions = [evic.archive.parse_condition(condition)
+                      for condition in conditions]
+    except ValueError as error:
+        raise click.UsageError(str(error))
+
+    try:
+        dumps_archive = evic.archive.DataFlashArchive(archivefile)
+    except IOError as error:
+        raise click.ClickException(str(error))
+    try:
+        indices = dumps_archive.select(conditions, latest)
+        if listdumps:
+            table = dumps_archive.table()
+            for index in indices:
+                record = table[index]
+                click.echo("\t{:<16} {} {} FW {:.2f} HW {:.2f}".format(
+                    record['serial'].decode('latin-1'),
+                    datetime.fromtimestamp(record['time']).isoformat(' '),
+                    record['product_id'].decode('latin-1'),
+                    record['fw_version'] / 100.0,
+                    record['hw_version'] / 100.0))
+        if groupby:
+            for value, count in dumps_archive.count_by(groupby, indices):
+                click.echo("\t{}: {}".format(value, count))
+        click.echo("{} of {} dumps match.".format(len(indices),
+                                                   len(dumps_archive)))
+    finally:
+        dumps_archive.close()
+
+
+@main.group()
+def backup():
+    """List and export data flash backups made by evic-usb."""
+
+    pass
+
+
+@backup.command('list')
+@click.option('--serial', '-s', help='Only list backups of this device.')
+@click.option('--limit', '-n', type=click.IntRange(1, None),
+              help='Maximum number of backups to list.')
+def backuplist(serial, limit):
+    """List the data flash backups, newest first."""
+
+    backups = open_backups()
+    try:
+        snapshots = backups.snapshots(serial, limit or -1)
+        stats = backups.stats()
+    finally:
+        backups.close()
+
+    for snapshot in snapshots:
+        click.echo("{:>6} {} {:<16} {} FW {:.2f} {}".format(
+            snapshot.id,
+            datetime.fromtimestamp(snapshot.time).strftime(
+                '%Y-%m-%d %H:%M:%S'),
+            snapshot.serial, snapshot.product_id,
+            snapshot.fw_version / 100.0, snapshot.sha256[0:12]))
+
+    click.echo("{} backups of {} distinct data flashes in {:.1f} KB.".format(
+        stats.snapshots, stats.objects, stats.size / 1024.0))
+
+
+@backup.command('export')
+@click.argument('snapshot_id', metavar='SNAPSHOT', type=int)
+@click.option('--output', '-o', type=click.File('wb'), required=True)
+def backupexport(snapshot_id, output):
+    """Write a data flash backup to a file."""
+
+    backups = open_backups()
+    try:
+        with handle_exceptions(evic.backup.BackupError, sqlite3.Error,
+                               IOError):
+            click.echo("Writing backup {} to the file...".format(snapshot_id),
+                       nl=False)
+            output.write(backups.load(snapshot_id).array)
+    finally:
+        backups.close()
+
+
+def default_catalog_path():
+    """Returns the path of the default catalog database."""
+
+    return app_path('catalog.sqlite')
+
+
+@main.group()
+def catalog():
+    """Index APROM images and find compatible ones."""
+
+    pass
+
+
+@catalog.command('update')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--database', '-D', type=click.Path(dir_okay=False),
+              help='Catalog database file.')
+def catalogupdate(directory, database):
+    """Add the APROM images in a directory to the catalog."""
+
+    images = evic.catalog.Catalog(database or default_catalog_path())
+
+    with handle_exceptions(IOError, sqlite3.Error):
+        click.echo("Updating catalog...", nl=False)
+        try:
+            update = images.update(directory)
+        finally:
+            images.close()
+
+    click.echo("\tScanned: {}, unchanged: {}, removed: {}".format(*update))
+
+
+@catalog.command('query')
+@click.option('--product-id', '-p', required=True,
+              help='Product ID of the device, e.g. E052.')
+@click.option('--hw-version', '-w', type=float, required=True,
+              help='Hardware version of the device, e.g. 1.06.')
+@click.option('--database', '-D', type=click.Path(dir_okay=False),
+              help='Catalog database file.')
+def catalogquery(product_id, hw_version, database):
+    """List the images compatible with a device."""
+
+    device_info = evic.HIDTransfer.devices.get(
+        product_id, DeviceInfo("Unknown device", None, None))
+    product_ids = [product_id]
+    if device_info.supported_product_ids:
+        product_ids.extend(device_info.supported_product_ids)
+
+    images = evic.catalog.Catalog(database or default_catalog_path())
+    try:
+        paths = images.compatible(product_ids,
+                                  int(round(hw_version * 100)))
+    finally:
+        images.close()
+
+    for path in paths:
+        click.echo(path)
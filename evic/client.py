@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import json
+import base64
+import socket
+import argparse
+import tempfile
+
+
+def default_socket_path():
+    """Returns the path of the evic-usb serve socket.
+
+    The socket is kept in the user's XDG_RUNTIME_DIR. The shared temporary
+    directory is only used if it's unset. The EVIC_SOCKET environment
+    variable overrides the default path.
+    """
+
+    path = os.environ.get('EVIC_SOCKET')
+    if path:
+        return path
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'evic.sock')
+
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    return os.path.join(tempfile.gettempdir(), 'evic-{}.sock'.format(uid))
+
+
+def encode(data):
+    """Encodes binary data for a request or a response."""
+
+    return base64.b64encode(bytes(data)).decode('ascii')
+
+
+def decode(data):
+    """Decodes binary data from a request or a response."""
+
+    return bytearray(base64.b64decode(data))
+
+
+def request(path, command, **args):
+    """Sends a request to the evic-usb serve process.
+
+    Args:
+        path: Path of the server socket.
+        command: Name of the command.
+        **args: Arguments for the command.
+
+    Returns:
+        A dictionary containing the response.
+
+    Raises:
+        IOError: The server is not running or the command failed.
+    """
+
+    args['command'] = command
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        conn.sendall(json.dumps(args).encode('utf-8') + b'\n')
+        conn.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.error as error:
+        raise IOError("Can't connect to the server: {}".format(error))
+    finally:
+        conn.close()
+
+    try:
+        response = json.loads(b''.join(chunks).decode('utf-8'))
+    except ValueError:
+        raise IOError("Invalid response from the server.")
+
+    if not response.get('ok'):
+        raise IOError(response.get('error', "Unknown error."))
+
+    return response
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='evic-client',
+        description="Send commands to a running evic-usb serve process.")
+    parser.add_argument('--socket', default=default_socket_path(),
+                        help="Path of the server socket.")
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('list', help="List the attached devices.")
+
+    info = commands.add_parser('info', help="Print the device information.")
+    info.add_argument('--serial', '-s')
+
+    upload = commands.add_parser(
+        'upload', help="Upload an APROM image to the device.")
+    upload.add_argument('inputfile')
+    upload.add_argument('--encrypted', '-e', dest='encrypted',
+                        action='store_true', default=True)
+    upload.add_argument('--unencrypted', '-u', dest='encrypted',
+                        action='store_false')
+    upload.add_argument('--dataflash', '-d', dest='dataflashfile')
+    upload.add_argument('--no-verify', dest='noverify', action='append',
+                        choices=['aprom', 'dataflash'], default=[])
+    upload.add_argument('--serial', '-s')
+    upload.add_argument('--delta', action='store_true')
+    upload.add_argument('--if-changed', dest='ifchanged',
+                        action='store_true')
+
+    logo = commands.add_parser('upload-logo',
+                               help="Upload a logo to the device.")
+    logo.add_argument('inputfile')
+    logo.add_argument('--invert', '-i', action='store_true')
+    logo.add_argument('--no-verify', dest='noverify', action='store_true')
+    logo.add_argument('--serial', '-s')
+
+    dump = commands.add_parser('dump-dataflash',
+                               help="Write device data flash to a file.")
+    dump.add_argument('--output', '-o', required=True)
+    dump.add_argument('--no-verify', dest='noverify', action='store_true')
+    dump.add_argument('--serial', '-s')
+
+    reset = commands.add_parser('reset-dataflash',
+                                help="Reset device data flash.")
+    reset.add_argument('--serial', '-s')
+
+    return parser
+
+
+def _read(path):
+    with open(path, 'rb') as inputfile:
+        return encode(inputfile.read())
+
+
+def main(argv=None):
+    """Entry point of evic-client."""
+
+    args = _parser().parse_args(argv)
+    if not args.command:
+        _parser().print_usage()
+        return 2
+
+    try:
+        if args.command == 'list':
+            for device in request(args.socket, 'list')['devices']:
+                print("{serial}\t{product}".format(**device))
+            return 0
+
+        if args.command == 'info':
+            info = request(args.socket, 'info', serial=args.serial)
+            print("Device name: {name}\n"
+                  "Serial No: {serial}\n"
+                  "Firmware version: {fw_version:.2f}\n"
+                  "Hardware version: {hw_version:.2f}".format(
+                      name=info['name'], serial=info['serial'],
+                      fw_version=info['fw_version'] / 100.0,
+                      hw_version=info['hw_version'] / 100.0))
+            return 0
+
+        if args.command == 'upload':
+            response = request(
+                args.socket, 'upload', serial=args.serial,
+                aprom=_read(args.inputfile), encrypted=args.encrypted,
+                dataflash=_read(args.dataflashfile) if args.dataflashfile
+                else None,
+                noverify=args.noverify, delta=args.delta,
+                ifchanged=args.ifchanged)
+            if response['skipped']:
+                print("APROM is already up to date.")
+
+        elif args.command == 'upload-logo':
+            request(args.socket, 'upload-logo', serial=args.serial,
+                    logo=_read(args.inputfile), invert=args.invert,
+                    verify=not args.noverify)
+
+        elif args.command == 'dump-dataflash':
+            response = request(args.socket, 'dump-dataflash',
+                               serial=args.serial, verify=not args.noverify)
+            with open(args.output, 'wb') as output:
+                output.write(decode(response['dataflash']))
+
+        elif args.command == 'reset-dataflash':
+            request(args.socket, 'reset-dataflash', serial=args.serial)
+
+    except (IOError, OSError) as error:
+        sys.stderr.write("FAIL: {}\n".format(error))
+        return 1
+
+    print("OK")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
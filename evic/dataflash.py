@@ -17,7 +17,8 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import binstruct
+import struct
+from collections import OrderedDict
 
 
 class DataFlashError(Exception):
@@ -26,25 +27,321 @@ class DataFlashError(Exception):
     pass
 
 
-class DataFlash(binstruct.StructTemplate):
+class Field(object):
+    """A data flash field decoded on access with a precompiled layout.
+
+    Attributes:
+        offset: Offset of the field in the data flash.
+        layout: struct.Struct of the field.
+        fmt: Format string of the field without the byte order.
+        count: Number of values the layout unpacks.
+    """
+
+    __slots__ = ('offset', 'fmt', 'layout', 'count')
+
+    def __init__(self, offset, fmt):
+        self.offset = offset
+        self.fmt = fmt
+        self.layout = struct.Struct('<' + fmt)
+        self.count = len(self.layout.unpack(b'\0' * self.layout.size))
+
+    def decode(self, values):
+        """Converts the unpacked values to the attribute value."""
+
+        return values[0]
+
+    def encode(self, value):
+        """Converts an attribute value to a tuple of values to pack."""
+
+        return (value,)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return self.decode(self.layout.unpack_from(
+            instance._array, instance.start_offset + self.offset))
+
+    def __set__(self, instance, value):
+        start = instance.start_offset + self.offset
+        old = instance._array[start:start + self.layout.size]
+        try:
+            self.layout.pack_into(instance._array, start, *self.encode(value))
+        except struct.error as error:
+            raise ValueError("{} does not fit in this field: {}".format(
+                value, error))
+        instance._written(self.offset, old)
+
+
+class ArrayField(Field):
+    """A data flash field containing several values of the same type."""
+
+    __slots__ = ()
+
+    def __init__(self, offset, fmt, length):
+        super(ArrayField, self).__init__(offset, '{}{}'.format(length, fmt))
+
+    def decode(self, values):
+        return values
+
+    def encode(self, value):
+        return tuple(value)
+
+
+class StringField(Field):
+    """A data flash field containing a fixed length string.
+
+    Setting a shorter string only overwrites the start of the field.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, offset, length):
+        super(StringField, self).__init__(offset, '{}s'.format(length))
+
+    def decode(self, values):
+        return values[0].decode('latin-1')
+
+    def __set__(self, instance, value):
+        if len(value) > self.layout.size:
+            raise ValueError("{} does not fit in this field".format(value))
+        start = instance.start_offset + self.offset
+        old = instance._array[start:start + len(value)]
+        instance._array[start:start + len(value)] = value.encode('latin-1')
+        instance._written(self.offset, old)
+
+
+class DataFlash(object):
     """Device data flash class.
 
+    The data flash is 2044 bytes of settings and device information. Fields
+    are read from and written to the array when accessed. The layout is the
+    one used by the Joyetech firmware. Units are given where they are known.
+
+    Field writes keep the checksum up to date and remember the original
+    contents of the written fields. Accessing the array drops the cached
+    checksum, as the array may be changed directly. Such changes are not
+    tracked otherwise.
+
     Attributes:
+        array: A bytearray containing the data flash.
+        start_offset: Offset of the data flash in the array.
         hw_version: An integer hardware version number.
+        magic: Data flash layout marker, 0x32 on known firmware.
         bootflag: 0 or 1. Controls whether APROM or LDROM is booted
                   when the device is restarted.
                     0 = APROM
                     1 = LDROM
-        product_id: Product ID string.
+        mode: Vaping mode.
+        protec: Raw protection setting.
+        power: Power in tenths of a watt.
+        temp: Temperature for the temperature control modes.
+        tc_power: Maximum power of the temperature control modes in tenths
+                  of a watt.
+        vw_volts: Output voltage in hundredths of a volt.
+        apt: Raw APT setting.
+        rez_type: Raw coil resistance type.
+        temp_algo: Temperature control algorithm.
+        is_celsius: 1 if temperatures are in Celsius, 0 for Fahrenheit.
+        resistance: Raw coil resistance.
+        rez_ti: Raw saved titanium coil resistance.
+        rez_ni: Raw saved nickel coil resistance.
+        rez_locked_ti: 1 if the titanium coil resistance is locked.
+        rez_locked_ni: 1 if the nickel coil resistance is locked.
+        ti_on: 1 if the titanium mode is enabled.
+        stealth_on: 1 if the stealth mode is enabled.
+        temp_coefs_ni: A tuple of 21 nickel temperature coefficients.
+        temp_coefs_ti: A tuple of 21 titanium temperature coefficients.
         fw_version: An integer firmware version number.
         ldrom_version: An integer LDROM versrion number.
+        fmc_cid: Company ID of the microcontroller.
+        fmc_did: Device ID of the microcontroller.
+        fmc_pid: Product ID of the microcontroller.
+        fmc_uid: A tuple of the 3 unique ID words of the microcontroller.
+        fmc_ucid: A tuple of the 4 unique customer ID words of the
+                  microcontroller.
+        product_id: Product ID string.
     """
 
-    hw_version = binstruct.Int32Field(4)
-    bootflag = binstruct.Int8Field(9)
-    product_id = binstruct.StringField(312, 4)
-    fw_version = binstruct.Int32Field(256)
-    ldrom_version = binstruct.Int32Field(260)
+    __slots__ = ('_array', 'start_offset', '_checksum', '_original')
+
+    size = 2044
+
+    hw_version = Field(4, 'I')
+    magic = Field(8, 'B')
+    bootflag = Field(9, 'B')
+    mode = Field(10, 'B')
+    protec = Field(11, 'B')
+    power = Field(12, 'H')
+    temp = Field(14, 'H')
+    tc_power = Field(16, 'H')
+    vw_volts = Field(18, 'H')
+    apt = Field(20, 'B')
+    rez_type = Field(21, 'B')
+    temp_algo = Field(22, 'B')
+    is_celsius = Field(23, 'B')
+    resistance = Field(24, 'H')
+    rez_ti = Field(26, 'H')
+    rez_ni = Field(28, 'H')
+    rez_locked_ti = Field(30, 'B')
+    rez_locked_ni = Field(31, 'B')
+    ti_on = Field(32, 'B')
+    stealth_on = Field(33, 'B')
+    temp_coefs_ni = ArrayField(34, 'H', 21)
+    temp_coefs_ti = ArrayField(76, 'H', 21)
+    fw_version = Field(256, 'I')
+    ldrom_version = Field(260, 'I')
+    fmc_cid = Field(264, 'I')
+    fmc_did = Field(268, 'I')
+    fmc_pid = Field(272, 'I')
+    fmc_uid = ArrayField(276, 'I', 3)
+    fmc_ucid = ArrayField(288, 'I', 4)
+    product_id = StringField(312, 4)
+
+    # Field names in data flash order
+    fields = ('hw_version', 'magic', 'bootflag', 'mode', 'protec', 'power',
+              'temp', 'tc_power', 'vw_volts', 'apt', 'rez_type', 'temp_algo',
+              'is_celsius', 'resistance', 'rez_ti', 'rez_ni',
+              'rez_locked_ti', 'rez_locked_ni', 'ti_on', 'stealth_on',
+              'temp_coefs_ni', 'temp_coefs_ti', 'fw_version', 'ldrom_version',
+              'fmc_cid', 'fmc_did', 'fmc_pid', 'fmc_uid', 'fmc_ucid',
+              'product_id')
+
+    def __init__(self, array, start_offset=0):
+        self._array = array
+        self.start_offset = start_offset
+        self._checksum = None
+        self._original = {}
+
+    @property
+    def array(self):
+        """The bytearray containing the data flash."""
+
+        # The caller may change the contents
+        self._checksum = None
+        return self._array
+
+    def _written(self, offset, old):
+        """Updates the checksum and the change tracking after a field write.
+
+        Args:
+            offset: Offset of the written bytes in the data flash.
+            old: A bytearray containing the bytes before the write.
+        """
+
+        start = self.start_offset + offset
+        new = self._array[start:start + len(old)]
+        if new == old:
+            return
+
+        if self._checksum is not None:
+            self._checksum += sum(new) - sum(old)
+
+        # Strings of different lengths are written at the same offset
+        original = self._original.get(offset, bytearray())
+        if len(old) > len(original):
+            self._original[offset] = original + old[len(original):]
+
+    @property
+    def checksum(self):
+        """Sum of the data flash bytes.
+
+        Computed once and then updated by the field writes.
+        """
+
+        if self._checksum is None:
+            # Items of a memoryview are str on Python 2
+            self._checksum = sum(bytearray(self._array[self.start_offset:]))
+
+        return self._checksum
+
+    @property
+    def changed(self):
+        """True if a field write has changed the contents."""
+
+        return bool(self.dirty_ranges())
+
+    def dirty_ranges(self):
+        """Returns the ranges changed by field writes.
+
+        Returns:
+            A sorted list of (start, end) offset tuples. Adjacent ranges are
+            merged.
+        """
+
+        ranges = []
+        for offset, old in sorted(self._original.items()):
+            start = self.start_offset + offset
+            length = len(old)
+            if self._array[start:start + length] == old:
+                continue
+            if ranges and ranges[-1][1] >= offset:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1],
+                                                 offset + length))
+            else:
+                ranges.append((offset, offset + length))
+
+        return ranges
+
+    def mark_clean(self):
+        """Forgets the changes, e.g. after writing the data flash."""
+
+        self._original = {}
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def layout(cls):
+        """Returns a struct.Struct unpacking all the fields at once.
+
+        The layout is compiled on first use.
+        """
+
+        if '_layout' not in cls.__dict__:
+            fmt = '<'
+            position = 0
+            for name in cls.fields:
+                field = getattr(cls, name)
+                fmt += '{}x{}'.format(field.offset - position,
+                                      field.fmt)
+                position = field.offset + field.layout.size
+            cls._layout = struct.Struct(fmt)
+
+        return cls._layout
+
+    def settings(self):
+        """Decodes all the fields with a single unpack.
+
+        Returns:
+            An OrderedDict mapping the field names to their values.
+        """
+
+        values = self.layout().unpack_from(self._array, self.start_offset)
+        settings = OrderedDict()
+        index = 0
+        for name in self.fields:
+            field = getattr(type(self), name)
+            count = field.count
+            settings[name] = field.decode(values[index:index + count])
+            index += count
+
+        return settings
+
+    def update(self, settings):
+        """Sets several fields.
+
+        Args:
+            settings: A dictionary mapping field names to values.
+
+        Raises:
+            KeyError: A name is not a data flash field.
+        """
+
+        for name in settings:
+            if name not in self.fields:
+                raise KeyError(name)
+        for name, value in settings.items():
+            setattr(self, name, value)
 
     def verify(self, checksum):
         """Verifies the data flash against given checksum.
@@ -56,5 +353,5 @@ class DataFlash(binstruct.StructTemplate):
             DataFlashError: Data flash verification failed.
         """
 
-        if sum(self.array) != checksum:
+        if self.checksum != checksum:
             raise DataFlashError("Data flash verification failed.")
@@ -17,8 +17,10 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import time
 import struct
-from collections import namedtuple
+import threading
+from collections import namedtuple, OrderedDict
 
 try:
     import hid
@@ -31,6 +33,94 @@ from .dataflash import DataFlash
 DeviceInfo = namedtuple('DeviceInfo',
                         'name supported_product_ids logo_dimensions')
 
+USBDevice = namedtuple('USBDevice', 'path serial product')
+
+# Emitted to the HIDTransfer listeners. event is one of 'report_write',
+# 'report_read', 'command', 'read_dataflash', 'write_dataflash',
+# 'write_flash', 'reset' and 'reconnect'. command is the HID command code
+# or None.
+TransferEvent = namedtuple('TransferEvent',
+                           'event command seconds nbytes retries')
+
+PhaseTotal = namedtuple('PhaseTotal', 'event count seconds nbytes retries')
+
+# Flash page size of the Nuvoton M451
+PAGE_SIZE = 2048
+
+
+def changed_ranges(old, new, page_size=PAGE_SIZE):
+    """Finds the flash pages that differ between two images.
+
+    Args:
+        old: The image on the device.
+        new: The image to write.
+        page_size: Flash page size in bytes.
+
+    Returns:
+        A list of (start, end) tuples of the byte ranges of new that need
+        to be written. Adjacent changed pages are merged.
+    """
+
+    old = memoryview(old)
+    new = memoryview(new)
+    ranges = []
+    for start in range(0, len(new), page_size):
+        end = min(start + page_size, len(new))
+        if new[start:end] == old[start:end]:
+            continue
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+    return ranges
+
+
+class TransferError(IOError):
+    """A HID write failed after all the retries.
+
+    Attributes:
+        offset: Number of bytes confirmed written before the failure.
+    """
+
+    def __init__(self, message, offset):
+        super(TransferError, self).__init__(message)
+        self.offset = offset
+
+
+# hidapi enumeration isn't guaranteed to be thread safe
+_enumerate_lock = threading.Lock()
+
+
+class TransferStats(object):
+    """Sums the transfer events per event type.
+
+    Usable as a HIDTransfer listener. Can be shared by several devices.
+    """
+
+    def __init__(self):
+        self._totals = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            total = self._totals.setdefault(event.event, [0, 0.0, 0, 0])
+            total[0] += 1
+            total[1] += event.seconds
+            total[2] += event.nbytes
+            total[3] += event.retries
+
+    def __len__(self):
+        return len(self._totals)
+
+    def totals(self):
+        """Returns a list of PhaseTotal tuples in order of first event."""
+
+        with self._lock:
+            return [PhaseTotal(event, *total)
+                    for event, total in self._totals.items()]
+
+
 class HIDTransfer(object):
     """Generic Nuvoton HID Transfer device class.
 
@@ -40,11 +130,37 @@ class HIDTransfer(object):
         devices: A dictionary mapping product IDs to DeviceInfo tuples.
         hid_signature: A bytearray containing the HID command signature
                        (4 bytes).
+        backend: The hid module or a stand-in providing device() and
+                 enumerate(), such as evic.simulator.SimulatedHID.
         device: A HIDAPI device.
+        path: HID path of the device to open. None opens the first device
+              found.
+        match_serial: Serial number of the device to open or None. The
+                      device is looked up by the serial number on every
+                      connect, since its path changes when it restarts.
         manufacturer: A string containing the device manufacturer.
         product: A string containing the product name.
         serial: A string conraining the product serial number.
         ldrom: A Boolean value set to True if the device is booted to LDROM.
+        reset_time: Time of the last reset or None.
+        reset_latency: Seconds from the last reset until the device was
+                       ready again or None.
+        listeners: A list of callables receiving a TransferEvent for every
+                   report, command and operation. Timing is only measured
+                   while there are listeners.
+        write_attempts: Number of times a report is written before giving
+                        up. A report that reached the device despite the
+                        error is written twice, so retries are off by
+                        default.
+        flash_attempts: Number of times a flash write is issued before
+                        giving up. Each reissue opens the device again and
+                        resumes from the flash page containing the last
+                        confirmed byte. This assumes LDROM abandons an
+                        interrupted transfer when the device is opened
+                        again, which hasn't been verified on hardware, so
+                        resuming is off by default.
+        retry_delay: Seconds to wait before the first retry.
+        retry_backoff: Factor the wait grows by after each retry.
     """
 
     vid = 0x0416
@@ -77,15 +193,28 @@ class HIDTransfer(object):
     # 0x43444948
     hid_signature = bytearray(b'HIDC')
 
-    def __init__(self):
-        if HIDAPI_AVAILABLE:
-            self.device = hid.device()
+    write_attempts = 1
+    flash_attempts = 1
+    retry_delay = 0.05
+    retry_backoff = 2.0
+
+    def __init__(self, path=None, serial=None, backend=None):
+        if backend is None and HIDAPI_AVAILABLE:
+            backend = hid
+        self.backend = backend
+        if backend is not None:
+            self.device = backend.device()
         else:
             self.device = None
+        self.path = path
+        self.match_serial = serial
         self.manufacturer = None
         self.product = None
         self.serial = None
         self.ldrom = False
+        self.reset_time = None
+        self.reset_latency = None
+        self.listeners = []
 
     @classmethod
     def hidcmd(cls, cmdcode, arg1, arg2):
@@ -112,18 +241,206 @@ class HIDTransfer(object):
         # Return the command with checksum tacked at the end
         return cmd + bytearray(struct.pack('=I', sum(cmd)))
 
+    def emit(self, event, start, nbytes=0, retries=0, command=None):
+        """Sends a TransferEvent to the listeners.
+
+        Args:
+            event: Name of the event.
+            start: Time the event started.
+            nbytes: Number of bytes transferred.
+            retries: Number of retries.
+            command: HID command code or None.
+        """
+
+        event = TransferEvent(event, command, time.time() - start, nbytes,
+                              retries)
+        for listener in self.listeners:
+            listener(event)
+
+    @classmethod
+    def enumerate(cls, backend=None):
+        """Lists the attached devices.
+
+        Args:
+            backend: The backend to use. Defaults to the hid module.
+
+        Returns:
+            A list of USBDevice tuples.
+        """
+
+        with _enumerate_lock:
+            devices = (backend or hid).enumerate(cls.vid, cls.pid)
+
+        return [USBDevice(info['path'], info['serial_number'],
+                          info['product_string']) for info in devices]
+
+    @classmethod
+    def find(cls, serial, backend=None):
+        """Finds the path of an attached device.
+
+        Args:
+            serial: Serial number of the device.
+            backend: The backend to use. Defaults to the hid module.
+
+        Returns:
+            The HID path of the device.
+
+        Raises:
+            IOError: The device was not found.
+        """
+
+        for device in cls.enumerate(backend):
+            if device.serial == serial:
+                return device.path
+
+        raise IOError("Device not found.")
+
     def connect(self):
         """Connects the USB device.
 
         Connects the device and saves the USB device info attributes.
         """
 
-        self.device.open(self.vid, self.pid)
+        if self.match_serial is not None:
+            self.path = self.find(self.match_serial, self.backend)
+
+        if self.path is not None:
+            self.device.open_path(self.path)
+        else:
+            self.device.open(self.vid, self.pid)
         if not self.manufacturer:
             self.manufacturer = self.device.get_manufacturer_string()
             self.product = self.device.get_product_string()
             self.serial = self.device.get_serial_number_string()
 
+    def close(self):
+        """Closes the USB device."""
+
+        self.device.close()
+
+    def attached(self):
+        """Checks if the device is attached.
+
+        Returns:
+            True if the device or, unless bound to a serial number, any
+            supported device is attached.
+        """
+
+        devices = self.enumerate(self.backend)
+        if self.match_serial is not None:
+            return any(device.serial == self.match_serial
+                       for device in devices)
+
+        return bool(devices)
+
+    def try_reconnect(self, ldrom=True):
+        """Tries once to connect the device after a reset.
+
+        Args:
+            ldrom: True to wait for LDROM, False for APROM.
+
+        The polling isn't reported to the listeners, its time is part of
+        the 'reconnect' event.
+
+        Returns:
+            True if the device was connected and has booted to LDROM or
+            APROM as requested.
+        """
+
+        if not self.attached():
+            return False
+
+        listeners = self.listeners
+        self.listeners = []
+        try:
+            self.connect()
+            self.read_dataflash()
+        except IOError:
+            self.close()
+            return False
+        finally:
+            self.listeners = listeners
+
+        # The device hasn't restarted yet
+        if bool(self.ldrom) != ldrom:
+            self.close()
+            return False
+
+        return True
+
+    def reconnect(self, delay=0.2, interval=0.05, backoff=1.5,
+                  max_interval=0.5, timeout=10.0, ldrom=True):
+        """Connects the device again after a reset.
+
+        Polls the attached devices until the device has restarted to LDROM,
+        or to APROM after the image has been written.
+
+        Args:
+            delay: Seconds to wait before the first attempt.
+            interval: Seconds between the first attempts.
+            backoff: Factor the interval grows by after each attempt.
+            max_interval: Maximum seconds between attempts.
+            timeout: Seconds to wait for the device in total.
+            ldrom: True to wait for LDROM, False for APROM.
+
+        Returns:
+            The seconds from the reset until the device was ready.
+
+        Raises:
+            IOError: The device didn't restart in time.
+        """
+
+        self.close()
+        start = time.time()
+
+        attempts = 0
+        for wait in self._reconnect_waits(start, delay, interval, backoff,
+                                          max_interval, timeout, ldrom):
+            time.sleep(wait)
+            attempts += 1
+            if self.try_reconnect(ldrom):
+                break
+
+        return self._reconnected(start, attempts)
+
+    @staticmethod
+    def _reconnect_waits(start, delay, interval, backoff, max_interval,
+                         timeout, ldrom):
+        """Yields the seconds to wait before each reconnect attempt.
+
+        Shared by the blocking and the asyncio reconnect. See reconnect for
+        the arguments.
+
+        Raises:
+            IOError: The timeout has passed.
+        """
+
+        yield delay
+        while True:
+            if time.time() - start > timeout:
+                raise IOError("Device didn't restart to {}.".format(
+                    "LDROM" if ldrom else "APROM"))
+            yield interval
+            interval = min(interval * backoff, max_interval)
+
+    def _reconnected(self, start, attempts):
+        """Records the reset latency once the device is connected again.
+
+        Args:
+            start: Time the reconnect started.
+            attempts: Number of connection attempts.
+
+        Returns:
+            The seconds from the reset until the device was ready.
+        """
+
+        self.reset_latency = time.time() - (self.reset_time or start)
+        if self.listeners:
+            self.emit('reconnect', self.reset_time or start,
+                      retries=attempts - 1)
+
+        return self.reset_latency
+
     def send_command(self, cmd, arg1, arg2):
         """Sends a HID command to the device.
 
@@ -133,8 +450,11 @@ class HIDTransfer(object):
             arg2: Second argument to the command (integer)
         """
 
+        start = time.time() if self.listeners else 0
         command = self.hidcmd(cmd, arg1, arg2)
         self.write(command)
+        if self.listeners:
+            self.emit('command', start, len(command), command=cmd)
 
     def read_dataflash(self):
         """Reads the device data flash.
@@ -145,6 +465,7 @@ class HIDTransfer(object):
             A tuple containing the data flash and its checksum.
         """
 
+        started = time.time() if self.listeners else 0
         start = 0
         end = 2048
 
@@ -153,43 +474,71 @@ class HIDTransfer(object):
 
         # Read the dataflash
         buf = self.read(end)
-        dataflash = DataFlash(buf[4:], 0)
 
         # Get the checksum from the beginning of the data flash transfer
-        checksum = struct.unpack('=I', bytes(buf[0:4]))[0]
+        checksum = struct.unpack_from('=I', buf)[0]
+
+        # Deleting from the front of a bytearray doesn't copy the data
+        del buf[0:4]
+        dataflash = DataFlash(buf, 0)
 
         # Are we booted to LDROM?
         self.ldrom = dataflash.ldrom_version or not dataflash.fw_version
 
+        if self.listeners:
+            self.emit('read_dataflash', started, end, command=0x35)
+
         return (dataflash, checksum)
 
     def write(self, data):
         """Writes data to the device.
 
+        Every report is retried write_attempts times before giving up.
+
         Args:
             data: An iterable containing the binary data.
 
         Raises:
-            IOError: Incorrect amount of bytes was written.
+            TransferError: A report couldn't be written.
         """
 
-        bytes_written = 0
-
-        # Split the data into 64 byte long chunks
-        chunks = [bytearray(data[i:i+64]) for i in range(0, len(data), 64)]
-
-        # Write the chunks to the device
-        for chunk in chunks:
-            buf = bytearray([0]) + chunk  # First byte is the report number
-            bytes_written += self.device.write(buf) - 1
-
-        # Windows always writes full pages
-        if bytes_written > len(data):
-            bytes_written -= 64 - (len(data) % 64)
-
-        # Raise IOerror if the amount sent doesn't match what we wanted
-        if bytes_written != len(data):
-            raise IOError("HID Write failed.")
+        try:
+            view = memoryview(data)
+        except TypeError:
+            view = memoryview(bytearray(data))
+
+        # First byte is the report number
+        report = bytearray(65)
+
+        # Write the data to the device in 64 byte long chunks
+        for i in range(0, len(view), 64):
+            start = time.time() if self.listeners else 0
+            chunk = view[i:i+64]
+            report[1:len(chunk) + 1] = chunk
+            if len(chunk) < 64:
+                report = report[:len(chunk) + 1]
+
+            retries = 0
+            while True:
+                try:
+                    error = None
+                    written = self.device.write(report) - 1
+                except IOError as ioerror:
+                    error = ioerror
+                    written = -1
+
+                # Windows always writes full pages
+                if written >= len(chunk):
+                    break
+                if retries + 1 >= self.write_attempts:
+                    raise TransferError("HID Write failed: {}".format(
+                        error or "{} of {} bytes written.".format(
+                            max(written, 0), len(chunk))), i)
+                time.sleep(self.retry_delay * self.retry_backoff ** retries)
+                retries += 1
+
+            if self.listeners:
+                self.emit('report_write', start, len(chunk), retries)
 
     def read(self, length):
         """Reads data from the device.
@@ -204,30 +553,54 @@ class HIDTransfer(object):
             IOError: Incorrect amount of bytes was read.
         """
 
-        data = []
-        pages, rem = divmod(length, 64)
-        for _ in range(0, pages):
-            data += self.device.read(64)
-        if rem:
-            data += self.device.read(rem)
+        data = bytearray(length)
+        self.readinto(data)
+
+        return data
+
+    def readinto(self, buf):
+        """Reads data from the device into a preallocated buffer.
 
-        # Windows always reads full pages
-        if len(data) > length:
-            data = data[:length]
+        Args:
+            buf: A writable bytes-like object. The whole buffer is filled.
+
+        Returns:
+            The number of bytes read.
+
+        Raises:
+            IOError: Incorrect amount of bytes was read.
+        """
+
+        view = memoryview(buf)
+        length = len(view)
+        bytes_read = 0
+
+        for i in range(0, length, 64):
+            start = time.time() if self.listeners else 0
+            # Windows always reads full pages
+            report = self.device.read(min(64, length - i))
+            report = report[:length - bytes_read]
+            view[bytes_read:bytes_read + len(report)] = bytearray(report)
+            bytes_read += len(report)
+            if self.listeners:
+                self.emit('report_read', start, len(report))
 
         # Raise IOerror if the amount read doesn't match what we wanted
-        if len(data) != length:
+        if bytes_read != length:
             raise IOError("HID read failed")
 
-        return bytearray(data)
+        return bytes_read
 
     def write_dataflash(self, dataflash):
         """Writes the data flash to the device.
 
+        The changes tracked by the data flash are forgotten once written.
+
         Args:
             dataflash: A DataFlash object.
         """
 
+        started = time.time() if self.listeners else 0
         # We want 2048 bytes
         start = 0
         end = 2048
@@ -236,10 +609,13 @@ class HIDTransfer(object):
         self.send_command(0x53, start, end)
 
         # Add checksum of the data in front of it
-        buf = bytearray(struct.pack("=I", sum(dataflash.array))) + \
+        buf = bytearray(struct.pack("=I", dataflash.checksum)) + \
             dataflash.array
 
         self.write(buf)
+        dataflash.mark_clean()
+        if self.listeners:
+            self.emit('write_dataflash', started, end, command=0x53)
 
     def reset_dataflash(self):
         """Resets the device data flash.
@@ -252,30 +628,76 @@ class HIDTransfer(object):
     def reset(self):
         """Sends the HID command for resetting the system (0xB4)"""
 
+        start = time.time() if self.listeners else 0
         self.send_command(0xB4, 0, 0)
+        self.reset_time = time.time()
+        if self.listeners:
+            self.emit('reset', start, command=0xB4)
 
     def write_flash(self, data, start):
         """Writes data to the flash memory.
 
+        If the transfer fails and flash_attempts allows it, the device is
+        opened again and the write is reissued from the start of the flash
+        page containing the last confirmed byte.
+
         Args:
+            data: The data to write.
             start: Start address.
-        """
 
-        end = len(data)
-
-        # Send the command for writing the data
-        self.send_command(0xC3, start, end)
-
-        self.write(data)
+        Raises:
+            TransferError: The write failed flash_attempts times.
+        """
 
-    def write_aprom(self, aprom):
+        started = time.time() if self.listeners else 0
+        view = memoryview(data)
+        offset = 0
+        reissues = 0
+
+        while True:
+            try:
+                # Send the command for writing the data
+                self.send_command(0xC3, start + offset, len(view) - offset)
+                self.write(view[offset:])
+                break
+            except TransferError as error:
+                if reissues + 1 >= self.flash_attempts:
+                    raise TransferError(str(error), offset + error.offset)
+
+                # The interrupted page may have been erased, write it again
+                address = start + offset + error.offset
+                offset = max(address - address % PAGE_SIZE - start, offset)
+                time.sleep(self.retry_delay *
+                           self.retry_backoff ** reissues)
+                reissues += 1
+                self.close()
+                self.connect()
+
+        if self.listeners:
+            self.emit('write_flash', started, len(view), reissues, 0xC3)
+
+    def write_aprom(self, aprom, base=None):
         """Writes the APROM to the device.
 
         Args:
             aprom: A BinFile object containing an unencrypted APROM image.
+            base: The unencrypted image on the device or None. If given,
+                  only the flash pages that differ from it are written.
+
+        Returns:
+            The number of bytes written.
         """
 
-        self.write_flash(aprom.data, 0)
+        if base is None:
+            self.write_flash(aprom.data, 0)
+            return len(aprom.data)
+
+        written = 0
+        for start, end in changed_ranges(base, aprom.data):
+            self.write_flash(aprom.data[start:end], start)
+            written += end - start
+
+        return written
 
     def write_logo(self, logo):
         """Writes the logo to the the device.
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import hashlib
+
+from .aprom import APROM, APROMInfo
+
+# os.rename doesn't overwrite files on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+
+class ImageCache(object):
+    """Content-addressed cache of converted and scanned APROM images.
+
+    Entries are keyed by the SHA-256 hash of the APROM file as it was read.
+    Each entry stores the unencrypted image and its APROMInfo, so a cache hit
+    skips both the conversion and the verification scan. The hash of the
+    unencrypted image is stored too, and an image that doesn't match it is
+    a cache miss. The least recently used entries are removed when the
+    cache grows over its size limit.
+
+    Attributes:
+        directory: Path of the cache directory.
+        max_size: Maximum combined size of the cached images in bytes.
+        hits: Number of images loaded from the cache.
+        misses: Number of images converted and added to the cache.
+    """
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(data, encrypted=True):
+        """Returns the cache key for APROM file contents.
+
+        Args:
+            data: Contents of the APROM file.
+            encrypted: True if the file is encrypted.
+        """
+
+        return "{}-{}".format(hashlib.sha256(data).hexdigest(),
+                              'enc' if encrypted else 'raw')
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def get(self, key):
+        """Returns a cached image.
+
+        Args:
+            key: Cache key of the image.
+
+        Returns:
+            An APROM object with the info attribute set or None if the image
+            isn't in the cache or is damaged.
+        """
+
+        try:
+            with open(self._path(key, '.json'), 'r') as infofile:
+                info = json.load(infofile)
+            with open(self._path(key, '.bin'), 'rb') as imagefile:
+                data = imagefile.read()
+            if hashlib.sha256(data).hexdigest() != info['sha256']:
+                return None
+            product_ids = dict((product_id, tuple(value)) for product_id, value
+                               in info['product_ids'].items())
+            info = APROMInfo(info['manufacturer'], product_ids)
+        except (EnvironmentError, ValueError, KeyError, TypeError,
+                AttributeError):
+            return None
+
+        # Mark as recently used
+        os.utime(self._path(key, '.bin'), None)
+
+        return APROM(data, info)
+
+    def put(self, key, aprom):
+        """Adds an image to the cache.
+
+        Args:
+            key: Cache key of the image.
+            aprom: An unencrypted APROM object.
+        """
+
+        info = aprom.scan()._asdict()
+        info['sha256'] = hashlib.sha256(aprom.data).hexdigest()
+
+        # The info file is written last, it marks the entry complete
+        for extension, mode, content in [
+                ('.bin', 'wb', aprom.data),
+                ('.json', 'w', json.dumps(info))]:
+            tmppath = self._path(key, extension + '.tmp')
+            with open(tmppath, mode) as cachefile:
+                cachefile.write(content)
+            _replace(tmppath, self._path(key, extension))
+
+        self.evict()
+
+    def load(self, data, encrypted=True):
+        """Returns a scanned, unencrypted APROM for APROM file contents.
+
+        The image is converted and scanned only if it isn't in the cache.
+
+        Args:
+            data: Contents of the APROM file.
+            encrypted: True if the file is encrypted.
+
+        Returns:
+            An APROM object with the info attribute set.
+        """
+
+        key = self.key(data, encrypted)
+        aprom = self.get(key)
+        if aprom is not None:
+            self.hits += 1
+            return aprom
+
+        self.misses += 1
+        aprom = APROM(data)
+        if encrypted:
+            aprom = APROM(aprom.convert())
+        aprom.scan()
+        self.put(key, aprom)
+
+        return aprom
+
+    def evict(self):
+        """Removes the least recently used images over the size limit."""
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.bin'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name[:-4]))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, key in sorted(entries):
+            if size <= self.max_size:
+                break
+            for extension in ['.json', '.bin']:
+                try:
+                    os.remove(self._path(key, extension))
+                except OSError:
+                    pass
+            size -= entry_size
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+import json
+import hashlib
+from collections import namedtuple
+
+JournalEntry = namedtuple('JournalEntry', 'data sha256 fw_version uid')
+
+
+class FlashJournal(object):
+    """Journal of the last APROM image written to each device.
+
+    An entry is recorded once the device has booted the written image. It
+    stores the unencrypted image, the firmware version the image reported
+    and the unique ID of the microcontroller. A device reporting another
+    version or ID has been flashed elsewhere and its entry is stale.
+
+    The devices can't read their flash back, so a device flashed elsewhere
+    with an image reporting the same version is not detected.
+
+    Attributes:
+        directory: Path of the journal directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, serial, extension):
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', serial)
+        return os.path.join(self.directory, name + extension)
+
+    def get(self, serial):
+        """Returns the journal entry of a device.
+
+        Args:
+            serial: Serial number of the device.
+
+        Returns:
+            A JournalEntry tuple or None.
+        """
+
+        entry = self._meta(serial)
+        if entry is None:
+            return None
+
+        try:
+            with open(self._path(serial, '.bin'), 'rb') as imagefile:
+                data = bytearray(imagefile.read())
+        except EnvironmentError:
+            return None
+
+        if hashlib.sha256(data).hexdigest() != entry.sha256:
+            return None
+
+        return entry._replace(data=data)
+
+    def _meta(self, serial):
+        """Returns the journal entry of a device without the image."""
+
+        try:
+            with open(self._path(serial, '.json'), 'r') as metafile:
+                meta = json.load(metafile)
+            return JournalEntry(None, meta['sha256'], meta['fw_version'],
+                                tuple(meta['uid']))
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            return None
+
+    def put(self, serial, data, dataflash):
+        """Records the image on a device.
+
+        Args:
+            serial: Serial number of the device.
+            data: The unencrypted image.
+            dataflash: The DataFlash object read from the device after
+                       booting the image.
+        """
+
+        with open(self._path(serial, '.bin'), 'wb') as imagefile:
+            imagefile.write(data)
+        with open(self._path(serial, '.json'), 'w') as metafile:
+            json.dump({'sha256': hashlib.sha256(data).hexdigest(),
+                       'fw_version': dataflash.fw_version,
+                       'uid': list(dataflash.fmc_uid)}, metafile)
+
+    def invalidate(self, serial):
+        """Removes the journal entry of a device.
+
+        Args:
+            serial: Serial number of the device.
+        """
+
+        for extension in ['.json', '.bin']:
+            try:
+                os.remove(self._path(serial, extension))
+            except OSError:
+                pass
+
+    def overwritten(self, serial, start):
+        """Invalidates the entry if a flash write starts inside the image.
+
+        Args:
+            serial: Serial number of the device.
+            start: Start address of the write.
+        """
+
+        try:
+            size = os.path.getsize(self._path(serial, '.bin'))
+        except OSError:
+            return
+        if start < size:
+            self.invalidate(serial)
+
+    @staticmethod
+    def _matches(entry, dataflash, ldrom):
+        """Checks if a device still runs the image of an entry."""
+
+        # In LDROM the previous write may have been interrupted
+        return entry is not None and not ldrom and \
+            entry.fw_version == dataflash.fw_version and \
+            entry.uid == tuple(dataflash.fmc_uid)
+
+    def current(self, serial, dataflash, ldrom):
+        """Returns the image believed to be on the device.
+
+        Args:
+            serial: Serial number of the device.
+            dataflash: The DataFlash object read from the device.
+            ldrom: True if the device is booted to LDROM.
+
+        Returns:
+            A bytearray containing the image or None if the entry is
+            missing or stale.
+        """
+
+        entry = self.get(serial)
+        if not self._matches(entry, dataflash, ldrom):
+            return None
+
+        return entry.data
+
+    def has_image(self, serial, dataflash, ldrom, data):
+        """Checks if a device is already running an image.
+
+        The image is compared with the hash in the journal, the journaled
+        image isn't read.
+
+        Args:
+            serial: Serial number of the device.
+            dataflash: The DataFlash object read from the device.
+            ldrom: True if the device is booted to LDROM.
+            data: The unencrypted image.
+
+        Returns:
+            True if the journal entry is current and matches the image.
+        """
+
+        entry = self._meta(serial)
+        return self._matches(entry, dataflash, ldrom) and \
+            entry.sha256 == hashlib.sha256(data).hexdigest()
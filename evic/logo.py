@@ -66,7 +66,7 @@ def fromimage(image, invert=False):
         img = img.point(lambda x: 0 if x < 32 else 255, '1')
 
     # 1 bit per pixel
-    bits = bitarray(list(img.getdata()))
+    bits = bitarray([bool(pixel) for pixel in img.getdata()])
 
     # Convert to paged column-major order
     # 1 bit per pixel, 8 rows per page, LSB topmost
@@ -75,7 +75,7 @@ def fromimage(image, invert=False):
     for page in range(0, height // 8):
         for x in range(0, width):
             for y in range(0, 8):
-                pagedbits.append(imgpixels[x, page*8 + y])
+                pagedbits.append(bool(imgpixels[x, page*8 + y]))
 
     # Invert colors
     if invert:
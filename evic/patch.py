@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import struct
+import numbers
+from collections import OrderedDict
+
+from .dataflash import DataFlash, ArrayField, StringField
+
+PATCH_FORMAT = 'evic-dataflash-patch'
+PATCH_VERSION = 1
+
+# Fields unique to each microcontroller, never copied between devices
+UNIQUE_FIELDS = ('fmc_uid', 'fmc_ucid')
+
+
+class PatchError(Exception):
+    """Invalid data flash patch."""
+
+    pass
+
+
+def _is_string(value):
+    """Checks if a value is a text string on both Python 2 and 3."""
+
+    return isinstance(value, type(u''))
+
+
+def _check_value(name, value):
+    """Checks that a value has the type of its data flash field.
+
+    Raises:
+        PatchError: The value has the wrong type.
+    """
+
+    field = getattr(DataFlash, name)
+    if isinstance(field, StringField):
+        valid = _is_string(value)
+    elif isinstance(field, ArrayField):
+        valid = isinstance(value, (list, tuple)) and \
+            len(value) == field.count and \
+            all(isinstance(item, numbers.Integral) for item in value)
+    else:
+        valid = isinstance(value, numbers.Integral)
+
+    if not valid:
+        raise PatchError("Invalid value {!r} for data flash field {}.".format(
+            value, name))
+
+
+class DataFlashPatch(object):
+    """Field level changes to a data flash.
+
+    A patch is stored as JSON:
+        {"format": "evic-dataflash-patch", "version": 1,
+         "product_id": "E052", "fields": {"bootflag": 0, "power": 400}}
+
+    Attributes:
+        fields: An OrderedDict mapping DataFlash field names to new values.
+        product_id: Product ID the patch applies to or None for any device.
+    """
+
+    def __init__(self, fields=None, product_id=None):
+        if product_id is not None and not _is_string(product_id):
+            raise PatchError("Invalid product ID {!r}.".format(product_id))
+        self.product_id = product_id
+        self.fields = OrderedDict()
+        for name, value in (fields or {}).items():
+            if name not in DataFlash.fields:
+                raise PatchError("Unknown data flash field {}.".format(name))
+            _check_value(name, value)
+            self.fields[name] = tuple(value) if isinstance(value, list) \
+                else value
+
+    def __len__(self):
+        return len(self.fields)
+
+    @classmethod
+    def diff(cls, old, new, ignore=UNIQUE_FIELDS):
+        """Creates a patch changing one data flash into another.
+
+        Only the fields of the DataFlash schema are compared. The patch
+        applies to devices with the product ID of the original.
+
+        Args:
+            old: The original DataFlash object.
+            new: The changed DataFlash object.
+            ignore: Names of the fields left out of the patch.
+
+        Returns:
+            A DataFlashPatch object.
+        """
+
+        old_settings = old.settings()
+        return cls(OrderedDict(
+            (name, value) for name, value in new.settings().items()
+            if old_settings[name] != value and name not in ignore),
+            old_settings['product_id'])
+
+    def apply(self, dataflash):
+        """Applies the patch to a data flash.
+
+        Args:
+            dataflash: DataFlash object. Its checksum is kept up to date.
+
+        Returns:
+            True if the data flash changed.
+
+        Raises:
+            PatchError: The patch is for another product or a value doesn't
+                        fit in its field.
+        """
+
+        if self.product_id is not None and \
+                dataflash.product_id != self.product_id:
+            raise PatchError("Patch is for product ID {}, not {}.".format(
+                self.product_id, dataflash.product_id))
+
+        try:
+            dataflash.update(self.fields)
+        except ValueError as error:
+            raise PatchError(str(error))
+
+        return dataflash.changed
+
+    def dumps(self):
+        """Returns the patch as a JSON string."""
+
+        patch = OrderedDict([('format', PATCH_FORMAT),
+                             ('version', PATCH_VERSION)])
+        if self.product_id is not None:
+            patch['product_id'] = self.product_id
+        patch['fields'] = self.fields
+
+        return json.dumps(patch, indent=2)
+
+    @classmethod
+    def loads(cls, text):
+        """Creates a patch from a JSON string.
+
+        Raises:
+            PatchError: The string is not a valid patch.
+        """
+
+        try:
+            patch = json.loads(text, object_pairs_hook=OrderedDict)
+        except ValueError as error:
+            raise PatchError("Invalid patch: {}".format(error))
+
+        if not isinstance(patch, dict) or \
+                patch.get('format') != PATCH_FORMAT or \
+                not isinstance(patch.get('fields'), dict):
+            raise PatchError("Not a data flash patch.")
+        if patch.get('version') != PATCH_VERSION:
+            raise PatchError("Unsupported patch version.")
+
+        return cls(patch['fields'], patch.get('product_id'))
+
+
+def apply_to_file(patch, inputpath, outputpath=None):
+    """Applies a patch to a data flash file.
+
+    Files with the checksum in front of the data (2048 bytes) are verified
+    and get their checksum updated.
+
+    Args:
+        patch: DataFlashPatch object.
+        inputpath: Path of the data flash file.
+        outputpath: Path of the patched file. Defaults to inputpath.
+
+    Returns:
+        True if the data flash changed.
+
+    Raises:
+        DataFlashError: The checksum in the file is wrong.
+        PatchError: The patch can't be applied to the data flash.
+    """
+
+    with open(inputpath, 'rb') as dataflashfile:
+        buf = bytearray(dataflashfile.read())
+
+    # Skip the checksum if the file has one
+    dataflash = DataFlash(buf, 4 if len(buf) == 2048 else 0)
+    if dataflash.start_offset:
+        dataflash.verify(struct.unpack_from('=I', buf, 0)[0])
+    changed = patch.apply(dataflash)
+    if dataflash.start_offset:
+        struct.pack_into('=I', buf, 0, dataflash.checksum)
+
+    if changed or (outputpath and outputpath != inputpath):
+        with open(outputpath or inputpath, 'wb') as dataflashfile:
+            dataflashfile.write(buf)
+
+    return changed
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import io
+import os
+import json
+import stat
+import socket
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import evic
+from . import cli
+from .client import encode, decode
+
+
+class DeviceSession(object):
+    """An open device and its cached data flash.
+
+    Attributes:
+        dev: The evic.HIDTransfer object.
+        lock: Lock serializing the requests to the device.
+    """
+
+    def __init__(self, serial, backend=None):
+        self.dev = evic.HIDTransfer(serial=serial, backend=backend)
+        self.lock = threading.Lock()
+        self._connected = False
+        self._dataflash = None
+
+    def connect(self):
+        """Connects the device unless it's already connected."""
+
+        if not self._connected:
+            self.dev.connect()
+            self._connected = True
+
+    def close(self):
+        """Closes the device and drops the cached data flash."""
+
+        if self._connected:
+            self.dev.close()
+        self._connected = False
+        self._dataflash = None
+
+    def read_dataflash(self):
+        """Returns the data flash, reading it from the device if needed.
+
+        Returns:
+            A tuple containing a copy of the data flash, its checksum and a
+            Boolean set to True if it came from the cache.
+        """
+
+        cached = self._dataflash is not None
+        if not cached:
+            self.connect()
+            self._dataflash = self.dev.read_dataflash()
+
+        dataflash, checksum = self._dataflash
+        return (evic.DataFlash(bytearray(dataflash.array), 0), checksum,
+                cached)
+
+    def invalidate(self):
+        """Drops the cached data flash after the device has changed."""
+
+        self._dataflash = None
+
+
+class SessionServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    """Serves device requests over a Unix socket.
+
+    Every connection carries one JSON request on a single line and gets
+    one JSON response. Binary data is base64 encoded.
+
+    Attributes:
+        backend: Backend for evic.HIDTransfer.
+        journal: evic.FlashJournal used for the uploads.
+        backup: True to back up the data flash read from the devices.
+        sessions: A dictionary of DeviceSession objects by serial number.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, backend=None, journal=None, backup=False):
+        if os.path.exists(path):
+            self._remove_stale(path)
+        socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+        self.backend = backend
+        self.journal = journal or cli.open_journal()
+        self.backup = backup
+        self.sessions = {}
+        self._sessions_lock = threading.Lock()
+
+    @staticmethod
+    def _remove_stale(path):
+        """Removes the socket of a server that is no longer running.
+
+        Raises:
+            IOError: The path is not a socket or a server answers on it.
+        """
+
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise IOError("{} is not a socket.".format(path))
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.remove(path)
+            return
+        finally:
+            probe.close()
+
+        raise IOError("A server is already running on {}.".format(path))
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        for session in self.sessions.values():
+            session.close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+    def session(self, serial=None):
+        """Returns the session of a device, opening one if needed.
+
+        Args:
+            serial: Serial number of the device. Defaults to the first
+                    attached device.
+
+        Raises:
+            IOError: No devices are attached.
+        """
+
+        if serial is None:
+            devices = evic.HIDTransfer.enumerate(self.backend)
+            if not devices:
+                raise IOError("No devices found.")
+            serial = devices[0].serial
+
+        with self._sessions_lock:
+            if serial not in self.sessions:
+                self.sessions[serial] = DeviceSession(serial, self.backend)
+            return self.sessions[serial]
+
+    def handle_command(self, args):
+        """Runs a request.
+
+        Args:
+            args: A dictionary containing the command and its arguments.
+
+        Returns:
+            A dictionary containing the response.
+        """
+
+        command = args.get('command')
+        if command == 'list':
+            return {'devices': [
+                {'serial': device.serial, 'product': device.product}
+                for device in evic.HIDTransfer.enumerate(self.backend)]}
+
+        handler = self.commands.get(command)
+        if handler is None:
+            raise ValueError("Unknown command {}.".format(command))
+
+        session = self.session(args.get('serial'))
+        with session.lock:
+            try:
+                return handler(self, session, args)
+            except IOError:
+                # Reopen the device on the next request
+                session.close()
+                raise
+
+    def _read_dataflash(self, session):
+        """Reads the data flash of a session, backing up fresh reads."""
+
+        dataflash, checksum, cached = session.read_dataflash()
+        if self.backup and not cached and session.dev.serial:
+            cli.backup_dataflash(session.dev.serial, dataflash)
+
+        return dataflash, checksum, cached
+
+    def _info(self, session, args):
+        dataflash, _, cached = self._read_dataflash(session)
+        device_info = cli.get_device_info(dataflash)
+        return {'serial': session.dev.serial,
+                'manufacturer': session.dev.manufacturer,
+                'product': session.dev.product,
+                'name': device_info.name,
+                'product_id': dataflash.product_id,
+                'fw_version': dataflash.fw_version,
+                'hw_version': dataflash.hw_version,
+                'ldrom': session.dev.ldrom,
+                'cached': cached}
+
+    def _dump_dataflash(self, session, args):
+        dataflash, checksum, cached = self._read_dataflash(session)
+        if args.get('verify', True):
+            dataflash.verify(checksum)
+        return {'dataflash': encode(dataflash.array), 'cached': cached}
+
+    def _reset_dataflash(self, session, args):
+        session.connect()
+        session.invalidate()
+        session.dev.reset_dataflash()
+        return {}
+
+    def _upload(self, session, args):
+        aprom = evic.APROM(decode(args['aprom']))
+        if args.get('encrypted', True):
+            aprom = evic.APROM(aprom.convert())
+        dataflashbuf = decode(args['dataflash']) if args.get('dataflash') \
+            else None
+
+        noverify = args.get('noverify', [])
+        dataflash, checksum, _ = self._read_dataflash(session)
+        if 'dataflash' not in noverify:
+            dataflash.verify(checksum)
+        session.invalidate()
+        skipped = cli.flash_aprom(session.dev, dataflash, aprom, dataflashbuf,
+                                  noverify, self.journal,
+                                  args.get('delta', False),
+                                  args.get('ifchanged', False))
+        return {'skipped': skipped}
+
+    def _upload_logo(self, session, args):
+        dataflash, checksum, _ = self._read_dataflash(session)
+        if args.get('verify', True):
+            dataflash.verify(checksum)
+
+        logo = cli.logo_from_image(io.BytesIO(bytes(decode(args['logo']))),
+                                   args.get('invert', False),
+                                   cli.get_device_info(dataflash))
+        session.invalidate()
+        cli.flash_logo(session.dev, dataflash, logo, self.journal)
+        return {}
+
+    commands = {
+        'info': _info,
+        'dump-dataflash': _dump_dataflash,
+        'reset-dataflash': _reset_dataflash,
+        'upload': _upload,
+        'upload-logo': _upload_logo,
+    }
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        # Probed by another server checking if this one is running
+        if not line:
+            return
+
+        try:
+            args = json.loads(line.decode('utf-8'))
+            response = self.server.handle_command(args)
+            response['ok'] = True
+        except (IOError, ValueError, KeyError, TypeError, evic.APROMError,
+                evic.DataFlashError, evic.LogoConversionError) as error:
+            response = {'ok': False, 'error': str(error)}
+
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
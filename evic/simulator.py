@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import random
+import struct
+import threading
+
+from .dataflash import DataFlash
+from .device import HIDTransfer
+
+
+class SimulatedUnit(object):
+    """State of a simulated device.
+
+    The unit boots to LDROM when it's reset with the boot flag set and
+    clears the flag while booting.
+
+    Attributes:
+        serial: Serial number string.
+        dataflash: A bytearray containing the data flash (without checksum).
+        factory_dataflash: Data flash contents restored by a data flash
+                           reset.
+        flash: A bytearray containing the flash memory.
+        ldrom: True if the unit is booted to LDROM.
+        ldrom_version: LDROM version reported in the data flash while
+                       booted to LDROM.
+        resets: Number of times the unit has been reset.
+        available_at: Time when the unit is attached again after a reset.
+    """
+
+    def __init__(self, serial='SIM0000000', product_id='E052',
+                 hw_version=106, fw_version=303, flash_size=256 * 1024):
+        self.serial = serial
+        self.dataflash = bytearray(2044)
+        dataflash = DataFlash(self.dataflash, 0)
+        dataflash.hw_version = hw_version
+        dataflash.product_id = product_id
+        dataflash.fw_version = fw_version
+        self.factory_dataflash = bytearray(self.dataflash)
+        self.flash = bytearray(b'\xff' * flash_size)
+        self.ldrom = False
+        self.ldrom_version = 100
+        self.resets = 0
+        self.available_at = 0
+
+    @property
+    def path(self):
+        """HID path of the unit. Changes every time the unit restarts."""
+
+        return "sim:{}:{}".format(self.serial, self.resets).encode()
+
+    def attached(self):
+        """Checks if the unit is attached to the bus."""
+
+        return time.time() >= self.available_at
+
+    def reset(self, delay):
+        """Restarts the unit.
+
+        Args:
+            delay: Seconds the unit stays detached.
+        """
+
+        self.resets += 1
+        self.available_at = time.time() + delay
+
+        # Boot to LDROM if requested, the flag is cleared on boot
+        self.ldrom = self.dataflash[9] == 1
+        self.dataflash[9] = 0
+
+    def read_dataflash(self):
+        """Returns the data flash transfer: checksum followed by the data."""
+
+        data = bytearray(self.dataflash)
+        ldrom_version = self.ldrom_version if self.ldrom else 0
+        struct.pack_into('=I', data, 260, ldrom_version)
+
+        return bytearray(struct.pack('=I', sum(data))) + data
+
+
+class SimulatedDevice(object):
+    """Stand-in for hid.device implementing the Nuvoton LDROM protocol.
+
+    Supported commands are 0x35 (read data flash), 0x53 (write data flash),
+    0xC3 (write flash), 0x7C (reset data flash) and 0xB4 (reset). A
+    partially received write keeps waiting for the rest of its data when
+    the device is opened again, unless the bus abandons transfers.
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.unit = None
+        self._last_unit = None
+        self._resets = 0
+        self._command = None
+        self._pending = bytearray()
+        self._expected = 0
+        self._readbuf = bytearray()
+
+    def _check_open(self):
+        if self.unit is None or not self.unit.attached() or \
+                self.unit.resets != self._resets:
+            raise IOError("Device disconnected.")
+
+    def _open(self, unit):
+        if unit is None or not unit.attached():
+            raise IOError("open failed")
+        # A restarted unit has forgotten the transfer
+        if self.bus.abandon_transfers or unit is not self._last_unit or \
+                unit.resets != self._resets:
+            self._command = None
+        self.unit = unit
+        self._last_unit = unit
+        self._resets = unit.resets
+        self._readbuf = bytearray()
+
+    def open(self, vendor_id, product_id):
+        self._open(next((unit for unit in self.bus.units
+                         if unit.attached()), None))
+
+    def open_path(self, path):
+        self._open(next((unit for unit in self.bus.units
+                         if unit.path == path), None))
+
+    def close(self):
+        self.unit = None
+
+    def get_manufacturer_string(self):
+        return "Nuvoton"
+
+    def get_product_string(self):
+        return "HID Transfer"
+
+    def get_serial_number_string(self):
+        return self.unit.serial
+
+    def write(self, buf):
+        time.sleep(self.bus.latency)
+        try:
+            self._check_open()
+        except IOError:
+            return -1
+
+        # The report is lost
+        if self.bus.write_fault():
+            return -1
+
+        # The first byte is the report number
+        payload = bytearray(buf[1:])
+        with self.bus.lock:
+            if self._command is not None:
+                self._receive(payload)
+            else:
+                self._execute(payload)
+
+        return len(buf)
+
+    def read(self, length):
+        time.sleep(self.bus.latency)
+        self._check_open()
+
+        report = self._readbuf[:min(length, 64)]
+        del self._readbuf[:len(report)]
+
+        return list(report)
+
+    def _execute(self, payload):
+        """Executes a HID command."""
+
+        cmd = payload[:18]
+        if len(cmd) != 18 or cmd[10:14] != HIDTransfer.hid_signature or \
+                struct.unpack('=I', bytes(cmd[14:18]))[0] != sum(cmd[:14]):
+            return
+        cmdcode = cmd[0]
+        arg1, arg2 = struct.unpack('=II', bytes(cmd[2:10]))
+        unit = self.unit
+
+        if cmdcode == 0x35:
+            self._readbuf = unit.read_dataflash()[arg1:arg1 + arg2]
+        elif cmdcode in (0x53, 0xC3):
+            self._command = (cmdcode, arg1)
+            self._expected = arg2
+            self._pending = bytearray()
+        elif cmdcode == 0x7C:
+            unit.dataflash[:] = unit.factory_dataflash
+        elif cmdcode == 0xB4:
+            unit.reset(self.bus.reset_delay)
+
+    def _receive(self, payload):
+        """Receives the data following a write command."""
+
+        cmdcode, start = self._command
+        data = payload[:self._expected - len(self._pending)]
+
+        # Flash is programmed as the data arrives
+        if cmdcode == 0xC3:
+            address = start + len(self._pending)
+            self.unit.flash[address:address + len(data)] = data
+
+        self._pending += data
+        if len(self._pending) < self._expected:
+            return
+
+        self._command = None
+        if cmdcode == 0x53:
+            checksum = struct.unpack('=I', bytes(self._pending[0:4]))[0]
+            if checksum == sum(self._pending[4:]):
+                self.unit.dataflash[:] = self._pending[4:]
+
+
+class SimulatedHID(object):
+    """Stand-in for the hid module with simulated devices.
+
+    Usable as the backend of HIDTransfer.
+
+    Attributes:
+        units: A list of SimulatedUnit objects attached to the bus.
+        latency: Seconds spent on every report read or written.
+        reset_delay: Seconds a unit stays detached after a reset.
+        fault_rate: Probability of losing a written report.
+        abandon_transfers: True to drop a partially received write when a
+                           device is opened again.
+        lock: Lock serializing the protocol handling of all units.
+    """
+
+    def __init__(self, units=None, latency=0.0, reset_delay=0.5,
+                 fault_rate=0.0, seed=None, abandon_transfers=False):
+        self.units = units if units is not None else [SimulatedUnit()]
+        self.latency = latency
+        self.reset_delay = reset_delay
+        self.fault_rate = fault_rate
+        self.abandon_transfers = abandon_transfers
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._faults = []
+
+    def fail_writes(self, count, after=0):
+        """Loses written reports.
+
+        Args:
+            count: Number of consecutive reports to lose.
+            after: Number of reports to write successfully first.
+        """
+
+        with self.lock:
+            self._faults = [False] * after + [True] * count
+
+    def write_fault(self):
+        """Decides whether the next written report is lost."""
+
+        with self.lock:
+            if self._faults:
+                return self._faults.pop(0)
+            return self._random.random() < self.fault_rate
+
+    def device(self):
+        """Returns a new simulated hid.device."""
+
+        return SimulatedDevice(self)
+
+    def enumerate(self, vendor_id=0, product_id=0):
+        """Lists the attached units like hid.enumerate."""
+
+        return [{'path': unit.path,
+                 'vendor_id': HIDTransfer.vid,
+                 'product_id': HIDTransfer.pid,
+                 'serial_number': unit.serial,
+                 'manufacturer_string': "Nuvoton",
+                 'product_string': "HID Transfer"}
+                for unit in self.units if unit.attached()]
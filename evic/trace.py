@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import time
+import struct
+import threading
+from collections import namedtuple, OrderedDict
+
+# A trace starts with the magic bytes and a version byte, followed by
+# records. A record is a header (kind, start time in seconds since the start
+# of the trace, duration, result and data length) followed by the data.
+MAGIC = b'EVTR'
+VERSION = 1
+
+# Record kinds
+ENUMERATE = 1
+OPEN = 2
+CLOSE = 3
+STRING = 4
+WRITE = 5
+READ = 6
+
+KIND_NAMES = {ENUMERATE: 'enumerate', OPEN: 'open', CLOSE: 'close',
+              STRING: 'string', WRITE: 'write', READ: 'read'}
+
+_HEADER = struct.Struct('<BdfiH')
+
+TraceRecord = namedtuple('TraceRecord', 'kind time duration result data')
+
+TraceSummary = namedtuple('TraceSummary', 'kind count nbytes seconds')
+
+
+class TraceError(IOError):
+    """The trace is invalid or doesn't match the replayed traffic."""
+
+    pass
+
+
+class TraceWriter(object):
+    """Writes trace records to a binary file.
+
+    Attributes:
+        start: Time the trace started.
+    """
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._lock = threading.Lock()
+        self.start = time.time()
+        self._file.write(MAGIC + struct.pack('<B', VERSION))
+
+    def write(self, kind, start, result, data=b''):
+        """Appends a record.
+
+        Args:
+            kind: Record kind.
+            start: Time the call started.
+            result: Integer result of the call.
+            data: The data written, read or returned by the call.
+        """
+
+        now = time.time()
+        data = bytes(data)
+        with self._lock:
+            self._file.write(_HEADER.pack(kind, start - self.start,
+                                          now - start, result, len(data)))
+            self._file.write(data)
+
+
+def read_trace(fileobj):
+    """Reads the records of a trace.
+
+    Args:
+        fileobj: Binary file object.
+
+    Returns:
+        An iterator of TraceRecord tuples.
+
+    Raises:
+        TraceError: The file is not a trace.
+    """
+
+    if fileobj.read(len(MAGIC)) != MAGIC:
+        raise TraceError("Not a trace file.")
+    version = bytearray(fileobj.read(1))
+    if not version or version[0] != VERSION:
+        raise TraceError("Unsupported trace version.")
+
+    while True:
+        header = fileobj.read(_HEADER.size)
+        if not header:
+            break
+        if len(header) != _HEADER.size:
+            raise TraceError("Truncated trace.")
+        kind, start, duration, result, length = _HEADER.unpack(header)
+        data = fileobj.read(length)
+        if len(data) != length:
+            raise TraceError("Truncated trace.")
+        yield TraceRecord(kind, start, duration, result, data)
+
+
+def summarize(records):
+    """Sums the records of a trace per kind.
+
+    Args:
+        records: An iterable of TraceRecord tuples.
+
+    Returns:
+        A list of TraceSummary tuples.
+    """
+
+    totals = OrderedDict()
+    for record in records:
+        total = totals.setdefault(record.kind, [0, 0, 0.0])
+        total[0] += 1
+        total[1] += len(record.data)
+        total[2] += record.duration
+
+    return [TraceSummary(KIND_NAMES.get(kind, str(kind)), *total)
+            for kind, total in totals.items()]
+
+
+def _encode_devices(devices):
+    return json.dumps([dict((key, value.decode('latin-1')
+                             if isinstance(value, bytes) else value)
+                            for key, value in device.items())
+                       for device in devices]).encode('utf-8')
+
+
+def _decode_devices(data):
+    devices = json.loads(data.decode('utf-8'))
+    for device in devices:
+        device['path'] = device['path'].encode('latin-1')
+    return devices
+
+
+class RecordingDevice(object):
+    """hid.device wrapper recording the traffic."""
+
+    def __init__(self, device, trace):
+        self._device = device
+        self._trace = trace
+
+    def _call(self, kind, func, *args):
+        start = time.time()
+        try:
+            result = func(*args)
+        except IOError as error:
+            self._trace.write(kind, start, -1, str(error).encode('utf-8'))
+            raise
+        return start, result
+
+    def open(self, vendor_id, product_id):
+        start, _ = self._call(OPEN, self._device.open, vendor_id, product_id)
+        self._trace.write(OPEN, start, 0)
+
+    def open_path(self, path):
+        start, _ = self._call(OPEN, self._device.open_path, path)
+        self._trace.write(OPEN, start, 0, path)
+
+    def close(self):
+        start, _ = self._call(CLOSE, self._device.close)
+        self._trace.write(CLOSE, start, 0)
+
+    def _string(self, func):
+        start, string = self._call(STRING, func)
+        self._trace.write(STRING, start, 0, string.encode('utf-8'))
+        return string
+
+    def get_manufacturer_string(self):
+        return self._string(self._device.get_manufacturer_string)
+
+    def get_product_string(self):
+        return self._string(self._device.get_product_string)
+
+    def get_serial_number_string(self):
+        return self._string(self._device.get_serial_number_string)
+
+    def write(self, buf):
+        start, result = self._call(WRITE, self._device.write, buf)
+        self._trace.write(WRITE, start, result, buf)
+        return result
+
+    def read(self, length):
+        start, report = self._call(READ, self._device.read, length)
+        self._trace.write(READ, start, length, bytearray(report))
+        return report
+
+
+class RecordingHID(object):
+    """Backend for HIDTransfer recording the traffic of another backend.
+
+    Attributes:
+        backend: The recorded backend.
+        trace: The TraceWriter receiving the records.
+    """
+
+    def __init__(self, backend, fileobj):
+        self.backend = backend
+        self.trace = TraceWriter(fileobj)
+
+    def device(self):
+        """Returns a new recording hid.device."""
+
+        return RecordingDevice(self.backend.device(), self.trace)
+
+    def enumerate(self, vendor_id=0, product_id=0):
+        """Lists the attached devices like hid.enumerate."""
+
+        start = time.time()
+        devices = self.backend.enumerate(vendor_id, product_id)
+        self.trace.write(ENUMERATE, start, len(devices),
+                         _encode_devices(devices))
+        return devices
+
+
+class ReplayDevice(object):
+    """hid.device stand-in answering from a trace."""
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def _result(self, record):
+        if record.result < 0 and record.kind != WRITE:
+            raise IOError(record.data.decode('utf-8'))
+        return record
+
+    def open(self, vendor_id, product_id):
+        self._result(self.bus.next(OPEN))
+
+    def open_path(self, path):
+        self._result(self.bus.next(OPEN, path))
+
+    def close(self):
+        self._result(self.bus.next(CLOSE))
+
+    def _string(self):
+        return self._result(self.bus.next(STRING)).data.decode('utf-8')
+
+    def get_manufacturer_string(self):
+        return self._string()
+
+    def get_product_string(self):
+        return self._string()
+
+    def get_serial_number_string(self):
+        return self._string()
+
+    def write(self, buf):
+        return self._result(self.bus.next(WRITE, buf)).result
+
+    def read(self, length):
+        return list(bytearray(self._result(self.bus.next(READ)).data))
+
+
+class ReplayHID(object):
+    """Backend for HIDTransfer replaying a trace.
+
+    The calls must arrive in the recorded order. Written reports and
+    opened paths are compared with the trace.
+
+    Attributes:
+        records: A list of the TraceRecord tuples to replay.
+        position: Index of the next record.
+        realtime: True to take as long as the recorded calls did.
+    """
+
+    def __init__(self, fileobj, realtime=False):
+        self.records = list(read_trace(fileobj))
+        self.position = 0
+        self.realtime = realtime
+        self._lock = threading.Lock()
+
+    def next(self, kind, data=None):
+        """Returns the next record.
+
+        Args:
+            kind: Expected record kind.
+            data: Expected data or None to skip the comparison.
+
+        Raises:
+            TraceError: The call doesn't match the trace.
+        """
+
+        with self._lock:
+            if self.position >= len(self.records):
+                raise TraceError("Trace ended before {}.".format(
+                    KIND_NAMES[kind]))
+            record = self.records[self.position]
+            if record.kind != kind:
+                raise TraceError("Expected {} at record {}, got {}.".format(
+                    KIND_NAMES.get(record.kind), self.position,
+                    KIND_NAMES[kind]))
+            if data is not None and record.result >= 0 and \
+                    bytes(bytearray(data)) != record.data:
+                raise TraceError("Data of record {} ({}) differs.".format(
+                    self.position, KIND_NAMES[kind]))
+            self.position += 1
+
+        if self.realtime:
+            time.sleep(record.duration)
+
+        return record
+
+    def device(self):
+        """Returns a new replaying hid.device."""
+
+        return ReplayDevice(self)
+
+    def enumerate(self, vendor_id=0, product_id=0):
+        """Lists the devices recorded by hid.enumerate."""
+
+        return _decode_devices(self.next(ENUMERATE).data)
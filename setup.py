@@ -63,11 +63,13 @@ setup(
     ],
     extras_require={
         'USB':  ['hidapi>=0.7.99'],
+        'NumPy': ['numpy'],
     },
     entry_points={
         'console_scripts': [
             'evic-convert=evic.cli:convert',
             'evic=evic.cli:main',
-            'evic-usb=evic.cli:usb [USB]'],
+            'evic-usb=evic.cli:usb [USB]',
+            'evic-client=evic.client:main'],
     },
 )
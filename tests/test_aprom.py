@@ -17,11 +17,18 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import io
+
 import pytest
 
 import evic
 
 
+def reference_convert(data):
+    return bytearray((b ^ evic.APROM._genfun(len(data), i)) & 0xFF
+                     for i, b in enumerate(data))
+
+
 class TestAPROM:
 
     def test_aprom_convert(self):
@@ -32,6 +39,25 @@ class TestAPROM:
 
             assert aprom_data == aprom_unencrypted.convert()
 
+    @pytest.mark.parametrize('size', [0, 1, 255, 256, 12028, 408377])
+    def test_aprom_convert_matches_genfun(self, size):
+        data = bytearray((i * 7) & 0xFF for i in range(size))
+
+        assert evic.APROM(data).convert() == reference_convert(data)
+
+    def test_aprom_convert_without_numpy(self, monkeypatch):
+        data = bytearray((i * 7) & 0xFF for i in range(12028))
+        monkeypatch.setattr(evic.aprom, '_numpy', False)
+
+        assert evic.aprom.numpy_module() is None
+        assert evic.APROM(data).convert() == reference_convert(data)
+
+    def test_aprom_keystream_offset(self):
+        keystream = evic.APROM.keystream(12028)
+
+        assert evic.APROM.keystream(12028, 1000, 500) == \
+            keystream[1000:1500]
+
     def test_aprom_verify(self):
         with open("testdata/helloworld.bin", "rb") as apromfile:
             aprom = evic.APROM(apromfile.read())
@@ -42,3 +68,70 @@ class TestAPROM:
             with pytest.raises(evic.APROMError):
                 aprom_unencrypted.verify(['W007'], 106)
                 aprom_unencrypted.verify(['E052'], 999)
+
+    def test_aprom_scan(self):
+        with open("testdata/helloworld.bin", "rb") as apromfile:
+            aprom = evic.APROM(evic.APROM(apromfile.read()).convert())
+
+            info = aprom.scan()
+            assert info.manufacturer
+            assert 'E052' in info.product_ids
+            assert 'W007' not in info.product_ids
+            id_ind, max_hw_version = info.product_ids['E052']
+            assert aprom.data[id_ind:id_ind+4] == b'E052'
+
+            # The scan result is reused
+            assert aprom.scan() is info
+            aprom.verify(['W007', 'E052'], max_hw_version)
+            with pytest.raises(evic.APROMError):
+                aprom.verify(['E052'], max_hw_version + 1)
+
+    def test_aprom_convert_file(self, tmpdir):
+        with open("testdata/helloworld.bin", "rb") as apromfile:
+            aprom_data = apromfile.read()
+
+        outpath = str(tmpdir.join("out.bin"))
+        with open("testdata/helloworld.bin", "rb") as apromfile:
+            with open(outpath, "wb") as outfile:
+                assert evic.aprom.convert_file(apromfile, outfile, 1000) == \
+                    len(aprom_data)
+
+        with open(outpath, "rb") as outfile:
+            assert outfile.read() == evic.APROM(aprom_data).convert()
+
+        # Files that can't be memory mapped
+        output = io.BytesIO()
+        evic.aprom.convert_file(io.BytesIO(aprom_data), output)
+        assert output.getvalue() == evic.APROM(aprom_data).convert()
+
+
+class TestKeystreamCache:
+
+    def test_keystream_cache_hits(self):
+        cache = evic.aprom.KeystreamCache()
+
+        assert cache.get(12028) == evic.APROM.keystream(12028)
+        assert cache.get(12028) == evic.APROM.keystream(12028)
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert cache.nbytes == 12028
+
+    def test_keystream_cache_limit(self):
+        cache = evic.aprom.KeystreamCache(max_bytes=3000)
+
+        cache.get(1000)
+        cache.get(2000)
+        cache.get(1000)
+        cache.get(1500)
+
+        # The least recently used keystream was evicted
+        assert len(cache) == 2
+        assert cache.nbytes == 2500
+        cache.get(2000)
+        assert cache.misses == 4
+
+        # Too large to cache
+        cache.get(4000)
+        assert cache.nbytes <= 3000
+
+        cache.resize(0)
+        assert len(cache) == 0
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import pytest
+
+import evic
+from evic.archive import DataFlashArchive, parse_condition
+
+
+def make_dumps():
+    with open("testdata/test_dataflash.bin", "rb") as dataflashfile:
+        data = bytearray(dataflashfile.read())
+
+    dumps = []
+    for index, (product_id, hw_version, fw_version) in enumerate([
+            ("E052", 106, 300), ("E052", 108, 302), ("W007", 108, 302),
+            ("E052", 111, 303), ("E052", 103, 300)]):
+        dataflash = evic.DataFlash(bytearray(data), 0)
+        dataflash.update({'product_id': product_id,
+                          'hw_version': hw_version,
+                          'fw_version': fw_version})
+        dumps.append(("SN{}".format(index % 4), dataflash, 1000.0 + index))
+
+    return dumps
+
+
+class TestArchive:
+
+    def test_archive_records(self, tmpdir):
+        path = str(tmpdir.join('archive.evda'))
+        dumps = make_dumps()
+        archive = DataFlashArchive(path)
+        archive.extend(dumps[0:4])
+        archive.close()
+
+        archive = DataFlashArchive(path)
+        archive.append(*dumps[4])
+        assert len(archive) == 5
+        records = list(archive.records())
+        assert [record.serial for record in records] == \
+            ["SN0", "SN1", "SN2", "SN3", "SN0"]
+        assert records[2].time == 1002.0
+        assert records[2].dataflash.settings() == dumps[2][1].settings()
+        assert archive.dataflash(3).array == dumps[3][1].array
+
+        # Serial numbers aren't truncated
+        with pytest.raises(ValueError):
+            archive.extend([dumps[0], ("S" * 17,) + dumps[1][1:]])
+        assert len(archive) == 5
+        archive.close()
+
+        with open(path, 'r+b') as archivefile:
+            archivefile.write(b'XXXX')
+        with pytest.raises(evic.archive.ArchiveError):
+            DataFlashArchive(path)
+
+    def test_archive_query(self, tmpdir):
+        pytest.importorskip('numpy')
+        archive = DataFlashArchive(str(tmpdir.join('archive.evda')))
+        assert len(archive.select()) == 0
+        archive.extend(make_dumps())
+
+        conditions = [parse_condition(condition) for condition in
+                      ["product_id==E052", "hw_version>106",
+                       "fw_version<303"]]
+        assert list(archive.select(conditions)) == [1]
+        assert list(archive.select(latest=True)) == [1, 2, 3, 4]
+        assert list(archive.select([('hw_version', '<', 108)],
+                                   latest=True)) == [4]
+        assert archive.count_by('product_id') == [("E052", 4), ("W007", 1)]
+        assert archive.count_by('fw_version', [0, 1, 4]) == [(300, 2),
+                                                             (302, 1)]
+        assert list(archive.table()['temp_coefs_ni'][0][0:3]) == [10, 20, 35]
+        archive.close()
+
+        with pytest.raises(ValueError):
+            parse_condition("temp_coefs_ni>1")
+        with pytest.raises(ValueError):
+            parse_condition("hw_version~1")
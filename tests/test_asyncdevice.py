@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import asyncio
+
+import pytest
+
+import evic
+from evic.asyncdevice import AsyncHIDTransfer
+
+
+class SlowTransfer(object):
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.calls = []
+
+    def connect(self):
+        time.sleep(0.2)
+        self.calls.append('connect')
+
+    def read_dataflash(self):
+        time.sleep(0.2)
+        self.calls.append('read_dataflash')
+        return (None, 0)
+
+
+class TestAsyncHIDTransfer:
+
+    def test_async_devices_run_concurrently(self):
+        devices = [AsyncHIDTransfer(SlowTransfer(str(i)))
+                   for i in range(0, 8)]
+
+        async def run(dev):
+            await dev.connect()
+            return await dev.read_dataflash()
+
+        async def run_all():
+            return await asyncio.gather(*[run(dev) for dev in devices])
+
+        start = time.time()
+        results = asyncio.run(run_all())
+
+        assert time.time() - start < 1.0
+        assert results == [(None, 0)] * 8
+        assert devices[3].serial == '3'
+        assert devices[3].calls == ['connect', 'read_dataflash']
+
+    def test_async_restart(self):
+        bus = evic.SimulatedHID(reset_delay=0.1)
+        unit = bus.units[0]
+        dev = AsyncHIDTransfer(evic.HIDTransfer(backend=bus))
+        events = []
+        dev.listeners.append(events.append)
+
+        async def restart_to_ldrom():
+            await dev.connect()
+            dataflash, _ = await dev.read_dataflash()
+            dataflash.bootflag = 1
+            await dev.write_dataflash(dataflash)
+            return await dev.restart(delay=0, interval=0.01)
+
+        latency = asyncio.run(restart_to_ldrom())
+        assert 0.1 <= latency < 1
+        assert unit.ldrom and dev.ldrom
+        assert events[-1].event == 'reconnect'
+
+        # The same device can be used from another event loop
+        latency = asyncio.run(dev.restart(delay=0, interval=0.01,
+                                          ldrom=False))
+        assert latency == dev.reset_latency
+        assert not unit.ldrom and not dev.ldrom
+        assert unit.resets == 2
+
+    def test_async_reconnect_timeout(self):
+        bus = evic.SimulatedHID(reset_delay=10)
+        dev = AsyncHIDTransfer(evic.HIDTransfer(backend=bus))
+
+        async def restart():
+            await dev.connect()
+            await dev.restart(delay=0, interval=0.01, timeout=0.05,
+                              ldrom=False)
+
+        with pytest.raises(IOError) as error:
+            asyncio.run(restart())
+        assert "APROM" in str(error.value)
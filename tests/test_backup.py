@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+
+import pytest
+
+import evic
+
+
+class TestBackup:
+
+    def test_backup_capture_load(self, tmpdir):
+        with open("testdata/test_dataflash.bin", "rb") as dataflashfile:
+            data = bytearray(dataflashfile.read())
+        backups = evic.BackupStore(str(tmpdir.join('backups.sqlite')))
+
+        first = backups.capture("SN0", evic.DataFlash(data, 0), 1000.0)
+        # Unchanged data flash is not captured again
+        assert backups.capture("SN0", evic.DataFlash(data, 0)) == first
+
+        dataflashes = []
+        for power in range(100, 110):
+            dataflash = evic.DataFlash(bytearray(data), 0)
+            dataflash.power = power
+            backups.capture("SN{}".format(power % 2), dataflash)
+            dataflashes.append(dataflash)
+        # The same contents on another device are stored once
+        backups.capture("SN2", dataflashes[0])
+
+        stats = backups.stats()
+        assert stats.snapshots == 12
+        assert stats.objects == 11
+        # Near-identical data flashes compress against the baseline
+        assert stats.size < 11 * 100
+        assert [snapshot.serial for snapshot in backups.snapshots("SN1")] \
+            == ["SN1"] * 5
+        assert backups.snapshots(limit=1)[0].serial == "SN2"
+        assert backups.snapshots("SN0")[-1] == first
+        backups.close()
+
+        backups = evic.BackupStore(str(tmpdir.join('backups.sqlite')))
+        assert backups.load(first.id).array == data
+        snapshot = backups.snapshots("SN1")[0]
+        assert backups.load(snapshot.id).array == dataflashes[-1].array
+        assert snapshot.product_id == "E052"
+        assert snapshot.fw_version == 300
+        with pytest.raises(evic.BackupError):
+            backups.load(100)
+        backups.close()
+
+    def test_backup_concurrent_capture(self, tmpdir):
+        with open("testdata/test_dataflash.bin", "rb") as dataflashfile:
+            data = bytearray(dataflashfile.read())
+        path = str(tmpdir.join('backups.sqlite'))
+        evic.BackupStore(path).close()
+        errors = []
+
+        def capture(power):
+            dataflash = evic.DataFlash(bytearray(data), 0)
+            dataflash.power = power
+            backups = evic.BackupStore(path)
+            try:
+                backups.capture("SN{}".format(power), dataflash)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                backups.close()
+
+        threads = [threading.Thread(target=capture, args=(power,))
+                   for power in range(100, 108)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not errors
+        backups = evic.BackupStore(path)
+        assert backups.stats().snapshots == 8
+        for snapshot in backups.snapshots():
+            assert backups.load(snapshot.id).power == \
+                int(snapshot.serial[2:])
+        backups.close()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import evic
+
+
+class TestCatalog:
+
+    def test_catalog_update(self, tmpdir):
+        with open("testdata/helloworld.bin", "rb") as apromfile:
+            aprom_data = apromfile.read()
+
+        images = tmpdir.mkdir("images")
+        images.join("encrypted.bin").write_binary(aprom_data)
+        images.join("copy.bin").write_binary(aprom_data)
+        images.join("decrypted.bin").write_binary(
+            bytes(evic.APROM(aprom_data).convert()))
+        images.join("junk.bin").write_binary(b'\x00' * 100)
+
+        catalog = evic.Catalog(str(tmpdir.join("catalog.sqlite")))
+        update = catalog.update(str(images))
+        assert update.scanned == 3
+        assert update.unchanged == 1
+        assert len(catalog) == 4
+
+        # Nothing has changed
+        assert catalog.update(str(images)).unchanged == 4
+
+        images.join("copy.bin").remove()
+        assert catalog.update(str(images)).removed == 1
+        catalog.close()
+
+    def test_catalog_compatible(self, tmpdir):
+        with open("testdata/helloworld.bin", "rb") as apromfile:
+            aprom_data = apromfile.read()
+        aprom = evic.APROM(evic.APROM(aprom_data).convert())
+        max_hw_version = aprom.scan().product_ids['E052'][1]
+
+        images = tmpdir.mkdir("images")
+        images.join("helloworld.bin").write_binary(aprom_data)
+
+        catalog = evic.Catalog(str(tmpdir.join("catalog.sqlite")))
+        catalog.update(str(images))
+
+        path = str(images.join("helloworld.bin"))
+        assert catalog.compatible(['E052'], max_hw_version) == [path]
+        assert catalog.compatible(['W007', 'E052'], 106) == [path]
+        assert catalog.compatible(['E052'], max_hw_version + 1) == []
+        assert catalog.compatible(['W007'], 0) == []
+        catalog.close()
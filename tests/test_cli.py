@@ -17,8 +17,15 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
+import sys
+import subprocess
+
+import pytest
 from click.testing import CliRunner
+from PIL import Image
 
+import evic
 from evic import cli
 
 
@@ -45,3 +52,451 @@ class TestCli:
 
             with open('test_aprom2.bin', 'rb') as apromfile:
                 assert aprom_data == apromfile.read()
+
+            # Converting a file onto itself would destroy it
+            result = runner.invoke(cli.convert, ['test_aprom2.bin',
+                                                 '-o', './test_aprom2.bin'])
+            assert result.exit_code != 0
+            with open('test_aprom2.bin', 'rb') as apromfile:
+                assert aprom_data == apromfile.read()
+
+            result = runner.invoke(cli.convert, ['-', '-o', '-'],
+                                   input=aprom_data)
+            assert result.exit_code == 0
+            assert result.stdout_bytes == evic.APROM(aprom_data).convert()
+
+    def test_cli_convert_directory(self):
+        with open('testdata/helloworld.bin', 'rb') as apromfile:
+            aprom_data = apromfile.read()
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            os.mkdir('in')
+            for name in ['a.bin', 'b.bin', 'c.bin']:
+                with open(os.path.join('in', name), 'wb') as apromfile:
+                    apromfile.write(aprom_data)
+            os.chmod(os.path.join('in', 'b.bin'), 0o600)
+
+            result = runner.invoke(cli.convert, ['in', '-o', 'out', '-j', '2'])
+            assert result.exit_code == 0
+            assert "3 files" in result.output
+
+            result = runner.invoke(cli.convert, ['in', '-o', 'in'])
+            assert result.exit_code != 0
+            with open(os.path.join('in', 'a.bin'), 'rb') as apromfile:
+                assert aprom_data == apromfile.read()
+
+            result = runner.invoke(cli.convert, ['out/a.bin', 'out/b.bin',
+                                                 'out/c.bin', '-o', 'back'])
+            assert result.exit_code == 0
+
+            for name in ['a.bin', 'b.bin', 'c.bin']:
+                with open(os.path.join('back', name), 'rb') as apromfile:
+                    assert aprom_data == apromfile.read()
+            assert os.stat('back/b.bin').st_mode & 0o777 == 0o600
+
+    def test_cli_upload(self):
+        with open('testdata/helloworld.bin', 'rb') as apromfile:
+            aprom_data = apromfile.read()
+        bus = evic.SimulatedHID(reset_delay=0.1)
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            with open('test_aprom.bin', 'wb') as apromfile:
+                apromfile.write(aprom_data)
+
+            result = runner.invoke(cli.usb, ['upload', '--no-cache',
+                                             'test_aprom.bin'],
+                                   obj={'backend': bus},
+                                   env={'XDG_CONFIG_HOME': os.getcwd()})
+            assert result.exit_code == 0
+
+        aprom = evic.APROM(aprom_data).convert()
+        assert bus.units[0].flash[0:len(aprom)] == aprom
+        assert bus.units[0].resets == 1
+
+    def test_cli_upload_cache_error(self, monkeypatch):
+        with open('testdata/helloworld.bin', 'rb') as apromfile:
+            aprom_data = apromfile.read()
+        bus = evic.SimulatedHID(reset_delay=0.1)
+
+        def failing_load(self, data, encrypted=True):
+            raise OSError("No space left on device")
+        monkeypatch.setattr(evic.ImageCache, 'load', failing_load)
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            with open('test_aprom.bin', 'wb') as apromfile:
+                apromfile.write(aprom_data)
+
+            result = runner.invoke(cli.usb, ['upload', 'test_aprom.bin'],
+                                   obj={'backend': bus},
+                                   env={'XDG_CONFIG_HOME': os.getcwd()})
+            assert result.exit_code == 0
+            assert "Image cache failed" in result.output
+
+        aprom = evic.APROM(aprom_data).convert()
+        assert bus.units[0].flash[0:len(aprom)] == aprom
+
+    def test_cli_upload_all(self):
+        with open('testdata/helloworld.bin', 'rb') as apromfile:
+            aprom_data = apromfile.read()
+        bus = evic.SimulatedHID([evic.SimulatedUnit(str(i))
+                                 for i in range(0, 3)], reset_delay=0.1)
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            with open('test_aprom.bin', 'wb') as apromfile:
+                apromfile.write(aprom_data)
+
+            result = runner.invoke(cli.usb, ['upload', '--no-cache', '--all',
+                                             'test_aprom.bin'],
+                                   obj={'backend': bus},
+                                   env={'XDG_CONFIG_HOME': os.getcwd()})
+            assert result.exit_code == 0, result.output
+            assert "3 of 3 devices" in result.output
+
+        aprom = evic.APROM(aprom_data).convert()
+        for unit in bus.units:
+            assert unit.flash[0:len(aprom)] == aprom
+
+    def test_cli_upload_all_errors(self, monkeypatch):
+        with open('testdata/helloworld.bin', 'rb') as apromfile:
+            aprom_data = apromfile.read()
+        bus = evic.SimulatedHID([evic.SimulatedUnit(str(i))
+                                 for i in range(0, 2)], reset_delay=0.1)
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            env = {'XDG_CONFIG_HOME': os.getcwd()}
+            with open('test_aprom.bin', 'wb') as apromfile:
+                apromfile.write(aprom_data)
+
+            # Devices are told apart by their serial numbers
+            for serials in [['0', '0'], ['0', '']]:
+                args = ['upload', '--no-cache', 'test_aprom.bin']
+                for serial in serials:
+                    args += ['-s', serial]
+                result = runner.invoke(cli.usb, args, obj={'backend': bus},
+                                       env=env)
+                assert result.exit_code == 1
+                assert "unique serial numbers" in result.output
+
+            # An unexpected error only stops its own device
+            flash_aprom = cli.flash_aprom
+
+            def failing_flash_aprom(dev, *args):
+                if dev.serial == '1':
+                    raise RuntimeError("unexpected")
+                return flash_aprom(dev, *args)
+            monkeypatch.setattr(cli, 'flash_aprom', failing_flash_aprom)
+
+            result = runner.invoke(cli.usb, ['upload', '--no-cache', '--all',
+                                             'test_aprom.bin'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 1
+            assert "1: FAIL unexpected" in result.output
+            assert "1 of 2 devices" in result.output
+
+        aprom = evic.APROM(aprom_data).convert()
+        assert bus.units[0].flash[0:len(aprom)] == aprom
+
+    def test_cli_upload_delta(self):
+        with open('testdata/helloworld.bin', 'rb') as apromfile:
+            aprom = evic.APROM(apromfile.read()).convert()
+        bus = evic.SimulatedHID(reset_delay=0.1)
+        unit = bus.units[0]
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            env = {'XDG_CONFIG_HOME': os.getcwd()}
+            with open('test_aprom.bin', 'wb') as apromfile:
+                apromfile.write(aprom)
+
+            result = runner.invoke(cli.usb, ['upload', '-u', '--delta',
+                                             'test_aprom.bin'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+            assert "Writing APROM..." in result.output
+
+            # Change one page of the image
+            aprom[5000] ^= 0xFF
+            with open('test_aprom.bin', 'wb') as apromfile:
+                apromfile.write(aprom)
+
+            result = runner.invoke(cli.usb, ['--stats', 'upload', '-u',
+                                             '--delta', 'test_aprom.bin'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+            assert "Writing APROM changes...2.0 KB" in result.output
+            assert "Transfer statistics:" in result.output
+            assert "Flash write:" in result.output
+
+            # A plain upload doesn't journal the image
+            result = runner.invoke(cli.usb, ['upload', '-u',
+                                             'test_aprom.bin'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+            assert "Restarting to the new image" not in result.output
+            result = runner.invoke(cli.usb, ['upload', '-u', '--delta',
+                                             'test_aprom.bin'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+            assert "Writing APROM...OK" in result.output
+
+        assert unit.flash[0:len(aprom)] == aprom
+
+    def test_cli_upload_if_changed(self):
+        with open('testdata/helloworld.bin', 'rb') as apromfile:
+            aprom = evic.APROM(apromfile.read()).convert()
+        bus = evic.SimulatedHID(reset_delay=0.1)
+        unit = bus.units[0]
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            env = {'XDG_CONFIG_HOME': os.getcwd()}
+            with open('test_aprom.bin', 'wb') as apromfile:
+                apromfile.write(aprom)
+
+            args = ['upload', '-u', '--if-changed', 'test_aprom.bin']
+            result = runner.invoke(cli.usb, args, obj={'backend': bus},
+                                   env=env)
+            assert result.exit_code == 0
+            assert "Writing APROM..." in result.output
+
+            resets = unit.resets
+            result = runner.invoke(cli.usb, args, obj={'backend': bus},
+                                   env=env)
+            assert result.exit_code == 0
+            assert "already up to date" in result.output
+            assert unit.resets == resets
+
+            result = runner.invoke(cli.usb, args + ['--all'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+            assert "SKIP" in result.output
+            assert unit.resets == resets
+
+            # A data flash file is still written
+            dataflash = evic.DataFlash(bytearray(unit.dataflash), 0)
+            dataflash.power = 250
+            with open('test_dataflash.bin', 'wb') as dataflashfile:
+                dataflashfile.write(dataflash.array)
+            result = runner.invoke(cli.usb, args + ['-d',
+                                                    'test_dataflash.bin'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+            assert "Writing data flash...OK" in result.output
+            assert "Writing APROM" not in result.output
+            assert unit.resets == resets
+            assert unit.dataflash == dataflash.array
+
+    def test_cli_flash(self):
+        with open('testdata/helloworld.bin', 'rb') as apromfile:
+            aprom = evic.APROM(apromfile.read()).convert()
+        bus = evic.SimulatedHID(reset_delay=0.1)
+        unit = bus.units[0]
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            env = {'XDG_CONFIG_HOME': os.getcwd()}
+            with open('test_aprom.bin', 'wb') as apromfile:
+                apromfile.write(aprom)
+            Image.new('1', (64, 40), 1).save('test_logo.png')
+            with open('test_logo.png', 'rb') as logofile:
+                logo = evic.logo.fromimage(logofile)
+
+            result = runner.invoke(cli.usb, ['flash', '-u',
+                                             '--aprom', 'test_aprom.bin',
+                                             '--logo', 'test_logo.png'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+            assert result.output.count("Restarting the device...") == 1
+
+            result = runner.invoke(cli.usb, ['flash'], obj={'backend': bus},
+                                   env=env)
+            assert result.exit_code != 0
+
+        assert unit.resets == 1
+        assert unit.flash[0:len(aprom)] == aprom
+        assert unit.flash[102400:102400 + len(logo.array)] == logo.array
+
+    def test_cli_record_replay(self):
+        with open('testdata/helloworld.bin', 'rb') as apromfile:
+            aprom = evic.APROM(apromfile.read()).convert()
+        bus = evic.SimulatedHID(reset_delay=0.1)
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            env = {'XDG_CONFIG_HOME': os.getcwd()}
+            with open('test_aprom.bin', 'wb') as apromfile:
+                apromfile.write(aprom)
+            args = ['upload', '-u', '--no-cache', 'test_aprom.bin']
+
+            result = runner.invoke(cli.usb, ['--record', 'trace.bin'] + args,
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+
+            result = runner.invoke(cli.usb, ['--replay', 'trace.bin'] + args,
+                                   env=env)
+            assert result.exit_code == 0
+            assert "Writing APROM...OK" in result.output
+
+            result = runner.invoke(cli.main, ['trace', 'trace.bin',
+                                              'trace.bin'])
+            assert result.exit_code == 0
+            assert "write:" in result.output
+
+    def test_cli_patch(self):
+        with open('testdata/test_dataflash.bin', 'rb') as dataflashfile:
+            data = bytearray(dataflashfile.read())
+        bus = evic.SimulatedHID(units=[evic.SimulatedUnit('SIM0'),
+                                       evic.SimulatedUnit('SIM1')])
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            env = {'XDG_CONFIG_HOME': os.getcwd()}
+            with open('old.bin', 'wb') as dataflashfile:
+                dataflashfile.write(data)
+            evic.DataFlash(data, 0).power = 250
+            with open('new.bin', 'wb') as dataflashfile:
+                dataflashfile.write(data)
+
+            result = runner.invoke(cli.patch, ['diff', 'old.bin', 'new.bin',
+                                               '-o', 'power.json'])
+            assert result.exit_code == 0
+
+            result = runner.invoke(cli.patch, ['apply', 'power.json',
+                                               'old.bin', '-o', 'out'])
+            assert result.exit_code == 0
+            with open(os.path.join('out', 'old.bin'), 'rb') as dataflashfile:
+                assert dataflashfile.read() == data
+
+            result = runner.invoke(cli.usb, ['patch-dataflash', '--all',
+                                             'power.json'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+            assert result.output.count("Writing data flash...OK") == 2
+
+            result = runner.invoke(cli.usb, ['patch-dataflash', '-s', 'SIM1',
+                                             'power.json'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+            assert "Data flash is already up to date." in result.output
+
+            # A failing device doesn't stop the others
+            bus.units.insert(0, evic.SimulatedUnit('SIM2', product_id='W007'))
+            with open('power.json', 'w') as patchfile:
+                patchfile.write(evic.DataFlashPatch({'power': 300},
+                                                    'E052').dumps())
+            result = runner.invoke(cli.usb, ['patch-dataflash', '--all',
+                                             'power.json'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 1
+            assert "Patching failed on 1 of 3 devices." in result.output
+            assert result.output.count("Writing data flash...OK") == 2
+
+        for unit in bus.units[1:]:
+            assert evic.DataFlash(unit.dataflash, 0).power == 300
+
+    def test_cli_archive(self):
+        pytest.importorskip('numpy')
+        with open('testdata/test_dataflash.bin', 'rb') as dataflashfile:
+            data = bytearray(dataflashfile.read())
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            os.mkdir('dumps')
+            for serial, hw_version in [('A', 103), ('B', 106), ('C', 108)]:
+                evic.DataFlash(data, 0).hw_version = hw_version
+                with open(os.path.join('dumps', serial + '.bin'),
+                          'wb') as dataflashfile:
+                    dataflashfile.write(data)
+
+            result = runner.invoke(cli.archive, ['add', 'archive.evda',
+                                                 'dumps'])
+            assert result.exit_code == 0
+
+            result = runner.invoke(cli.archive, ['query', 'archive.evda',
+                                                 '-w', 'hw_version>=106',
+                                                 '-g', 'serial', '--list'])
+            assert result.exit_code == 0
+            assert "\tB: 1\n\tC: 1\n" in result.output
+            assert "2 of 3 dumps match." in result.output
+
+            result = runner.invoke(cli.archive, ['query', 'archive.evda',
+                                                 '-w', 'bogus>1'])
+            assert result.exit_code != 0
+
+    def test_cli_import_without_numpy(self):
+        # NumPy is only imported by the commands that use it
+        code = "import sys, evic.cli; sys.exit('numpy' in sys.modules)"
+        assert subprocess.call([sys.executable, '-c', code]) == 0
+
+    def test_cli_dump_dataflash_verify(self, monkeypatch):
+        bus = evic.SimulatedHID()
+        unit = bus.units[0]
+        read = unit.read_dataflash
+
+        def corrupted_read_dataflash():
+            data = read()
+            data[0] ^= 0xFF
+            return data
+        monkeypatch.setattr(unit, 'read_dataflash', corrupted_read_dataflash)
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            env = {'XDG_CONFIG_HOME': os.getcwd()}
+            result = runner.invoke(cli.usb, ['dump-dataflash', '-o', 'd.bin'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 1
+            assert "Verifying data flash...FAIL" in result.output
+
+            result = runner.invoke(cli.usb, ['dump-dataflash', '--no-verify',
+                                             '-o', 'd.bin'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+            assert "Verifying data flash" not in result.output
+            with open('d.bin', 'rb') as dataflashfile:
+                assert dataflashfile.read() == unit.dataflash
+
+    def test_cli_backup_restore(self):
+        bus = evic.SimulatedHID()
+        unit = bus.units[0]
+        original = bytearray(unit.dataflash)
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            env = {'XDG_CONFIG_HOME': os.getcwd()}
+            result = runner.invoke(cli.usb, ['dump-dataflash', '-o', 'd.bin'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+
+            evic.DataFlash(unit.dataflash, 0).power = 400
+            result = runner.invoke(cli.usb, ['restore-dataflash', '1'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+            assert "Writing data flash...OK" in result.output
+            assert unit.dataflash == original
+
+            result = runner.invoke(cli.backup, ['list'], env=env)
+            assert result.exit_code == 0
+            assert "2 backups of 2 distinct data flashes" in result.output
+
+            result = runner.invoke(cli.backup, ['export', '2', '-o', 'b.bin'],
+                                   env=env)
+            assert result.exit_code == 0
+            with open('b.bin', 'rb') as dataflashfile:
+                assert evic.DataFlash(bytearray(dataflashfile.read()),
+                                      0).power == 400
+
+            result = runner.invoke(cli.usb, ['restore-dataflash', '3'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code != 0
+
+            result = runner.invoke(cli.usb, ['--no-backup', 'dump-dataflash',
+                                             '-o', 'd.bin'],
+                                   obj={'backend': bus}, env=env)
+            assert result.exit_code == 0
+            result = runner.invoke(cli.backup, ['list'], env=env)
+            assert "2 backups" in result.output
@@ -53,3 +53,78 @@ class TestDataFlash:
 
             with pytest.raises(evic.DataFlashError):
                 dataflash.verify(0)
+
+    def test_dataflash_settings(self):
+        with open("testdata/test_dataflash.bin", "rb") as dataflashfile:
+            dataflash = evic.DataFlash(bytearray(dataflashfile.read()), 0)
+
+        settings = dataflash.settings()
+        assert list(settings) == list(evic.DataFlash.fields)
+        assert settings['magic'] == 0x32
+        assert settings['tc_power'] == 750
+        assert settings['is_celsius'] == 1
+        assert settings['temp_coefs_ni'][0:3] == (10, 20, 35)
+        assert settings['fmc_cid'] == 0xDA
+        assert settings['product_id'] == "E052"
+        for name, value in settings.items():
+            assert getattr(dataflash, name) == value
+
+    def test_dataflash_update(self):
+        with open("testdata/test_dataflash.bin", "rb") as dataflashfile:
+            data = bytearray(dataflashfile.read())
+        # A data flash inside a larger buffer
+        dataflash = evic.DataFlash(bytearray(4) + data, 4)
+
+        dataflash.update({'power': 400, 'temp_coefs_ti': range(0, 21),
+                          'product_id': "W0"})
+        assert dataflash.power == 400
+        assert dataflash.temp_coefs_ti == tuple(range(0, 21))
+        assert dataflash.product_id == "W052"
+        assert dataflash.array[4:16] == data[0:12]
+
+        with pytest.raises(KeyError):
+            dataflash.update({'array': None})
+        with pytest.raises(ValueError):
+            dataflash.bootflag = 256
+        with pytest.raises(ValueError):
+            dataflash.temp_coefs_ni = (1, 2)
+
+    def test_dataflash_tracking(self):
+        with open("testdata/test_dataflash.bin", "rb") as dataflashfile:
+            dataflash = evic.DataFlash(bytearray(dataflashfile.read()), 0)
+
+        assert dataflash.checksum == sum(dataflash.array)
+        assert not dataflash.changed
+
+        # Writing the same value is not a change
+        dataflash.hw_version = dataflash.hw_version
+        assert not dataflash.changed
+
+        dataflash.bootflag = 1
+        dataflash.mode = 2
+        dataflash.fw_version = 303
+        dataflash.product_id = "W007"
+        assert dataflash.changed
+        assert dataflash.checksum == sum(dataflash.array)
+        assert dataflash.dirty_ranges() == [(9, 11), (256, 260), (312, 316)]
+
+        # Back to the original value
+        dataflash.bootflag = 0
+        dataflash.mode = 4
+        assert dataflash.dirty_ranges() == [(256, 260), (312, 316)]
+        assert dataflash.checksum == sum(dataflash.array)
+
+        dataflash.mark_clean()
+        assert not dataflash.changed
+
+        # Shorter and longer strings at the same offset
+        dataflash.product_id = "E0"
+        dataflash.product_id = "E052"
+        assert dataflash.dirty_ranges() == [(312, 316)]
+        dataflash.product_id = "W007"
+        assert not dataflash.changed
+
+        # Direct changes to the array drop the cached checksum
+        dataflash.array[100] ^= 0xFF
+        assert dataflash.checksum == sum(dataflash.array)
+        dataflash.verify(sum(dataflash.array))
@@ -17,11 +17,59 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import struct
+
+import pytest
+
 import evic
+from evic.device import changed_ranges
+
+
+class RecordingDevice(object):
+
+    def __init__(self, short=False):
+        self.reports = []
+        self.short = short
+
+    def write(self, buf):
+        self.reports.append(bytes(buf))
+        return len(buf) - self.short
+
+
+class FailingDevice(object):
+
+    def write(self, buf):
+        raise IOError("hid_write failed: broken pipe")
+
+
+class ReadingDevice(object):
+
+    def __init__(self, data, full_pages=False):
+        self.data = bytearray(data)
+        self.full_pages = full_pages
+
+    def read(self, length):
+        if self.full_pages:
+            length = 64
+        report, self.data = self.data[:length], self.data[length:]
+        return list(report)
 
 
 class TestDevice:
 
+    def test_changed_ranges(self):
+        old = bytearray(10000)
+        new = bytearray(old)
+        new[100] = 1
+        new[2048] = 1
+        new[6200] = 1
+
+        assert changed_ranges(old, old) == []
+        assert changed_ranges(old, new) == [(0, 4096), (6144, 8192)]
+        # Longer image
+        assert changed_ranges(old, new + bytearray(10)) == \
+            [(0, 4096), (6144, 10010)]
+
     def test_hidtransfer_hidcmd(self):
         read_df_cmd = bytearray(b'5\x0e\x00\x00\x00\x00\x00\x08\x00\x00HIDCc\x01\x00\x00')
         write_df_cmd = bytearray(b'S\x0e\x00\x00\x00\x00\x00\x08\x00\x00HIDC\x81\x01\x00\x00')
@@ -32,3 +80,115 @@ class TestDevice:
         assert evic.HIDTransfer.hidcmd(0xB4, 0, 0) == reset_cmd
         assert evic.HIDTransfer.hidcmd(0x35, 0, 2048) == read_df_cmd
         assert evic.HIDTransfer.hidcmd(0x53, 0, 2048) == write_df_cmd
+
+    def test_hidtransfer_write(self):
+        dev = evic.HIDTransfer()
+        dev.device = RecordingDevice()
+        data = bytearray(range(0, 200))
+
+        dev.write(data)
+
+        assert [len(report) for report in dev.device.reports] == \
+            [65, 65, 65, 9]
+        assert all(report[0] == 0 for report in dev.device.reports)
+        assert b''.join(report[1:] for report in dev.device.reports) == data
+
+    def test_hidtransfer_write_fail(self):
+        dev = evic.HIDTransfer()
+        dev.device = RecordingDevice(short=True)
+
+        with pytest.raises(IOError):
+            dev.write(bytearray(100))
+
+        # The hidapi error is kept
+        dev.device = FailingDevice()
+        with pytest.raises(evic.TransferError) as excinfo:
+            dev.write(bytearray(100))
+        assert "broken pipe" in str(excinfo.value)
+
+    def test_hidtransfer_read(self):
+        data = bytearray(range(0, 200))
+        dev = evic.HIDTransfer()
+
+        dev.device = ReadingDevice(data)
+        assert dev.read(200) == data
+
+        # Windows reads full pages
+        dev.device = ReadingDevice(data + bytearray(56), full_pages=True)
+        buf = bytearray(300)
+        assert dev.readinto(memoryview(buf)[100:]) == 200
+        assert buf[100:] == data
+
+        dev.device = ReadingDevice(data)
+        with pytest.raises(IOError):
+            dev.read(256)
+
+    def test_hidtransfer_read_dataflash(self):
+        with open("testdata/test_dataflash.bin", "rb") as dataflashfile:
+            data = bytearray(dataflashfile.read())
+        dev = evic.HIDTransfer()
+        dev.device = ReadingDevice(struct.pack("=I", sum(data)) + data)
+        dev.device.write = lambda buf: len(buf)
+
+        dataflash, checksum = dev.read_dataflash()
+
+        assert checksum == sum(data)
+        assert dataflash.array == data
+        assert dataflash.product_id == "E052"
+        assert not dev.ldrom
+
+    def test_hidtransfer_reconnect(self):
+        dev = evic.HIDTransfer()
+        dev.device = RecordingDevice()
+        dev.device.close = lambda: None
+        # Gone for two polls, then still in APROM once, then in LDROM
+        states = [None, None, False, True]
+
+        def try_reconnect(ldrom):
+            dev.ldrom = states.pop(0)
+            return bool(dev.ldrom)
+        dev.try_reconnect = try_reconnect
+
+        dev.reset()
+        latency = dev.reconnect(delay=0, interval=0.01)
+
+        assert not states
+        assert latency == dev.reset_latency
+        assert 0 < latency < 1
+
+        states = [None] * 1000
+        with pytest.raises(IOError):
+            dev.reconnect(delay=0, interval=0.01, timeout=0.05)
+
+    def test_hidtransfer_reconnect_events(self):
+        dev = evic.HIDTransfer(backend=evic.SimulatedHID(reset_delay=0.05))
+        dev.connect()
+        events = []
+        dev.listeners.append(events.append)
+
+        dev.reset()
+        dev.reconnect(delay=0, interval=0.01, ldrom=False)
+
+        # The polling isn't reported
+        assert [event.event for event in events] == \
+            ['report_write', 'command', 'reset', 'reconnect']
+        assert events[-1].retries > 0
+        assert dev.listeners == [events.append]
+
+    def test_hidtransfer_listeners(self):
+        dev = evic.HIDTransfer()
+        dev.device = RecordingDevice()
+        events = []
+        stats = evic.TransferStats()
+        dev.listeners.extend([events.append, stats])
+
+        dev.write_flash(bytearray(100), 0)
+
+        assert [event.event for event in events] == \
+            ['report_write', 'command', 'report_write', 'report_write',
+             'write_flash']
+        assert events[1].command == 0xC3
+        assert events[-1].nbytes == 100
+        totals = dict((total.event, total) for total in stats.totals())
+        assert totals['report_write'].count == 3
+        assert totals['report_write'].nbytes == 118
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+import evic
+
+
+class TestImageCache:
+
+    def test_imagecache_load(self, tmpdir):
+        with open("testdata/helloworld.bin", "rb") as apromfile:
+            aprom_data = apromfile.read()
+
+        cache = evic.ImageCache(str(tmpdir))
+        aprom = cache.load(aprom_data)
+        assert (cache.hits, cache.misses) == (0, 1)
+
+        cached = evic.ImageCache(str(tmpdir)).load(aprom_data)
+        assert cached.data == aprom.data == evic.APROM(aprom_data).convert()
+        assert cached.info == aprom.info
+        cached.verify(['E052'], 106)
+
+        # Unencrypted images use a different key
+        cache.load(aprom_data, encrypted=False)
+        assert cache.misses == 2
+
+    def test_imagecache_damaged(self, tmpdir):
+        with open("testdata/helloworld.bin", "rb") as apromfile:
+            aprom_data = apromfile.read()
+
+        cache = evic.ImageCache(str(tmpdir))
+        aprom = cache.load(aprom_data)
+        key = cache.key(aprom_data)
+
+        # A truncated image is converted again
+        imagepath = tmpdir.join(key + '.bin')
+        imagepath.write_binary(aprom.data[:100])
+        assert cache.get(key) is None
+        assert cache.load(aprom_data).data == aprom.data
+        assert (cache.hits, cache.misses) == (0, 2)
+        assert imagepath.read_binary() == aprom.data
+
+        # Entries without a hash are stale
+        tmpdir.join(key + '.json').write('{"manufacturer": true}')
+        assert cache.get(key) is None
+
+    def test_imagecache_evict(self, tmpdir):
+        cache = evic.ImageCache(str(tmpdir), max_size=2500)
+
+        for i in range(0, 3):
+            key = cache.key(bytes([i]))
+            cache.put(key, evic.APROM(bytearray(1000)))
+            os.utime(str(tmpdir.join(key + '.bin')), (i, i))
+        cache.evict()
+
+        assert cache.get(cache.key(bytes([0]))) is None
+        assert cache.get(cache.key(bytes([2]))) is not None
+        assert len(tmpdir.listdir()) == 4
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import evic
+
+
+class TestJournal:
+
+    def test_journal_current(self, tmpdir):
+        with open("testdata/test_dataflash.bin", "rb") as dataflashfile:
+            dataflash = evic.DataFlash(bytearray(dataflashfile.read()), 0)
+        journal = evic.FlashJournal(str(tmpdir))
+
+        assert journal.current('A', dataflash, False) is None
+
+        journal.put('A', bytearray(b'image'), dataflash)
+        assert journal.get('A').fw_version == dataflash.fw_version
+        # Interrupted writes leave the device in LDROM
+        assert journal.current('A', dataflash, True) is None
+        assert journal.current('A', dataflash, False) == b'image'
+
+        # Flashed elsewhere
+        other = evic.DataFlash(bytearray(dataflash.array), 0)
+        other.fw_version = 999
+        assert journal.current('A', other, False) is None
+        # Another device with the same serial number
+        other = evic.DataFlash(bytearray(dataflash.array), 0)
+        other.fmc_uid = (1, 2, 3)
+        assert journal.current('A', other, False) is None
+
+        journal.overwritten('A', 102400)
+        assert journal.get('A') is not None
+        journal.overwritten('A', 0)
+        assert journal.get('A') is None
+
+    def test_journal_has_image(self, tmpdir):
+        with open("testdata/test_dataflash.bin", "rb") as dataflashfile:
+            dataflash = evic.DataFlash(bytearray(dataflashfile.read()), 0)
+        journal = evic.FlashJournal(str(tmpdir))
+
+        assert not journal.has_image('A', dataflash, False, b'image')
+        journal.put('A', bytearray(b'image'), dataflash)
+        assert not journal.has_image('A', dataflash, True, b'image')
+        assert journal.has_image('A', dataflash, False, b'image')
+        assert not journal.has_image('A', dataflash, False, b'other')
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import struct
+import pytest
+
+import evic
+
+
+def load_dataflash():
+    with open("testdata/test_dataflash.bin", "rb") as dataflashfile:
+        return evic.DataFlash(bytearray(dataflashfile.read()), 0)
+
+
+class TestPatch:
+
+    def test_patch_diff_apply(self):
+        old = load_dataflash()
+        new = load_dataflash()
+        new.update({'bootflag': 1, 'power': 400,
+                    'temp_coefs_ni': range(0, 21), 'fmc_uid': (1, 2, 3)})
+
+        patch = evic.DataFlashPatch.diff(old, new)
+        assert list(patch.fields) == ['bootflag', 'power', 'temp_coefs_ni']
+        assert patch.product_id == "E052"
+
+        patch = evic.DataFlashPatch.loads(patch.dumps())
+        assert patch.fields['temp_coefs_ni'] == tuple(range(0, 21))
+        assert patch.apply(old)
+        assert old.checksum == sum(old.array)
+        assert old.settings()['power'] == 400
+        assert old.fmc_uid != (1, 2, 3)
+
+        # Already applied
+        old.mark_clean()
+        assert not patch.apply(old)
+
+    def test_patch_errors(self):
+        dataflash = load_dataflash()
+
+        with pytest.raises(evic.PatchError):
+            evic.DataFlashPatch.loads('{"fields": {}}')
+        with pytest.raises(evic.PatchError):
+            evic.DataFlashPatch({'array': 0})
+        with pytest.raises(evic.PatchError):
+            evic.DataFlashPatch({'bootflag': 1}, "W007").apply(dataflash)
+        with pytest.raises(evic.PatchError):
+            evic.DataFlashPatch({'bootflag': 256}).apply(dataflash)
+        for fields in [{'product_id': 52}, {'power': "400"},
+                       {'fmc_uid': [1, 2]}, {'fmc_uid': "abc"}]:
+            with pytest.raises(evic.PatchError):
+                evic.DataFlashPatch(fields)
+        with pytest.raises(evic.PatchError):
+            evic.DataFlashPatch.loads('{"format": "evic-dataflash-patch", '
+                                      '"version": 1, "product_id": 52, '
+                                      '"fields": {}}')
+
+    def test_patch_file(self, tmpdir):
+        dataflash = load_dataflash()
+        path = str(tmpdir.join('checksum.bin'))
+        with open(path, 'wb') as dataflashfile:
+            dataflashfile.write(struct.pack('=I', dataflash.checksum))
+            dataflashfile.write(dataflash.array)
+
+        patch = evic.DataFlashPatch({'mode': 1, 'temp': 450})
+        assert evic.patch.apply_to_file(patch, path)
+        with open(path, 'rb') as dataflashfile:
+            buf = bytearray(dataflashfile.read())
+        assert struct.unpack('=I', bytes(buf[0:4]))[0] == sum(buf[4:])
+        assert evic.DataFlash(buf, 4).temp == 450
+        assert not evic.patch.apply_to_file(patch, path)
+
+        # A wrong checksum is not silently fixed
+        buf[0] ^= 1
+        with open(path, 'wb') as dataflashfile:
+            dataflashfile.write(buf)
+        with pytest.raises(evic.DataFlashError):
+            evic.patch.apply_to_file(patch, path)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import tempfile
+import threading
+
+import pytest
+from PIL import Image
+
+import evic
+from evic import client
+from evic.server import SessionServer
+
+
+@pytest.fixture
+def server(tmpdir):
+    bus = evic.SimulatedHID(reset_delay=0.1)
+    journal = evic.FlashJournal(str(tmpdir.join('journal')))
+    server = SessionServer(str(tmpdir.join('evic.sock')), bus, journal)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestServer:
+
+    def test_server_caches_dataflash(self, server):
+        path = server.server_address
+        unit = server.backend.units[0]
+
+        devices = client.request(path, 'list')['devices']
+        assert devices == [{'serial': unit.serial,
+                            'product': "HID Transfer"}]
+
+        info = client.request(path, 'info')
+        assert info['serial'] == unit.serial
+        assert info['product_id'] == 'E052'
+        assert not info['cached']
+
+        response = client.request(path, 'dump-dataflash',
+                                  serial=unit.serial)
+        assert response['cached']
+        assert client.decode(response['dataflash']) == unit.dataflash
+
+        # Changing the device drops the cache
+        client.request(path, 'reset-dataflash')
+        assert not client.request(path, 'info')['cached']
+
+    def test_server_upload(self, server, tmpdir):
+        path = server.server_address
+        unit = server.backend.units[0]
+        with open('testdata/helloworld.bin', 'rb') as apromfile:
+            aprom = apromfile.read()
+        apromfile = tmpdir.join('aprom.bin')
+        apromfile.write_binary(aprom)
+
+        assert client.main(['--socket', path, 'upload',
+                            str(apromfile)]) == 0
+        data = evic.APROM(aprom).convert()
+        assert unit.flash[0:len(data)] == data
+        assert unit.resets == 1
+
+        dumpfile = tmpdir.join('dataflash.bin')
+        assert client.main(['--socket', path, 'dump-dataflash',
+                            '-o', str(dumpfile)]) == 0
+        assert dumpfile.read_binary() == unit.read_dataflash()[4:]
+
+        with pytest.raises(IOError):
+            client.request(path, 'upload', aprom=client.encode(b'bad'),
+                           encrypted=False)
+
+    def test_server_upload_logo(self, server, tmpdir):
+        path = server.server_address
+        unit = server.backend.units[0]
+        logofile = tmpdir.join('logo.png')
+        Image.new('1', (64, 40), 1).save(str(logofile))
+        with open(str(logofile), 'rb') as imagefile:
+            logo = evic.logo.fromimage(imagefile)
+
+        assert client.main(['--socket', path, 'upload-logo',
+                            str(logofile)]) == 0
+        assert unit.flash[102400:102400 + len(logo.array)] == logo.array
+
+        Image.new('1', (10, 10), 1).save(str(logofile))
+        with pytest.raises(IOError):
+            client.request(path, 'upload-logo',
+                           logo=client.encode(logofile.read_binary()))
+
+    def test_server_socket_in_use(self, server, tmpdir):
+        backend, journal = server.backend, server.journal
+        with pytest.raises(IOError):
+            SessionServer(server.server_address, backend, journal)
+
+        # Not a socket
+        path = tmpdir.join('file')
+        path.write('data')
+        with pytest.raises(IOError):
+            SessionServer(str(path), backend, journal)
+        assert path.read() == 'data'
+
+        # The socket of a server that is gone is replaced
+        stale = SessionServer(str(tmpdir.join('stale.sock')), backend,
+                              journal)
+        stale.socket.close()
+        SessionServer(stale.server_address, backend, journal).server_close()
+
+    def test_default_socket_path(self, monkeypatch):
+        monkeypatch.delenv('EVIC_SOCKET', raising=False)
+        monkeypatch.setenv('XDG_RUNTIME_DIR', '/run/user/1000')
+        assert client.default_socket_path() == '/run/user/1000/evic.sock'
+
+        monkeypatch.delenv('XDG_RUNTIME_DIR')
+        assert client.default_socket_path().startswith(tempfile.gettempdir())
+
+        monkeypatch.setenv('EVIC_SOCKET', '/tmp/other.sock')
+        assert client.default_socket_path() == '/tmp/other.sock'
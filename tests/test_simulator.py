@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import pytest
+
+import evic
+
+
+class TestSimulator:
+
+    def test_simulator_dataflash(self):
+        bus = evic.SimulatedHID([evic.SimulatedUnit('A'),
+                                 evic.SimulatedUnit('B', product_id='W007')])
+        dev = evic.HIDTransfer(serial='B', backend=bus)
+        dev.connect()
+        assert dev.serial == 'B'
+
+        dataflash, checksum = dev.read_dataflash()
+        dataflash.verify(checksum)
+        assert dataflash.product_id == 'W007'
+        assert not dev.ldrom
+
+        dataflash.hw_version = 111
+        assert dataflash.changed
+        dev.write_dataflash(dataflash)
+        assert not dataflash.changed
+        assert dev.read_dataflash()[0].hw_version == 111
+
+        dev.reset_dataflash()
+        assert dev.read_dataflash()[0].hw_version == 106
+
+    def test_simulator_reset_and_flash(self):
+        bus = evic.SimulatedHID(reset_delay=0.1)
+        unit = bus.units[0]
+        dev = evic.HIDTransfer(backend=bus)
+        dev.connect()
+
+        dataflash, _ = dev.read_dataflash()
+        dataflash.bootflag = 1
+        dev.write_dataflash(dataflash)
+        dev.reset()
+
+        # The old handle is gone
+        with pytest.raises(IOError):
+            dev.read_dataflash()
+        assert not bus.enumerate()
+
+        assert dev.reconnect(delay=0, interval=0.01) >= 0.1
+        assert dev.ldrom
+        assert unit.ldrom and unit.resets == 1
+
+        dev.write_aprom(evic.APROM(b'\x12' * 1000))
+        dev.write_flash(bytearray(b'\x34' * 10), 102400)
+        assert unit.flash[0:1000] == b'\x12' * 1000
+        assert unit.flash[1000] == 0xFF
+        assert unit.flash[102400:102410] == b'\x34' * 10
+
+    def test_simulator_flash_write_fault(self):
+        bus = evic.SimulatedHID()
+        dev = evic.HIDTransfer(backend=bus)
+        dev.connect()
+
+        # Retrying is opt-in
+        bus.fail_writes(1, after=10)
+        with pytest.raises(evic.TransferError) as excinfo:
+            dev.write_flash(bytearray(4096), 0)
+        assert excinfo.value.offset == 9 * 64
+
+    def test_simulator_resume_flash_write(self):
+        # Models an LDROM dropping the interrupted transfer on reopen
+        bus = evic.SimulatedHID(abandon_transfers=True)
+        unit = bus.units[0]
+        dev = evic.HIDTransfer(backend=bus)
+        dev.write_attempts = 3
+        dev.flash_attempts = 3
+        dev.retry_delay = 0
+        events = []
+        dev.listeners.append(events.append)
+        dev.connect()
+        data = bytearray(range(0, 256)) * 40
+
+        # A lost report is written again
+        bus.fail_writes(2, after=10)
+        dev.write_flash(data, 0)
+        assert unit.flash[0:len(data)] == data
+        assert events[-1].retries == 0
+        assert sum(event.retries for event in events) == 2
+
+        # The write resumes from the page of the first lost report
+        del events[:]
+        unit.flash[:] = b'\xff' * len(unit.flash)
+        bus.fail_writes(3, after=40)
+        dev.write_flash(data, 0)
+        assert unit.flash[0:len(data)] == data
+        assert events[-1].retries == 1
+        reports = [event for event in events if event.event == 'report_write']
+        assert len(reports) == 1 + 39 + 1 + (len(data) - 2048) // 64
+
+        bus.fail_writes(100)
+        with pytest.raises(evic.TransferError):
+            dev.write_flash(data, 0)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Evic is a USB programmer for devices based on the Joyetech Evic VTC Mini.
+Copyright © Jussi Timperi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import io
+
+import pytest
+
+import evic
+from evic import trace
+
+
+def session(backend, data):
+    dev = evic.HIDTransfer(serial='SIM0000000', backend=backend)
+    dev.connect()
+    dataflash, checksum = dev.read_dataflash()
+    dev.write_flash(data, 0)
+    dev.close()
+    return (dev.serial, dataflash.array, checksum)
+
+
+class TestTrace:
+
+    def test_trace_record_replay(self):
+        data = bytearray(range(0, 256)) * 4
+        tracefile = io.BytesIO()
+        recorded = session(trace.RecordingHID(evic.SimulatedHID(), tracefile),
+                           data)
+
+        tracefile.seek(0)
+        summary = dict((total.kind, total) for total in
+                       trace.summarize(trace.read_trace(tracefile)))
+        # Commands 0x35 and 0xC3, 16 data reports
+        assert summary['write'].count == 18
+        assert summary['read'].count == 32
+        assert summary['read'].nbytes == 2048
+
+        tracefile.seek(0)
+        replay = trace.ReplayHID(tracefile)
+        assert session(replay, data) == recorded
+        assert replay.position == len(replay.records)
+
+        # The replayed traffic must match the recording
+        tracefile.seek(0)
+        data[300] ^= 0xFF
+        with pytest.raises(IOError) as excinfo:
+            session(trace.ReplayHID(tracefile), data)
+        assert "differs" in str(excinfo.value)
+
+    def test_trace_invalid(self):
+        with pytest.raises(evic.TraceError):
+            list(trace.read_trace(io.BytesIO(b'not a trace')))
+        with pytest.raises(evic.TraceError):
+            list(trace.read_trace(io.BytesIO(trace.MAGIC + b'\x01\x05')))